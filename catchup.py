@@ -0,0 +1,183 @@
+"""Restart catch-up for Hermes
+
+    Finds the reminders missed while the bot was down, so each user gets a single summary
+    instead of every stale reminder at once.
+"""
+import os
+import time
+import random
+import datetime
+import tempfile
+import threading
+from shifts import MINUTES_PER_WEEK, minute_of_week, window
+
+SECONDS_PER_WEEK = MINUTES_PER_WEEK * 60
+
+
+def popcount(mask):
+    """Count the bits set in a bitmap.
+
+    Args:\n
+        mask (int): The bitmap.
+
+    Returns:\n
+        int: Number of bits set.
+    """
+    return bin(mask).count("1")
+
+
+class CatchUp():
+    def __init__(self, path, timezone, interval=60, jitter=300, grace=60, clock=time.time, rng=None):
+        """Heartbeat file and missed reminder counter
+
+        The bot writes the time to the heartbeat file every interval seconds, along with the time of the last slot whose reminders were sent.
+        After a restart every slot since then was missed. While running, a slot more than grace seconds old that was not sent
+        was dropped by the scheduler, so each beat checks the slots between the last one sent and grace seconds ago.
+        The slots missed by each user are counted with a bitwise and of the user's weekly bitmap
+        and the bitmap of the outage window, and the catch-up messages are spread over the jitter window.
+
+        Args:\n
+            path (str): String containing the relative or full path to the heartbeat file.
+            timezone (tzinfo): Timezone the weekly bitmaps are in.
+            interval (float, optional): Seconds between beats. Defaults to 60.
+            jitter (float, optional): Seconds the catch-up messages are spread over. Defaults to 300.
+            grace (float, optional): Seconds a late job may still run before the scheduler drops it. Defaults to 60.
+            clock (callable, optional): Returns the current timestamp. Defaults to time.time.
+            rng (Random, optional): Random generator for the jitter. Defaults to None, a new generator.
+        """
+        self.path = path
+        self.timezone = timezone
+        self.interval = interval
+        self.jitter = jitter
+        self.grace = grace
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+        self.last, self.last_handled = self.read()
+
+    def read(self):
+        """Read the heartbeat file.
+
+        Returns:\n
+            tuple: (timestamp of the last beat, time of the last slot handled), either is None when unknown.
+        """
+        try:
+            with open(self.path) as file:
+                values = [float(value) for value in file.read().split()]
+        except (OSError, ValueError):
+            return None, None
+        return tuple(values + [None, None])[:2]
+
+    def last_seen(self):
+        """Read the last beat from the heartbeat file.
+
+        Returns:\n
+            float: Timestamp of the last beat, None if the bot never ran before.
+        """
+        return self.read()[0]
+
+    def write(self):
+        """Replace the heartbeat file with the last beat and the last slot handled."""
+        folder = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".heartbeat-", suffix=".tmp", dir=folder)
+        with os.fdopen(fd, "w") as file:
+            file.write(" ".join(repr(value) for value in (self.last, self.last_handled) if value is not None))
+        os.replace(tmp_path, self.path)
+
+    def handled(self, timestamp):
+        """Record that the reminders of a slot were sent, so they are not counted as missed after a restart.
+
+        Args:\n
+            timestamp (float): Time of the slot.
+        """
+        with self._lock:
+            if self.last_handled is not None and timestamp <= self.last_handled:
+                return
+            self.last_handled = timestamp
+            self.write()
+
+    def beat(self, now=None, restart=False):
+        """Record that the bot is alive.
+
+        Args:\n
+            now (float, optional): Current timestamp. Defaults to None, asking the clock.
+            restart (bool, optional): True on the first beat after starting, when every slot since the last one handled was missed.
+                Otherwise only the slots older than the grace time were. Defaults to False.
+
+        Returns:\n
+            tuple: (since, until) timestamps of the outage that ended with this beat, None if no slot was missed.
+        """
+        now = self.clock() if now is None else now
+        with self._lock:
+            known = [value for value in (self.last, self.last_handled) if value is not None]
+            self.last = now
+            self.write()
+        if not known:
+            return None
+        since, until = max(known), now if restart else now - self.grace
+        if until // 60 <= since // 60:
+            return None  # No slot started in between
+        return since, until
+
+    def next_beat(self, now=None):
+        """Get the time the beats should start at.
+
+        The beats fall half a minute after the slots once the grace time is taken off,
+        so the window checked while running never ends right on a slot that may still be running.
+        Keep the interval a multiple of a minute for the beats to stay in step.
+
+        Args:\n
+            now (float, optional): Current timestamp. Defaults to None, asking the clock.
+
+        Returns:\n
+            float: Timestamp of the first beat.
+        """
+        now = self.clock() if now is None else now
+        return now + ((30 + self.grace) - now) % 60
+
+    def minute(self, timestamp):
+        """Convert a timestamp into its minute of the week.
+
+        Args:\n
+            timestamp (float): The timestamp.
+
+        Returns:\n
+            int: Minutes since monday 00:00 in the bot's timezone.
+        """
+        moment = datetime.datetime.fromtimestamp(timestamp, self.timezone)
+        return minute_of_week((moment.weekday(), moment.hour, moment.minute))
+
+    def missed(self, mask, since, until):
+        """Count the slots of a user between two moments.
+
+        Args:\n
+            mask (int): The user's weekly bitmap.
+            since (float): Timestamp of the last slot that was handled, excluded.
+            until (float): Timestamp of the last slot that was missed, included.
+
+        Returns:\n
+            int: Number of slots missed.
+        """
+        if until <= since:
+            return 0
+        weeks = int((until - since) // SECONDS_PER_WEEK)
+        span = window((self.minute(since) + 1) % MINUTES_PER_WEEK, (self.minute(until) + 1) % MINUTES_PER_WEEK)
+        return weeks * popcount(mask) + popcount(mask & span)
+
+    def plan(self, masks, since, until):
+        """Plan the catch-up messages of an outage.
+
+        Args:\n
+            masks (dict): personId -> weekly bitmap.
+            since (float): Timestamp of the last slot that was handled, excluded.
+            until (float): Timestamp of the last slot that was missed, included.
+
+        Returns:\n
+            list: List of (personId, missed slots, delay in seconds) tuples for the users that missed any slot, sorted by delay.
+        """
+        plan = []
+        for personId, mask in masks.items():
+            count = self.missed(mask, since, until)
+            if count:
+                plan.append((personId, count, self.rng.uniform(0, self.jitter)))
+        return sorted(plan, key=lambda item: item[2])
@@ -0,0 +1,298 @@
+"""Multi-process operation for Hermes
+
+    Runs several bot processes on one host: they share the listening socket and the SQLite stores,
+    split the reminders by consistent hashing of the personId and elect a leader with a file lock.
+"""
+import os
+import sys
+import time
+import bisect
+import signal
+import socket
+import hashlib
+import threading
+import traceback
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FileLock():
+    def __init__(self, path):
+        """Exclusive OS lock on a file
+
+        The lock belongs to the open file, the OS releases it when the process exits,
+        so a crashed process never leaves a stale lock behind.
+        The pid of the holder is written to the file, for information only.
+
+        Args:\n
+            path (str): String containing the relative or full path to the lock file.
+        """
+        self.path = path
+        self.file = None
+
+    @property
+    def locked(self):
+        """bool: True while this process holds the lock."""
+        return self.file is not None
+
+    def acquire(self, blocking=False):
+        """Take the lock.
+
+        Args:\n
+            blocking (bool, optional): Wait until the lock is free. Defaults to False.
+
+        Returns:\n
+            bool: True if the lock is held, False if another process holds it.
+        """
+        if self.file:
+            return True
+        file = open(self.path, "a+")
+        try:
+            if fcntl:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        except OSError:
+            file.close()
+            return False
+        file.seek(0)
+        file.truncate()
+        file.write(str(os.getpid()))
+        file.flush()
+        self.file = file
+        return True
+
+    def release(self):
+        """Release the lock, if held."""
+        if not self.file:
+            return
+        try:
+            if fcntl:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.file.close()
+            self.file = None
+
+    def holder(self):
+        """Read the pid of the process that last took the lock.
+
+        Returns:\n
+            int: The pid, None if the lock was never taken.
+        """
+        try:
+            with open(self.path) as file:
+                return int(file.read().strip())
+        except (OSError, ValueError):
+            return None
+
+
+class LeaderElection():
+    def __init__(self, path, on_elected, interval=1.0):
+        """Leader election through a file lock
+
+        Every process tries to take the lock every interval seconds, the one that gets it is the leader until it exits.
+        As the OS releases the lock of a dead process, another process takes over within interval seconds.
+
+        Args:\n
+            path (str): String containing the relative or full path to the lock file.
+            on_elected (callable): Called once, on the election thread, when this process becomes the leader.
+            interval (float, optional): Seconds between attempts to take the lock. Defaults to 1.0.
+        """
+        self.lock = FileLock(path)
+        self.on_elected = on_elected
+        self.interval = interval
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="hermes-election", daemon=True)
+
+    @property
+    def leader(self):
+        """bool: True if this process is the leader."""
+        return self.lock.locked
+
+    def start(self):
+        """Start competing for the lock in the background."""
+        self.thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.lock.acquire():
+                try:
+                    self.on_elected()
+                except Exception as e:
+                    print(f"Taking the lead failed: {e!r}")
+                return
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        """Stop competing for the lock and step down if this process is the leader."""
+        self._stop.set()
+        self.lock.release()
+
+
+class HashRing():
+    def __init__(self, nodes=(), replicas=100):
+        """Consistent hash ring
+
+        Every node is placed at replicas points of the ring, a key belongs to the first node found clockwise from the hash of the key,
+        so adding or removing a node only moves the keys of that node.
+
+        Args:\n
+            nodes (iterable, optional): Names of the nodes. Defaults to ().
+            replicas (int, optional): Points of the ring per node, more points spread the keys more evenly. Defaults to 100.
+        """
+        self.replicas = replicas
+        self._points = []  # Sorted hashes of the points
+        self._nodes = {}  # point hash -> node
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(key):
+        """Hash a key onto the ring.
+
+        Args:\n
+            key (str): The key.
+
+        Returns:\n
+            int: Position of the key, stable across processes and restarts.
+        """
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    @property
+    def nodes(self):
+        """set: Names of the nodes in the ring."""
+        return set(self._nodes.values())
+
+    def add(self, node):
+        """Add a node to the ring.
+
+        Args:\n
+            node (str): Name of the node.
+        """
+        for num in range(self.replicas):
+            point = self.hash(f"{node}#{num}")
+            if point not in self._nodes:
+                bisect.insort(self._points, point)
+            self._nodes[point] = node
+
+    def remove(self, node):
+        """Remove a node from the ring.
+
+        Args:\n
+            node (str): Name of the node.
+        """
+        for num in range(self.replicas):
+            point = self.hash(f"{node}#{num}")
+            if self._nodes.get(point) == node:
+                del self._nodes[point]
+                self._points.pop(bisect.bisect_left(self._points, point))
+
+    def node(self, key):
+        """Find the node a key belongs to.
+
+        Args:\n
+            key (str): The key, for instance a personId.
+
+        Returns:\n
+            str: Name of the node, None if the ring is empty.
+        """
+        if not self._points:
+            return None
+        num = bisect.bisect(self._points, self.hash(key)) % len(self._points)
+        return self._nodes[self._points[num]]
+
+
+class Cluster():
+    def __init__(self, workers, host="localhost", port=8080, restart_delay=1.0):
+        """Pre-forking supervisor of the bot processes
+
+        Opens the listening socket once and forks the worker processes, which all accept connections on that socket,
+        so the kernel spreads the webhook requests among them. A worker that exits is started again under the same number.
+        Needs os.fork, so it only runs on POSIX systems.
+
+        Args:\n
+            workers (int): Number of worker processes.
+            host (str, optional): Address to listen on. Defaults to "localhost".
+            port (int, optional): Port to listen on. Defaults to 8080.
+            restart_delay (float, optional): Seconds to wait before starting a worker that exited again. Defaults to 1.0.
+        """
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.restart_delay = restart_delay
+        self.children = {}  # pid -> worker number
+        self.stopping = False
+        self.sock = None
+
+    def run(self, target):
+        """Start the workers and supervise them until SIGTERM or SIGINT.
+
+        Args:\n
+            target (callable): Runs in each worker as target(number, sock), the worker exits when it returns.
+
+        Raises:\n
+            SystemExit: When the system can not fork.
+        """
+        if not hasattr(os, "fork"):
+            raise SystemExit("Running several workers needs a POSIX system, set HERMES_WORKERS=1")
+        self.sock = socket.create_server((self.host, self.port), backlog=128)
+        self.sock.setblocking(False)  # Every worker is woken by a new connection, the ones that lose the race to accept it go back to waiting
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for number in range(self.workers):
+            self.spawn(target, number)
+        print(f"Started {self.workers} workers on {self.host}:{self.port}")
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            number = self.children.pop(pid, None)
+            if number is None or self.stopping:
+                continue
+            print(f"Worker {number} (pid {pid}) exited with status {status}, starting it again")
+            time.sleep(self.restart_delay)
+            self.spawn(target, number)
+        self.sock.close()
+
+    def spawn(self, target, number):
+        """Fork a worker.
+
+        Args:\n
+            target (callable): Runs in the worker as target(number, sock).
+            number (int): Number of the worker.
+        """
+        pid = os.fork()
+        if pid:
+            self.children[pid] = number
+            return
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        code = 0
+        try:
+            target(number, self.sock)
+        except (SystemExit, KeyboardInterrupt) as e:
+            code = e.code if isinstance(e, SystemExit) and isinstance(e.code, int) else 0
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            os._exit(code)
+
+    def stop(self, *_):
+        """Stop every worker, used as the SIGTERM and SIGINT handler."""
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,489 @@
+"""Message delivery for Hermes
+
+    Sends messages to many users at once without blocking the webhook handlers or the scheduler,
+    while keeping under the Webex rate limits.
+"""
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def retry_after(error):
+    """Find how long to wait before retrying a rate limited request.
+
+    Args:\n
+        error (Exception): Error raised while sending the request.
+
+    Returns:\n
+        float: Seconds to wait, None if the error was not caused by the rate limit.
+    """
+    if getattr(error, "retry_after", None) is not None:
+        return float(error.retry_after)
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        return float(response.headers.get("Retry-After", 15))
+    return None
+
+
+MAX_MESSAGE_BYTES = 7439  # Largest text or markdown accepted by the messages API
+
+
+def mention(personId, name):
+    """Build the markdown mention of a user.
+
+    Args:\n
+        personId (str): Unique identifier of the user.
+        name (str): Name shown in the mention.
+
+    Returns:\n
+        str: The mention.
+    """
+    return f"<@personId:{personId}|{name}>"
+
+
+def chunk_mentions(header, mentions, limit=MAX_MESSAGE_BYTES):
+    """Split a list of mentions into as few messages as possible.
+
+    Every message starts with the header and stays under the message size limit.
+
+    Args:\n
+        header (str): Text at the start of every message.
+        mentions (list): List of mentions, see mention.
+        limit (int, optional): Maximum size of a message in bytes. Defaults to MAX_MESSAGE_BYTES.
+
+    Returns:\n
+        list: List of markdown messages.
+    """
+    messages = []
+    current, size = [], len(header.encode())
+    for item in mentions:
+        item_size = len(item.encode()) + 2  # Separator included
+        if current and size + item_size > limit:
+            messages.append(header + ", ".join(current))
+            current, size = [], len(header.encode())
+        current.append(item)
+        size += item_size
+    if current:
+        messages.append(header + ", ".join(current))
+    return messages
+
+
+def is_transient(error):
+    """Check if a failed request is worth retrying.
+
+    Args:\n
+        error (Exception): Error raised while sending the request.
+
+    Returns:\n
+        bool: True for server errors and connection problems, False for any other client error.
+    """
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    return status is None or status >= 500
+
+
+class TokenBucket():
+    def __init__(self, rate, capacity=None):
+        """Token bucket rate limiter
+
+        Allows up to capacity calls at once, refilling at rate calls per second.
+        The bucket can be paused, for instance when the API answers with a Retry-After header.
+
+        Args:\n
+            rate (float): Calls allowed per second.
+            capacity (int, optional): Maximum burst of calls. Defaults to rate.
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a call is allowed."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop handing out calls for a while.
+
+        Args:\n
+            seconds (float): Seconds to wait before allowing new calls.
+        """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class BroadcastJob():
+    def __init__(self, recipients, message, on_done=None):
+        """Progress of a message sent to a list of users
+
+        Args:\n
+            recipients (list): List of personIds to send the message to.
+            message (str): Message to send.
+            on_done (callable, optional): Called with the job once every recipient has been handled. Defaults to None.
+        """
+        self.id = uuid.uuid4().hex[:8]
+        self.recipients = list(recipients)
+        self.message = message
+        self.on_done = on_done
+        self.results = {}  # personId -> "delivered" or the error that made the delivery fail
+        self.started = time.monotonic()
+        self.elapsed = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def total(self):
+        return len(self.recipients)
+
+    @property
+    def delivered(self):
+        return sum(1 for result in list(self.results.values()) if result == "delivered")
+
+    @property
+    def failed(self):
+        return len(self.results) - self.delivered
+
+    def record(self, personId, result):
+        """Record the result of a delivery.
+
+        Args:\n
+            personId (str): Unique identifier of the recipient.
+            result (str): "delivered" or the reason the delivery failed.
+        """
+        with self._lock:
+            self.results[personId] = result
+            finished = len(self.results) >= self.total and not self.done.is_set()
+            if finished:
+                self.elapsed = time.monotonic() - self.started
+                self.done.set()
+        if finished and self.on_done:
+            self.on_done(self)
+
+    def summary(self):
+        """Describe the state of the job.
+
+        Returns:\n
+            str: Delivered and failed counts.
+        """
+        if self.done.is_set():
+            return f"Broadcast {self.id} finished in {self.elapsed:.1f}s: {self.delivered} delivered, {self.failed} failed."
+        return f"Broadcast {self.id} in progress: {len(self.results)} of {self.total} handled."
+
+
+class Broadcaster():
+    def __init__(self, send, workers=8, rate=5, burst=10, max_retries=3, history=100):
+        """Concurrent, rate limited delivery engine
+
+        Sends a message to every recipient from a bounded pool of workers sharing a token bucket.
+        Rate limited requests pause the whole bucket for the Retry-After period before being retried,
+        server errors are retried with exponential backoff, and the result for every recipient is kept in the job.
+
+        Args:\n
+            send (callable): Called as send(personId, message) to deliver a single message.
+            workers (int, optional): Number of concurrent deliveries. Defaults to 8.
+            rate (float, optional): Messages per second. Defaults to 5.
+            burst (int, optional): Maximum burst of messages. Defaults to 10.
+            max_retries (int, optional): Attempts after the first one before giving up on a recipient. Defaults to 3.
+            history (int, optional): Number of finished jobs kept to be looked up. Defaults to 100.
+        """
+        self.send = send
+        self.max_retries = max_retries
+        self.history = history
+        self.bucket = TokenBucket(rate, burst)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hermes-broadcast")
+        self.jobs = OrderedDict()
+
+    def submit(self, recipients, message, on_done=None):
+        """Start sending a message to a list of users.
+
+        Args:\n
+            recipients (list): List of personIds to send the message to.
+            message (str): Message to send.
+            on_done (callable, optional): Called with the job once every recipient has been handled. Defaults to None.
+
+        Returns:\n
+            BroadcastJob: Handle to follow the delivery.
+        """
+        job = BroadcastJob(recipients, message, on_done)
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.history:
+            self.jobs.popitem(last=False)
+        if not job.total:
+            job.elapsed = 0.0
+            job.done.set()
+            if on_done:
+                on_done(job)
+        for personId in job.recipients:
+            self.pool.submit(self.deliver, job, personId)
+        return job
+
+    def deliver(self, job, personId):
+        """Send the message of a job to a single recipient.
+
+        Args:\n
+            job (BroadcastJob): The job being delivered.
+            personId (str): Unique identifier of the recipient.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                self.send(personId, job.message)
+                job.record(personId, "delivered")
+                return
+            except Exception as e:
+                wait = retry_after(e)
+                if attempt == self.max_retries or (wait is None and not is_transient(e)):
+                    job.record(personId, f"failed: {e}")
+                    return
+                if wait is not None:
+                    self.bucket.pause(wait)
+                else:
+                    time.sleep(2 ** attempt)
+
+
+class Outbox():
+    schema = """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL UNIQUE,
+            payload TEXT NOT NULL,
+            scheduled_at REAL NOT NULL,
+            next_attempt REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            delivered_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt);
+    """
+
+    def __init__(self, dbpath, recover=True):
+        """Persistent queue of messages waiting to be sent
+
+        Every message is stored with an idempotency key, so queuing the same reminder twice only sends it once,
+        and stays in the database until it is marked as delivered or failed, so pending messages survive restarts.
+        Messages left in the sending state by a previous run are put back in the queue when the outbox opens.
+        Several processes may share the outbox, claiming a message is atomic across them.
+
+        Args:\n
+            dbpath (str): String containing the relative or full path to the database file.
+            recover (bool, optional): Put the messages left in the sending state back in the queue,
+                False when other processes sharing the outbox may be sending them. Defaults to True.
+        """
+        self.dbpath = dbpath
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(dbpath, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self.schema)
+        if recover:
+            self.db.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'")
+
+    def put(self, key, payload, scheduled_at=None, delay=0):
+        """Queue a message.
+
+        Args:\n
+            key (str): Idempotency key, a message with an already queued key is ignored.
+            payload (dict or str): Body of the message, either as a dict or already serialized to json.
+            scheduled_at (float, optional): Timestamp the message was meant to be sent at. Defaults to now.
+            delay (float, optional): Seconds to wait before sending the message. Defaults to 0.
+
+        Returns:\n
+            bool: True if the message was queued, False if the key was already queued.
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self.db.execute("INSERT OR IGNORE INTO outbox (key, payload, scheduled_at, next_attempt) VALUES (?, ?, ?, ?)",
+                                     (key, payload if isinstance(payload, str) else json.dumps(payload), scheduled_at or now, now + delay))
+            return cursor.rowcount == 1
+
+    def claim(self, limit):
+        """Take the messages that are due to be sent.
+
+        The claimed messages are moved to the sending state, so they are not claimed twice.
+
+        Args:\n
+            limit (int): Maximum number of messages to claim.
+
+        Returns:\n
+            list: List of (id, payload, attempts, scheduled_at) tuples, the payload is the serialized message body.
+        """
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.db.execute("SELECT id, payload, attempts, scheduled_at FROM outbox WHERE status = 'pending' AND next_attempt <= ? ORDER BY next_attempt LIMIT ?",
+                                       (time.time(), limit)).fetchall()
+                self.db.executemany("UPDATE outbox SET status = 'sending' WHERE id = ?", [(row[0],) for row in rows])
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return [(row[0], row[1], row[2], row[3]) for row in rows]
+
+    def delivered(self, message_id):
+        """Mark a message as delivered.
+
+        Args:\n
+            message_id (int): Id of the message in the outbox.
+        """
+        with self._lock:
+            self.db.execute("UPDATE outbox SET status = 'delivered', delivered_at = ?, attempts = attempts + 1 WHERE id = ?",
+                            (time.time(), message_id))
+
+    def failed(self, message_id, error, retry_in=None):
+        """Record a failed attempt to send a message.
+
+        Args:\n
+            message_id (int): Id of the message in the outbox.
+            error (str): Reason the attempt failed.
+            retry_in (float, optional): Seconds to wait before the next attempt. Defaults to None, giving up on the message.
+        """
+        with self._lock:
+            if retry_in is None:
+                self.db.execute("UPDATE outbox SET status = 'failed', error = ?, attempts = attempts + 1 WHERE id = ?",
+                                (error, message_id))
+            else:
+                self.db.execute("UPDATE outbox SET status = 'pending', error = ?, attempts = attempts + 1, next_attempt = ? WHERE id = ?",
+                                (error, time.time() + retry_in, message_id))
+
+    def purge(self, older_than=7 * 24 * 3600):
+        """Remove delivered and failed messages.
+
+        Args:\n
+            older_than (float, optional): Only remove messages scheduled more than this many seconds ago. Defaults to a week.
+        """
+        with self._lock:
+            self.db.execute("DELETE FROM outbox WHERE status IN ('delivered', 'failed') AND scheduled_at < ?",
+                            (time.time() - older_than,))
+
+    def pending(self):
+        """Count the messages waiting to be sent.
+
+        Returns:\n
+            int: Number of pending messages.
+        """
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM outbox WHERE status IN ('pending', 'sending')").fetchone()[0]
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self.db.close()
+
+
+class OutboxDispatcher():
+    def __init__(self, outbox, send, workers=16, bucket=None, max_attempts=8, base_delay=5, max_delay=900, poll_interval=1.0, on_delivered=None):
+        """Dedicated executor draining the outbox
+
+        A single thread claims due messages while workers are free and hands them to its own pool of workers,
+        so sending never runs on the scheduler threads.
+        Failed messages are retried with exponential backoff, or after the Retry-After period when rate limited.
+
+        Args:\n
+            outbox (Outbox): The outbox to drain.
+            send (callable): Called as send(payload) with the serialized message body to deliver a single message.
+            workers (int, optional): Number of concurrent deliveries. Defaults to 16.
+            bucket (TokenBucket, optional): Rate limiter shared with other senders. Defaults to None.
+            max_attempts (int, optional): Attempts before giving up on a message. Defaults to 8.
+            base_delay (float, optional): Seconds to wait before the first retry, doubled on every attempt. Defaults to 5.
+            max_delay (float, optional): Maximum seconds between attempts. Defaults to 900.
+            poll_interval (float, optional): Seconds between checks for due messages. Defaults to 1.0.
+            on_delivered (callable, optional): Called as on_delivered(scheduled_at, attempts) after a message is delivered. Defaults to None.
+        """
+        self.outbox = outbox
+        self.send = send
+        self.workers = workers
+        self.bucket = bucket
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.on_delivered = on_delivered
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hermes-outbox")
+        self._free = threading.Semaphore(workers)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="hermes-outbox-dispatch", daemon=True)
+
+    def start(self):
+        """Start draining the outbox."""
+        self._thread.start()
+
+    def stop(self):
+        """Stop claiming new messages."""
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        """Check for due messages right away, used after queuing a message."""
+        self._wake.set()
+
+    def _run(self):
+        failures = 0
+        while not self._stop.is_set():
+            self._wake.clear()
+            free = 0
+            while self._free.acquire(blocking=False):
+                free += 1
+            try:
+                claimed = self.outbox.claim(free) if free else []
+            except Exception as e:
+                # A locked or failing database must not stop the deliveries for good, give the workers back and try again later
+                for _ in range(free):
+                    self._free.release()
+                failures += 1
+                backoff = min(self.poll_interval * 2 ** failures, 60)
+                print(f"Claiming messages from the outbox failed: {e!r}, trying again in {backoff:.1f}s")
+                self._stop.wait(backoff)
+                continue
+            failures = 0
+            for _ in range(free - len(claimed)):
+                self._free.release()
+            for message in claimed:
+                self.pool.submit(self.deliver, *message)
+            if len(claimed) < free or not free:
+                self._wake.wait(self.poll_interval)
+
+    def deliver(self, message_id, payload, attempts, scheduled_at):
+        """Send a single message and record the result in the outbox.
+
+        Args:\n
+            message_id (int): Id of the message in the outbox.
+            payload (str): Serialized message body.
+            attempts (int): Attempts made so far.
+            scheduled_at (float): Timestamp the message was meant to be sent at.
+        """
+        try:
+            if self.bucket:
+                self.bucket.acquire()
+            self.send(payload)
+            self.outbox.delivered(message_id)
+            if self.on_delivered:
+                self.on_delivered(scheduled_at, attempts)
+        except Exception as e:
+            wait = retry_after(e)
+            if wait is not None and self.bucket:
+                self.bucket.pause(wait)
+            if attempts + 1 >= self.max_attempts or (wait is None and not is_transient(e)):
+                print(f"Giving up on message {message_id}: {e}")
+                self.outbox.failed(message_id, str(e))
+            else:
+                delay = wait if wait is not None else min(self.max_delay, self.base_delay * 2 ** attempts)
+                self.outbox.failed(message_id, str(e), retry_in=delay)
+        finally:
+            self._free.release()
+            self._wake.set()
@@ -7,18 +7,44 @@
 """
 # Prod Imports
 import os
-import json
+import time
+import logging
 import datetime
-import requests
+import functools
+import threading
+import tempfile
+import traceback
 import webexteamsbot
+from urllib.parse import urlparse
 from webexteamssdk import WebexTeamsAPI
 from apscheduler.schedulers.background import BackgroundScheduler as Scheduler
-
-# Dev imports
-import dotenv
-from pyngrok import ngrok
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.events import EVENT_JOB_SUBMITTED
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import make_server
+from flask import request
+from store import UserStore, SQLiteUserStore, Subscriber
+from shifts import Shift, hour_range, due_time, utc_offset, slot_start, transitions, DEFAULT_TIMEZONE
+from delivery import Broadcaster, Outbox, OutboxDispatcher, mention, chunk_mentions
+from people import PeopleCache
+from rest import RestClient
+from workqueue import WorkQueue
+from templates import CardRegistry
+from timingwheel import TimingWheel
+from catchup import CatchUp
+from cluster import Cluster, HashRing, LeaderElection
+from metrics import REGISTRY, merge, timed
 from pprint import pprint
 
+log = logging.getLogger("hermes")
+
+REMINDER_LAG = REGISTRY.histogram("hermes_reminder_lag_seconds", "Time between the slot a message was due in and its delivery",
+                                  buckets=(0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600))
+COMMAND_SECONDS = REGISTRY.histogram("hermes_command_seconds", "Time taken by the bot commands", labels=("command",))
+COMMAND_ERRORS = REGISTRY.counter("hermes_command_errors_total", "Bot commands that failed", labels=("command",))
+WEBEX_REQUESTS = REGISTRY.counter("hermes_webex_requests_total", "Requests made to the Webex API", labels=("method", "endpoint", "status"))
+WEBEX_SECONDS = REGISTRY.histogram("hermes_webex_request_seconds", "Latency of the Webex API requests", labels=("method", "endpoint"))
+
 
 class Hermess():
     def __init__(self):
@@ -28,24 +54,27 @@ class Hermess():
 
         Usage:
             Just run the hermes.py to start the bot locally, then look for it on Webex Teams, either with the name: HermessRCSS or with the full name: hermesrcss@webex.bot\n
-            After that, send the '/subscribe' command to set up the notification times.
+            After that, send the '/subscribe' command to set up the notification times.\n
+            The users store and the schedule are loaded in the background while the HTTP tunnel and the webhooks are set up,
+            webhooks are accepted as soon as the users store is loaded, even if the schedule is still being built.\n
+            Setting HERMES_WORKERS above 1 runs that many worker processes sharing the webhook port and the SQLite stores, see run_cluster.
         """
+        self.started = time.perf_counter()
         self.clear_screen()
-        self.current_user = None  # Define current interacting user
-        self.filepath = "peopletonotify.json"  # Define where to find the users file
-        self.baseurl = "https://api.ciscospark.com/v1"  # API vars
         # Retrieve required details from environment variables
-        dotenv.load_dotenv()
-        # Open a HTTP tunnel on the default port 8080
-        self.start_local_server()
-        # Get enviroment details
-        self.bot_email = os.getenv("TEAMS_BOT_EMAIL")
-        self.teams_token = os.getenv("TEAMS_BOT_TOKEN")
-        self.bot_app_name = os.getenv("TEAMS_BOT_APP_NAME")
-        self.api = WebexTeamsAPI(access_token=self.teams_token)  # Start API
+        self.load_env()
+        self.configure()
+        self.api = self.webex_api()  # Start API
+        if self.workers == 1:
+            # Load the users and the schedule while the tunnel and the webhooks are set up
+            self.start_services()
+        # Open a HTTP tunnel on the webhook port
+        if not self.bot_url:
+            self.start_local_server()
         # Create the Bot Object
         self.bot = webexteamsbot.TeamsBot(self.bot_app_name,
                                           teams_bot_token=self.teams_token,
+                                          teams_api_url=self.api_url and f"{self.baseurl}/",
                                           teams_bot_url=self.bot_url,
                                           teams_bot_email=self.bot_email,
                                           webhook_resource_event=[{"resource": "messages",
@@ -53,14 +82,60 @@ class Hermess():
                                                                   {"resource": "attachmentActions",
                                                                    "event": "created"}])  # Handles Adaptive cards
         self.bot.set_help_message("Hello, my name is Hermes! You can use the following commands:\n")
+        self.instrument(self.bot.teams)
         self.add_commands()
-        self.init_users_file()
-        # Create the scheduler
-        self.sched = Scheduler({'apscheduler.timezone': 'America/Costa_Rica'})
-        self.sched.remove_all_jobs()
-        self.sched.start()  # Start the scheduler
-        self.schedule_subscriptions()
-        self.bot.run(host="localhost", port=8080)  # Run Bot
+        self.add_metrics()
+        if self.workers > 1:
+            self.run_cluster()
+            return
+        self.users_loaded.result()
+        print(f"Accepting webhooks {time.perf_counter() - self.started:.2f}s after start")
+        self.bot.run(host=self.host, port=self.port)  # Run Bot
+
+    def configure(self):
+        """Read the settings from the environment variables.
+
+        Kept apart from __init__ so a bot can be set up without being run, as tools/benchmark.py does.
+
+        Raises:\n
+            SystemExit: When several workers are asked for without the sqlite store.
+        """
+        self._local = threading.local()  # Holds the current user of each thread
+        self.current_user = None  # Define current interacting user
+        self.filepath = "peopletonotify.json"  # Define where to find the users file
+        self.flush_interval = float(os.getenv("HERMES_FLUSH_INTERVAL", 2))  # Seconds between users file writes
+        self.store_backend = os.getenv("HERMES_STORE", "json")  # Either "json" or "sqlite"
+        self.dbpath = os.getenv("HERMES_DB_PATH", "hermes.db")  # Database used by the sqlite store
+        self.schedule_mode = os.getenv("HERMES_SCHEDULE_MODE", "slot")  # Either one job per time "slot" or, much slower to build for large rosters, per "user" ping
+        self.misfire_grace = int(os.getenv("HERMES_MISFIRE_GRACE", 60))  # Seconds a late job may still run, older runs are left to the catch-up
+        self.catchup_policy = os.getenv("HERMES_CATCHUP", "summary")  # Either "summary", one message per user for the reminders missed during an outage, or "off"
+        self.heartbeat_path = os.getenv("HERMES_HEARTBEAT_PATH", "heartbeat")  # Last time the bot was alive, to find the outages
+        self.cache_path = os.getenv("HERMES_CACHE_PATH", "schedule.cache")  # Slot index saved on exit to skip rebuilding it on the next start
+        self.outbox_path = os.getenv("HERMES_OUTBOX_PATH", "outbox.db")  # Database holding the scheduled reminders until they are sent
+        self.default_tz = os.getenv("HERMES_DEFAULT_TZ", DEFAULT_TIMEZONE)  # Timezone preselected on the subscription card and used for the daily reminders
+        self.dst_weeks = int(os.getenv("HERMES_DST_WEEKS", 8))  # Weeks ahead the UTC offset changes of the users' timezones are looked up
+        self.team_room = os.getenv("HERMES_TEAM_ROOM")  # roomId of the space the users choosing "room" delivery are reminded in
+        self.clean_workers = int(os.getenv("HERMES_CLEAN_WORKERS", 4))  # Concurrent deletions made by /clean
+        self.workers = int(os.getenv("HERMES_WORKERS", 1))  # Worker processes sharing the webhooks and the reminders, more than 1 needs the sqlite store
+        self.lock_path = os.getenv("HERMES_LOCK_PATH", "hermes.lock")  # File locked by the leader worker
+        self.host = os.getenv("HERMES_HOST", "localhost")  # Address the webhook server listens on
+        self.port = int(os.getenv("HERMES_PORT", 8080))  # Port the webhook server listens on
+        self.metrics_dir = os.getenv("HERMES_METRICS_DIR", "hermes-metrics")  # Folder the workers write their metrics to, so the worker answering a scrape can serve them all
+        self.metrics_interval = float(os.getenv("HERMES_METRICS_INTERVAL", 5))  # Seconds between the updates of each worker's metrics file
+        self.ring = None  # Consistent hash ring of the workers, None when running a single process
+        self.node = None  # Name of this worker in the ring
+        self.leading = True  # Whether this process runs the jobs that must run only once, see lead
+        self.last_tick = None  # Last minute pinged by the cluster mode ticker, in minutes since the epoch
+        self.me = None  # Person of the bot account, looked up on first use
+        self.api_url = os.getenv("HERMES_API_URL")  # Base url of the Webex API, to run the bot against a fake endpoint
+        self.baseurl = (self.api_url or "https://api.ciscospark.com/v1").rstrip("/")  # API vars
+        if self.workers > 1 and self.store_backend != "sqlite":
+            raise SystemExit("HERMES_WORKERS > 1 needs HERMES_STORE=sqlite, the users file can not be shared between processes")
+        # Get enviroment details
+        self.bot_email = os.getenv("TEAMS_BOT_EMAIL")
+        self.teams_token = os.getenv("TEAMS_BOT_TOKEN")
+        self.bot_app_name = os.getenv("TEAMS_BOT_APP_NAME")
+        self.bot_url = os.getenv("HERMES_BOT_URL")  # Public url of the bot, a HTTP tunnel is opened when missing
 
     def clear_screen(self):
         """Function to clear the screen
@@ -70,6 +145,14 @@ class Hermess():
         """
         os.system("cls" if os.name == "nt" else "clear")
 
+    def load_env(self):
+        """Load the environment variables from the .env file, when python-dotenv is installed."""
+        try:
+            import dotenv
+        except ImportError:
+            return
+        dotenv.load_dotenv()
+
     def start_local_server(self):
         """Start a local Ngrok webhook for the bot
 
@@ -78,8 +161,9 @@ class Hermess():
         Raises:\n
             SystemExit: When it finds a previous Ngrook service running.
         """
+        from pyngrok import ngrok  # Only needed to run the bot locally
         try:
-            self.bot_url = ngrok.connect(port=8080, proto="http")
+            self.bot_url = ngrok.connect(port=self.port, proto="http")
             print(self.bot_url)
         except Exception:
             self.clear_screen()
@@ -87,37 +171,268 @@ class Hermess():
             input("Press enter to exit.\n")
             raise SystemExit
 
+    def webex_api(self, **kwargs):
+        """Create a Webex API instance, pointed at HERMES_API_URL when it is set.
+
+        Args:\n
+            **kwargs: Keyword arguments for WebexTeamsAPI.
+
+        Returns:\n
+            WebexTeamsAPI: The API instance.
+        """
+        if self.api_url:
+            kwargs["base_url"] = f"{self.baseurl}/"
+        return self.instrument(WebexTeamsAPI(access_token=self.teams_token, **kwargs))
+
+    def instrument(self, api):
+        """Record the requests made by a Webex API instance in the metrics.
+
+        Args:\n
+            api (WebexTeamsAPI): The API instance.
+
+        Returns:\n
+            WebexTeamsAPI: The same API instance.
+        """
+        api._session._req_session.hooks["response"].append(self.record_response)  # The SDK has no hooks of its own
+        return api
+
+    def start_services(self):
+        """Start the components running background threads and load the users and the schedule in the background.
+
+        In cluster mode every worker starts its own after it is forked, as threads do not survive a fork.
+        """
+        self.rest = RestClient(self.baseurl, self.teams_token,
+                               timeout=(float(os.getenv("HERMES_CONNECT_TIMEOUT", 3.05)),
+                                        float(os.getenv("HERMES_READ_TIMEOUT", 15))))  # Shared session for raw REST calls
+        self.rest.add_hook(self.record_request)
+        self.people = PeopleCache(self.api,
+                                  ttl=float(os.getenv("HERMES_PEOPLE_TTL", 3600)),
+                                  maxsize=int(os.getenv("HERMES_PEOPLE_CACHE_SIZE", 5000)))  # Cached people lookups
+        self.cards = CardRegistry({"subscription": "subscription.json",
+                                   "notification": "notification.json"},
+                                  check_interval=float(os.getenv("HERMES_CARD_CHECK_INTERVAL", 1)))  # Adaptive cards, reloaded when their files change
+        self.start_delivery()
+        self.snoozes = TimingWheel(tick=float(os.getenv("HERMES_SNOOZE_TICK", 60)))  # Pending snoozed reminders
+        self.work = WorkQueue(workers=int(os.getenv("HERMES_WEBHOOK_WORKERS", 4)),
+                              maxsize=int(os.getenv("HERMES_WEBHOOK_QUEUE", 1000)))  # Processes the webhooks off the request thread
+        startup = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hermes-startup")
+        self.users_loaded = startup.submit(self.init_users_file)
+        self.schedule_ready = startup.submit(self.load_schedule)
+        self.schedule_ready.add_done_callback(self.log_startup_error)
+        startup.shutdown(wait=False)
+
+    def log_startup_error(self, task):
+        """Log a startup task that failed, the bot keeps accepting webhooks so it would otherwise go unnoticed.
+
+        Args:\n
+            task (Future): The finished startup task.
+        """
+        error = task.exception()
+        if error:
+            print(f"Loading the schedule failed, no reminders will be sent: {error!r}")
+            traceback.print_exception(type(error), error, error.__traceback__)
+
+    # --------- Metrics --------- #
+    def add_metrics(self):
+        """Add the /metrics route to the bot and the gauges read on every scrape.
+
+        The route serves every metric in the Prometheus text format.
+        In cluster mode each scrape is answered by one of the workers, which serves the series of every worker labelled with the worker name, see serve_metrics.
+        """
+        self.bot.add_url_rule("/metrics", "metrics", self.serve_metrics)
+        REGISTRY.gauge("hermes_subscribers", "Users in the users store", fn=lambda: len(self.store))
+        REGISTRY.gauge("hermes_scheduler_jobs", "Jobs in the scheduler's job store", fn=lambda: len(self.sched.get_jobs()))
+        REGISTRY.gauge("hermes_outbox_pending", "Messages waiting in the outbox", fn=lambda: self.outbox.pending())
+        REGISTRY.gauge("hermes_snoozes_pending", "Snoozed reminders waiting", fn=lambda: len(self.snoozes))
+        REGISTRY.gauge("hermes_webhook_queue", "Webhooks waiting for a worker thread", fn=lambda: self.work.queue.qsize())
+
+    def serve_metrics(self):
+        """Serve the metrics.
+
+        In cluster mode the metrics files of every worker in HERMES_METRICS_DIR are combined,
+        so every scrape gets the series of all the workers whichever worker answers it.
+
+        Returns:\n
+            tuple: The Flask response.
+        """
+        if not self.node:
+            return REGISTRY.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        self.write_metrics()
+        texts = []
+        for num in range(self.workers):
+            try:
+                with open(self.metrics_path(f"worker-{num}")) as file:
+                    texts.append(file.read())
+            except OSError:
+                continue  # Worker still starting
+        return merge(texts), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+    def metrics_path(self, node):
+        """Get the path of the metrics file of a worker.
+
+        Args:\n
+            node (str): Name of the worker.
+
+        Returns:\n
+            str: Path of the file in HERMES_METRICS_DIR.
+        """
+        return os.path.join(self.metrics_dir, f"{node}.prom")
+
+    def write_metrics(self):
+        """Write the metrics of this worker to its file, replacing it at once so a scrape never reads half of it."""
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{self.node}-", suffix=".tmp", dir=self.metrics_dir)
+        with os.fdopen(fd, "w") as file:
+            file.write(REGISTRY.render({"worker": self.node}))
+        os.replace(tmp_path, self.metrics_path(self.node))
+
+    def publish_metrics(self):
+        """Keep the metrics file of this worker up to date every HERMES_METRICS_INTERVAL seconds, runs in its own thread."""
+        while True:
+            try:
+                self.write_metrics()
+            except Exception as e:
+                print(f"Writing the metrics of {self.node} failed: {e!r}")
+            time.sleep(self.metrics_interval)
+
+    def record_request(self, method, endpoint, status, seconds):
+        """Record a request to the Webex API.
+
+        Args:\n
+            method (str): HTTP method.
+            endpoint (str): Endpoint of the request, without ids.
+            status (int): HTTP status, None when the request failed to complete.
+            seconds (float): Time taken by the request.
+        """
+        WEBEX_REQUESTS.inc(method=method, endpoint=endpoint, status=status or "error")
+        WEBEX_SECONDS.observe(seconds, method=method, endpoint=endpoint)
+
+    def record_response(self, response, *args, **kwargs):
+        """Response hook of the SDK sessions, see record_request.
+
+        Args:\n
+            response (Response): The API response.
+        """
+        path = urlparse(response.request.url).path
+        prefix = urlparse(self.baseurl).path
+        if path.startswith(prefix):
+            path = path[len(prefix):]
+        self.record_request(response.request.method, RestClient.endpoint(path), response.status_code, response.elapsed.total_seconds())
+
+    def record_delivery(self, scheduled_at, attempts):
+        """Record the lag of a message delivered by the outbox.
+
+        Args:\n
+            scheduled_at (float): Timestamp the message was due at.
+            attempts (int): Failed attempts before it was delivered.
+        """
+        REMINDER_LAG.observe(time.time() - scheduled_at)
+
+    # --------- Cluster --------- #
+    def run_cluster(self):
+        """Run HERMES_WORKERS worker processes and supervise them.
+
+        The webhooks are registered once, then every worker is forked with its own connections and threads.
+        The workers accept the webhooks on a shared socket, so the kernel balances them,
+        and share the SQLite users store and outbox. Every minute each worker queues the reminders of its own share of the due users,
+        the users being split among the workers by consistent hashing of their personId, see tick.
+        The outbox keys make sure a reminder is queued once even if two workers both think they own the user.
+        The jobs that must run in a single process, like the catch-up and the timezone changes, run on the leader,
+        elected with a lock on HERMES_LOCK_PATH, see lead. When the leader dies the lock is released and another worker takes over.
+        Snoozes stay in the worker that received the snooze.
+        """
+        # Migrate the database and requeue the messages of the previous run once, before any worker opens them
+        SQLiteUserStore(self.dbpath, json_path=self.filepath).close()
+        Outbox(self.outbox_path).close()
+        Cluster(self.workers, host=self.host, port=self.port).run(self.serve_worker)
+
+    def serve_worker(self, number, sock):
+        """Run a worker process of the cluster.
+
+        Args:\n
+            number (int): Number of the worker.
+            sock (socket): Listening socket shared by the workers.
+        """
+        self.node = f"worker-{number}"
+        self.ring = HashRing(f"worker-{num}" for num in range(self.workers))
+        self.leading = False
+        # Connections opened before the fork are shared with the parent, open new ones
+        self.api = self.webex_api()
+        self.bot.teams = self.webex_api()
+        self.start_services()
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        threading.Thread(target=self.publish_metrics, name="hermes-metrics", daemon=True).start()
+        self.users_loaded.result()
+        print(f"Worker {number} (pid {os.getpid()}) accepting webhooks {time.perf_counter() - self.started:.2f}s after start")
+        server = make_server(self.host, self.port, self.bot, threaded=True, fd=sock.fileno())
+        try:
+            server.serve_forever()
+        finally:
+            self.dispatcher.stop()
+            self.store.close()
+
+    def owns(self, personId):
+        """Check if the reminders of a user are sent by this process.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+
+        Returns:\n
+            bool: True when running a single process or when the user hashes to this worker.
+        """
+        return self.ring is None or self.ring.node(personId) == self.node
+
+    def lead(self):
+        """Take over the jobs that must run in a single process of the cluster.
+
+        Called once by the leader election when this worker becomes the leader.
+        """
+        self.schedule_ready.result()
+        self.leading = True
+        print(f"{self.node} (pid {os.getpid()}) is the leader")
+        self.schedule_unsubscribed()
+        self.start_maintenance()
+
     # --------- File Management --------- #
 
     def init_users_file(self):
-        """Discover if the users file is present.
+        """Load the users file into the users store.
 
-        Attemps to find a preexisting user file, if none is found then it creates a new user file.
+        The users file is read once, any changes are kept in memory and written back in the background by the store.
+        If no users file is found the store creates a new one on the first write.
+        When HERMES_STORE is set to "sqlite" the users are kept in a SQLite database instead,
+        the users file is imported into it the first time the database is created.
+        The slot index of the users file is cached in HERMES_CACHE_PATH, the sqlite store keeps it in the database.
         """
-        try:
-            with open(self.filepath) as _:
-                print("Users file found!")
-        except FileNotFoundError:
-            print("No users file found, creating a new one..")
-            with open(self.filepath, "w+") as _:
-                print("File created!")
+        if self.store_backend == "sqlite":
+            self.store = SQLiteUserStore(self.dbpath, json_path=self.filepath)
+        else:
+            self.store = UserStore(self.filepath, flush_interval=self.flush_interval, cache_path=self.cache_path)
 
+    @timed
     def write_to_file(self, data, filepath=None):
-        """Write data to a file
+        """Replace the users data
 
-        Simple function to write string data to a file in Json format.
+        Replaces the data held by the users store, the store then writes it to the users file in Json format.
 
         Args:\n
-            data (str): A string containing the data to be written to a file
-            filepath (str, optional): String containing the relative or full path to the file the data is going to be written to. Defaults to self.filepath.
+            data (dict): A dict containing the users data to be written to the users file
+            filepath (str, optional): Unused, kept for compatibility. The store always writes to self.filepath.
         """
-        with open(self.filepath, "w+") as file:
-            json.dump(data, file, sort_keys=True, indent=4, separators=(",", ": "))
+        self.store.replace(data)
+
+    @property
+    def current_user(self):
+        """Person: The user interacting with the bot, kept per thread as commands run concurrently on the work queue."""
+        return getattr(self._local, "current_user", None)
+
+    @current_user.setter
+    def current_user(self, person):
+        self._local.current_user = person
 
     def get_user_info(self, incoming_msg):
         """Sets the curren_user global variable using id of the incomming message.
 
-        Uses the personId from the incomming message to gather the user data by making an API call,
+        Uses the personId from the incomming message to gather the user data from the people cache, which only makes an API call on a miss,
         then it sets the global current_user variable.
         Should be called before any actions that require the current_user variable to ensure it is populated.
 
@@ -128,29 +443,12 @@ class Hermess():
             current_user (str): A string containing all the user data gathered.
         """
         personId = incoming_msg.personId
-        self.current_user = self.api.people.get(personId)
+        self.current_user = self.people.get(personId)
         return str(self.current_user)
 
-    def check_user_file(self):
-        """Check if the user file exist
-
-        Sanity check to see if the users file already exists.
-        If there is no users file then it proceeds to create it.
-        """
-        try:
-            with open(self.filepath, "r+") as file:
-                json.load(file)
-        except FileNotFoundError:
-            print("The file has not been initialized",
-                  "initializing ...",
-                  sep="\n")
-            self.write_to_file({"users": {self.current_user.id: self.current_user.to_dict()}})
-            print("done")
-        except json.JSONDecodeError:
-            return {}
-
+    @timed
     def load_users(self, file=False):
-        """Loads the user data in the user file.
+        """Loads the user data in the users store.
 
         Returns the user data as a list of personId by default or the whole user data block if the file option is set to true.
 
@@ -158,20 +456,11 @@ class Hermess():
             file (bool, optional): If True, it returns the file data instead of just the personId list. Defaults to False.
 
         Returns:\n
-            str: String containing either a list of personIds or the whole user data set.
+            list or dict: Either a list of personIds or the whole user data set.
         """
-        self.check_user_file()
-        id_list = []
-        try:
-            with open(self.filepath, "r") as file:
-                data = json.load(file)
-            id_list.append(list(data["users"]))
-            if file:
-                return data
-            else:
-                return id_list
-        except json.JSONDecodeError:
-            return {}
+        if file:
+            return self.store.data
+        return self.store.ids()
 
     def user_in_file(self):
         """Check if the current user is in the users data file
@@ -181,8 +470,7 @@ class Hermess():
         Returns:\n
             bool: True if the current user is in the user data file, False if not.
         """
-        stored_users = self.load_users()
-        return True if self.current_user.id in stored_users["users"] else False
+        return self.current_user.id in self.store
 
     def update_file(self, user=None, data=None, remove=False):
         r"""Update the users file with new data
@@ -190,6 +478,8 @@ class Hermess():
         Allows to add or remove a user from the users file.
         By default it uses the global current_user to check if the user is in the users file and adds it if not.
         If a custom data set is to be added a personId must be passed to the user arg, as well as a data dict, if either are missing it will not update.
+        Users are stored as compact Subscriber records, the data dict holds the subscription card inputs which are normalized into a Shift
+        and the delivery chosen by the user.
 
         Usage:
             To add the current user:
@@ -198,65 +488,54 @@ class Hermess():
             To remove the current user:
                 update_file(remove=True)
 
-            To add custom data to a user:
+            To set the shift of a user:
                 update_file(user=personId, data=dict)
 
         Args:\n
             user (personId, optional): A string containig the personId to change/add. Defaults to None.
-            data (str, optional): A string containing the data to add to the user. Defaults to None.
+            data (dict, optional): The subscription card inputs of the user. Defaults to None.
             remove (bool, optional): If true removes the current user from the users data file. Defaults to False.
 
         Returns:\n
             str: A string informing of the action taken, either updated, created or removed.
         """
         if user and data:
-            stored_users = self.load_users(file=True)
-            if ("users" in stored_users) and (stored_users["users"]):
-                # Check if user in stored users
-                if user in stored_users["users"]:
-                    stored_users["users"][user]["subscription"] = data
-                else:
-                    raise ValueError("User not found")
+            shift = Shift.from_inputs(data)
+            delivery = "room" if data.get("delivery") == "room" else None
+            if user in self.store:
+                self.store.update(user, shift=shift, delivery=delivery)
             else:
-                stored_users = {"users": {user: data}}
-            self.write_to_file(stored_users)
+                self.store.set(user, Subscriber.from_person(self.people.get(user), shift=shift, delivery=delivery))
             return "Updated"
         elif remove:
-            if self.user_in_file():
-                stored_users = self.load_users(file=True)
-                stored_users["users"].pop(self.current_user.id)
+            if self.store.remove(self.current_user.id) is not None:
                 name = self.current_user.displayName
                 email = self.current_user.emails[0]
-                self.write_to_file(stored_users)
                 return f"I have removed you {name} - {email}"
             else:
                 return "You were not subscribed ..."
         elif self.user_in_file():
             return "User already in file"
         else:
-            stored_users = self.load_users(file=True)
-            stored_users["users"][self.current_user.id] = self.current_user
-            self.write_to_file(stored_users)
+            self.store.set(self.current_user.id, Subscriber.from_person(self.current_user))
             user = self.current_user.displayName
             return f"I've added you, {user}"
 
     # --------- Adaptive Card --------- #
     def card_subscription(self):
-        """Load the Adaptive Card file
+        """Get the subscription Adaptive Card
 
-        Loads the json file describing the adaptive card used for the user to enter the work schedule
+        The card used for the user to enter the work schedule is loaded once by the card registry and reloaded when its file changes.
 
         Returns:\n
-            JSON: Json string containing the Adaptive info.
+            dict: The card content.
         """
-        with open("subscription.json") as file:
-            card_json = json.load(file)
-        return card_json
+        return self.cards.card("subscription")
 
     def subscription_card(self, personId):
         """Sends the subscription card to a specified user.
 
-        Gathers the current subscription card from file and sends it to a specified user.
+        Gathers the current subscription card and sends it to a specified user, prefilled with the user's current shift.
 
         Args:
             personId (str): String containing the unique id for the recipient of the subscription card.
@@ -266,9 +545,11 @@ class Hermess():
         """
         user = personId
         txt = "If you are seeing this message you might be using teams in a web browser or an older version of the app, please switch to the desktop/mobile app or update your desktop/mobile app to subscribe. You can get the latest version here:\n\nhttps://www.webex.com/downloads\n\n If you are still having problems after this, please ping the developer:\n\njoseeroj@cisco.com"
-        card = self.card_subscription()
-        attachment = {'contentType': 'application/vnd.microsoft.card.adaptive',
-                      'content': card}
+        record = self.store.get(user)
+        inputs = record.shift.to_inputs() if record and record.shift else {f"day{day}": "false" for day in range(7)}
+        inputs.setdefault("timezone", self.default_tz)
+        inputs["delivery"] = (record and record.delivery) or "direct"
+        attachment = self.cards.attachment("subscription", **inputs)
         self.api.messages.create(toPersonId=user, text=txt, attachments=[attachment])
         return ""
 
@@ -285,7 +566,8 @@ class Hermess():
             str: Request the user to fill out the form.
         """
         self.get_user_info(incoming_msg)
-        self.update_file(user=self.current_user.id, data=self.current_user.to_dict())
+        self.update_file()
+        self.update_schedules(self.current_user.id)
         self.subscription_card(self.current_user.id)
         return "Please fill out the subscription form."
 
@@ -301,13 +583,16 @@ class Hermess():
             str: Confirmation message if the user was removed successfully
         """
         self.get_user_info(incoming_msg)
-        return self.update_file(remove=True)
+        response = self.update_file(remove=True)
+        self.update_schedules(self.current_user.id)
+        return response
 
     # --------- Message Management --------- #
     def get_attachment_actions(self, attachmentid):
         """Retrieve the incomming attachement.
 
         Checks for incomming attachements to get the work schedule specified by the user using the adaptive card.
+        The request goes through the shared REST session, reusing its pooled connections and timeouts.
 
         Args:
             attachmentid (str): Unique identifier for the incomming attachement.
@@ -315,10 +600,7 @@ class Hermess():
         Returns:
             JSON: Json string containing the work schedule.
         """
-        headers = {"content-type": "application/json; charset=utf-8",
-                   "authorization": f"Bearer {self.teams_token}"}
-        url = f"{self.baseurl}/attachment/actions/{attachmentid}"
-        response = requests.get(url, headers=headers)
+        response = self.rest.get(f"/attachment/actions/{attachmentid}")
         return response.json()
 
     # check attachmentActions:created webhook to handle any card actions
@@ -336,14 +618,129 @@ class Hermess():
             str: Success message once the information has been received.
         """
         message = self.get_attachment_actions(incoming_msg["data"]["id"])
+        if "shiftstart" not in message["inputs"]:
+            return self.handle_notification(message)
         # Update people to notify file
         self.update_file(user=message["personId"], data=message["inputs"])
         self.remove_messages(incoming_msg, messageId=message["messageId"])
-        self.update_schedules()
+        self.update_schedules(message["personId"])
         return "Form received!"
 
+    def handle_notification(self, message):
+        """Process the actions of the notification card.
+
+        Snooze sends the reminder again after the chosen number of minutes, ACK cancels the user's pending snoozes.
+        The card is removed in both cases.
+
+        Args:\n
+            message (dict): The attachment action.
+
+        Returns:\n
+            str: Confirmation message.
+        """
+        inputs = message["inputs"]
+        personId = message["personId"]
+        self.remove_messages(None, messageId=message["messageId"])
+        if inputs.get("x") == "snooze":
+            minutes = int(inputs.get("snooze") or 5)
+            self.snooze(personId, minutes, inputs.get("time", ""))
+            return f"Snoozed, I will remind you again in {minutes} minutes."
+        self.snoozes.cancel_owner(personId)
+        return "Got it, thanks!"
+
+    def snooze(self, personId, minutes, due=""):
+        """Remind a user again after some minutes.
+
+        Snoozes live in the timing wheel instead of the scheduler, so they cost no scheduler jobs.
+        A user has at most one pending snooze, snoozing again replaces it.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+            minutes (int): Minutes to wait.
+            due (str, optional): Time the email is due at, shown on the card. Defaults to "".
+        """
+        self.snoozes.cancel_owner(personId)
+        self.snoozes.schedule(minutes * 60, self.ping_snoozed, personId, due, owner=personId)
+
+    def ping_snoozed(self, personId, due=""):
+        """Send a snoozed reminder.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+            due (str, optional): Time the email is due at, shown on the card. Defaults to "".
+        """
+        record = self.store.get(personId)
+        if record:
+            self.queue_reminder(personId, f"Hello {record.name}, remember to send the hourly email!",
+                                card="notification", kind="snooze", name=record.name, time=due)
+
     # --------- Ping Functions --------- #
-    def ping_user(self, personId, message="Hello, remember to send the hourly email!"):
+    def start_delivery(self):
+        """Start the broadcast engine and the outbox dispatcher.
+
+        Broadcasts and reminders are sent through their own API instance that raises on rate limits instead of sleeping,
+        so the senders can pause every worker for the Retry-After period.
+        Workers and rate limit are taken from the HERMES_BROADCAST_WORKERS, HERMES_RATE_LIMIT (messages per second),
+        HERMES_RATE_BURST and HERMES_MAX_RETRIES environment variables, the outbox workers from HERMES_OUTBOX_WORKERS.
+        Both share the same rate limit.
+        """
+        self.delivery_api = self.webex_api(wait_on_rate_limit=False)
+        self.broadcaster = Broadcaster(functools.partial(self.ping_user, api=self.delivery_api),
+                                       workers=int(os.getenv("HERMES_BROADCAST_WORKERS", 8)),
+                                       rate=float(os.getenv("HERMES_RATE_LIMIT", 5)),
+                                       burst=int(os.getenv("HERMES_RATE_BURST", 10)),
+                                       max_retries=int(os.getenv("HERMES_MAX_RETRIES", 3)))
+        self.outbox = Outbox(self.outbox_path, recover=self.ring is None)  # Cluster workers share the outbox, it is recovered once by run_cluster
+        self.outbox.purge()
+        self.dispatcher = OutboxDispatcher(self.outbox, self.send_payload,
+                                           workers=int(os.getenv("HERMES_OUTBOX_WORKERS", 16)),
+                                           bucket=self.broadcaster.bucket,
+                                           on_delivered=self.record_delivery)
+        self.dispatcher.start()
+
+    def send_payload(self, payload):
+        """Send a message queued in the outbox.
+
+        The payload is posted as is through the shared REST session, so it is never parsed again.
+
+        Args:\n
+            payload (str): Serialized message body.
+
+        Raises:\n
+            HTTPError: When the API rejects the message.
+        """
+        self.rest.post("/messages", data=payload.encode()).raise_for_status()
+
+    def queue_reminder(self, personId, message, card=None, kind=None, delay=0, scheduled_at=None, **values):
+        """Queue a scheduled reminder in the outbox.
+
+        Used by the schedule jobs instead of ping_user, so the scheduler threads never wait on the API
+        and the reminder survives restarts and API errors until it is delivered.
+        The reminder is keyed by user, kind and the minute it is due in, so a job firing twice for the same minute only sends it once.
+        A delayed reminder is due at the end of its delay, so the delay is not counted in the reminder lag metric.
+
+        Args:\n
+            personId (str): Unique identifier of the recipient.
+            message (str): Message to send, the fallback text when a card is sent.
+            card (str, optional): Name of the card to send with the message. Defaults to None.
+            kind (str, optional): Kind of reminder, so reminders of different kinds due in the same minute are all sent. Defaults to None.
+            delay (float, optional): Seconds to wait before sending the reminder. Defaults to 0.
+            scheduled_at (float, optional): Start of the slot the reminder is due in, the reminder lag is measured from it. Defaults to None, the current minute.
+            **values: Values for the card variables.
+        """
+        if scheduled_at is None:
+            now = time.time()
+            scheduled_at = now - now % 60
+        key = f"{personId}:{kind}:{int(scheduled_at // 60)}" if kind else f"{personId}:{int(scheduled_at // 60)}"
+        if card:
+            payload = self.cards.message(card, message, toPersonId=personId, **values)
+        else:
+            payload = {"toPersonId": personId, "text": message}
+        if self.outbox.put(key, payload, scheduled_at=scheduled_at + delay, delay=delay):
+            self.dispatcher.wake()
+
+    @timed
+    def ping_user(self, personId, message="Hello, remember to send the hourly email!", api=None):
         """Base function to send a 1:1 message to a specified user
 
         Sends a message to a specific user using the personId as delivery address.
@@ -351,27 +748,30 @@ class Hermess():
         Args:
             personId (str): String containing the unique id for the recipient of the subscription card.
             message (str, optional): string containing the message . Defaults to None.
+            api (WebexTeamsAPI, optional): API instance used to send the message. Defaults to self.api.
         """
-        self.api.messages.create(toPersonId=personId, text=message)
+        (api or self.api).messages.create(toPersonId=personId, text=message)
 
-    def ping_all(self, message=None):
+    def ping_all(self, message=None, on_done=None):
         """Ping all users in the users data file.
 
-        Iters through the list of users and sends them a message to all of them.
+        Hands the message to the broadcast engine, which sends it to every user in the background.
         Intended for use only by the bot.
 
         Args:\n
             message (str, optional): Message to send all users. Defaults to None.
+            on_done (callable, optional): Called with the broadcast job once every user has been handled. Defaults to None.
+
+        Returns:\n
+            BroadcastJob: Handle to follow the delivery.
         """
-        users_to_ping = self.load_users(file=True)["users"]
-        for user in users_to_ping:
-            self.ping_user(user, message=message)
+        return self.broadcaster.submit(self.store.ids(), message, on_done=on_done)
 
     # --------- User Functions --------- #
     def ping_all_users(self, incoming_msg):
         """User facing, hidden command, to ping all users.
 
-        Iters through the list of users and sends them a message to all of them.
+        Starts a broadcast to all of them and returns right away, the delivered and failed counts are sent to the requesting space once it finishes.
         Intended for use by any user aware of the command.
         Meant to be kept hidden from regular users as it will ping every subscriber.
         Users will be notified on who requested to send the message through the bot.
@@ -380,25 +780,27 @@ class Hermess():
             incoming_msg (webexteamssdk.models.immutable.Message): Message provided by the webexteamssdk.
 
         Returns:
-            str: Success message informing the number of users reached by the sent message.
+            str: Message informing the broadcast id and the number of users it will reach.
         """
         message = f"Broadcast message requestesd by {incoming_msg.personEmail}"
-        users_to_ping = self.load_users()["users"]
-        responses = []
-        for user in users_to_ping:
-            self.api.messages.create(toPersonId=user, text=message)
-            responses.append(user)
-        return f"Ping sent to {len(users_to_ping)} users."
+        room = incoming_msg.roomId
+        job = self.ping_all(message, on_done=lambda job: self.api.messages.create(roomId=room, markdown=job.summary()))
+        return f"Broadcast {job.id} started for {job.total} users, I will let you know when it is done."
 
     def remove_messages(self, incoming_msg, messageId=None):
         """Delete a message sent by the bot.
 
-        Removes a specific message if a messageId is specified,  otherwise, it will delete all messages in the 1:1 space the bot shares with the requesting user.
+        Removes a specific message if a messageId is specified,  otherwise, it will delete the bot's messages in the 1:1 space the bot shares with the requesting user.
         Only capable of removing messages sent by the bot due to the restrictions put in place by the Webex Teams API.
+        The command accepts optional bounds to trim the history incrementally:
+            /clean [max] [before=YYYY-MM-DDTHH:MM:SSZ]
 
         Args:
             incoming_msg (webexteamssdk.models.immutable.Message): Message provided by the webexteamssdk.
             messageId (str, optional): String containing the unique identifier for the message to be deleted. Defaults to None.
+
+        Returns:
+            str: Number of messages removed when cleaning the space.
         """
         if messageId:
             try:
@@ -406,19 +808,100 @@ class Hermess():
             except Exception as e:
                 pprint(e)
         else:
-            # List all the messages the bot and the user share
-            messages_with_user = self.api.messages.list(roomId=incoming_msg.roomId)
-            for message in messages_with_user:
-                # Delete the messages
-                try:
-                    self.api.messages.delete(message.id)
-                except Exception:
-                    pass
+            limit, before = None, None
+            for option in (incoming_msg.text or "").split("/clean")[-1].split():
+                if option.isdigit():
+                    limit = int(option)
+                elif option.startswith("before="):
+                    before = option.split("=", 1)[1]
+            return self.clean_room(incoming_msg.roomId, before=before, limit=limit)
+
+    def get_bot(self):
+        """Get the person of the bot account.
+
+        Returns:\n
+            Person: The bot, looked up once.
+        """
+        if self.me is None:
+            self.me = self.api.people.me()
+        return self.me
+
+    def get_bot_id(self):
+        """Get the personId of the bot.
+
+        Returns:\n
+            str: The bot's personId.
+        """
+        return self.get_bot().id
+
+    def clean_room(self, roomId, before=None, limit=None, progress_every=100):
+        """Delete the bot's messages in a space.
+
+        Keeps listing pages of messages while a bounded pool of workers deletes them, sharing the rate limit of the other senders.
+        Messages not sent by the bot are skipped before any delete is sent, as the API would refuse to delete them.
+        The progress is shown in a status message posted to the space, which is edited as the deletions go and removed at the end.
+
+        Args:\n
+            roomId (str): Unique identifier of the space.
+            before (str, optional): Only delete messages sent before this ISO 8601 date. Defaults to None.
+            limit (int, optional): Maximum number of messages to delete. Defaults to None, deleting all of them.
+            progress_every (int, optional): Update the status message every this many deletions. Defaults to 100.
+
+        Returns:\n
+            str: Number of messages removed.
+        """
+        bot_id = self.get_bot_id()
+        slots = threading.BoundedSemaphore(self.clean_workers * 2)  # Keeps the listing a couple of pages ahead at most
+        lock = threading.Lock()
+        counts = {"deleted": 0, "failed": 0}
+        status = self.api.messages.create(roomId=roomId, markdown="Removing my messages in this space, this may take a while...")
+
+        def report(done):
+            log.info("Cleaning %s: %d messages handled", roomId, done)
+            try:
+                self.broadcaster.bucket.acquire()
+                self.api.messages.edit(status.id, roomId=roomId, markdown=f"Removing my messages in this space, {done} handled so far...")
+            except Exception as e:
+                log.warning("Updating the /clean status of %s failed: %r", roomId, e)
+
+        def delete(messageId):
+            try:
+                self.broadcaster.bucket.acquire()
+                self.api.messages.delete(messageId)
+                result = "deleted"
+            except Exception:
+                result = "failed"
+            finally:
+                slots.release()
+            with lock:
+                counts[result] += 1
+                done = counts["deleted"] + counts["failed"]
+            if done % progress_every == 0:
+                report(done)
+
+        submitted = 0
+        with ThreadPoolExecutor(max_workers=self.clean_workers, thread_name_prefix="hermes-clean") as pool:
+            for message in self.api.messages.list(roomId=roomId, before=before, max=100):
+                if limit is not None and submitted >= limit:
+                    break
+                if message.personId != bot_id or message.id == status.id:
+                    continue
+                slots.acquire()
+                pool.submit(delete, message.id)
+                submitted += 1
+        try:
+            self.api.messages.delete(status.id)
+        except Exception as e:
+            log.warning("Removing the /clean status of %s failed: %r", roomId, e)
+        log.info("Cleaned %s: %d messages deleted, %d failed", roomId, counts["deleted"], counts["failed"])
+        failed = f", {counts['failed']} could not be removed" if counts["failed"] else ""
+        return f"Removed {counts['deleted']} messages{failed}."
 
     def list_subscribers(self, _):
         """See who is subscribed to the notifications.
 
         Returns a formatted list to the requesting user of all the subscribers to the bot's notifications.
+        The subscribers' details come from the people cache, the ones missing from it are fetched in bulk.
 
         Args:
             _ (webexteamssdk.models.immutable.Message): Message provided by the webexteamssdk.
@@ -426,11 +909,14 @@ class Hermess():
         Returns:
             str: List of subscribers.
         """
-        subscribers = self.load_users()
         subList = ""
         num = 0
-        for sub in subscribers["users"]:
-            user_data = self.api.people.get(sub)
+        subscribers = self.store.ids()
+        people = self.people.get_many(subscribers)
+        for sub in subscribers:
+            user_data = people.get(sub)
+            if user_data is None:
+                continue
             num += 1
             name = user_data.displayName
             email = user_data.emails[0]
@@ -452,74 +938,406 @@ class Hermess():
         Returns:
             list: List containing time objects specifing the diferent hours to ping the user
         """
-        hour_list = []
-        s_start = datetime.datetime.strptime(shift_start, "%H:%M").time()
-        s_end = datetime.datetime.strptime(shift_end, "%H:%M",).time()
-        add_start = True
-        while s_start.hour != s_end.hour:
-            # Add shift start
-            minute_delta= 60-offset
-            if add_start:
-                if s_start.hour == 0:
-                    hour_list.append((23, minute_delta))
-                else:
-                    hour_list.append(((s_start.hour - 1), minute_delta))
-                add_start = False
-            hour_list.append((s_start.hour, minute_delta))
-            if s_start.hour < 23:
-                s_start = datetime.time((s_start.hour + 1))
+        return hour_range(shift_start, shift_end, offset=offset)
+
+    def load_schedule(self):
+        """Create the scheduler and the jobs of every user.
+
+        Runs in the background during startup, once the users store is loaded.
+        The scheduler runs in UTC, the shifts of every timezone are compiled into UTC slots.
+        In cluster mode the heartbeat and the timezone changes are left to the leader, see lead.
+        """
+        # Late runs of a job are merged into one and dropped once older than the grace time,
+        # so a stalled scheduler never fires a burst of stale reminders
+        self.sched = Scheduler({'apscheduler.timezone': 'UTC',
+                                'apscheduler.job_defaults.coalesce': True,
+                                'apscheduler.job_defaults.max_instances': 1,
+                                'apscheduler.job_defaults.misfire_grace_time': self.misfire_grace})
+        self.user_jobs = {}  # personId -> ids of the user's jobs, or slots in slot mode
+        self.dst_zones = set()  # Timezones whose offset changes are scheduled
+        self.sched.start()  # Start the scheduler
+        self.schedule_subscriptions()
+        if self.ring is None:
+            self.start_maintenance()
+        else:
+            self.election = LeaderElection(self.lock_path, self.lead,
+                                           interval=float(os.getenv("HERMES_ELECTION_INTERVAL", 1)))
+            self.election.start()
+        print(f"Schedule ready with {len(self.sched.get_jobs())} jobs {time.perf_counter() - self.started:.2f}s after start")
+
+    def start_maintenance(self):
+        """Start the heartbeat, catching up on the reminders missed since the last beat, and the jobs keeping the schedule up to date."""
+        self.catchup = CatchUp(self.heartbeat_path, self.sched.timezone,
+                               interval=int(os.getenv("HERMES_HEARTBEAT_INTERVAL", 60)),
+                               jitter=float(os.getenv("HERMES_CATCHUP_JITTER", 300)),
+                               grace=self.misfire_grace)
+        if self.last_tick is not None:
+            self.catchup.handled(self.last_tick * 60)  # A worker taking over the lead kept pinging its users until now
+        self.heartbeat(restart=True)
+        self.sched.add_listener(self.record_handled, EVENT_JOB_SUBMITTED)  # Only after the restart beat, which counts the slots since the previous run
+        self.schedule_maintenance()
+
+    def record_handled(self, event):
+        """Record the slot a reminder job ran for in the heartbeat file, the catch-up after an outage starts after it.
+
+        Args:\n
+            event (JobSubmissionEvent): The scheduler event of the job.
+        """
+        job = self.sched.get_job(event.job_id)
+        if job and job.func.__name__ in ("ping_slot", "tick", "queue_reminder"):
+            self.catchup.handled(max(event.scheduled_run_times).timestamp())
+
+    def schedule_maintenance(self):
+        """Create the jobs keeping the schedule itself up to date: the heartbeat, the outbox purge and the timezone offset changes.
+
+        In cluster mode the timezones in use are looked up every hour instead of every week,
+        as the subscriptions received by the other workers do not reach the leader's schedule.
+        """
+        self.sched.add_job(self.heartbeat, "interval",
+                           seconds=self.catchup.interval,
+                           start_date=datetime.datetime.fromtimestamp(self.catchup.next_beat(), datetime.timezone.utc),
+                           id="heartbeat",
+                           misfire_grace_time=None,
+                           replace_existing=True)
+        self.sched.add_job(self.outbox.purge, "interval",
+                           hours=1,
+                           id="purge",
+                           replace_existing=True)  # Delivered and failed messages would otherwise pile up while the bot runs
+        self.dst_zones = set()
+        self.schedule_transitions()
+        self.sched.add_job(self.schedule_transitions, "interval",
+                           **({"weeks": 1} if self.ring is None else {"hours": 1}),
+                           id="transitions",
+                           replace_existing=True)
+
+    def schedule_transitions(self, zones=None):
+        """Precompute the UTC offset changes of the users' timezones and create a job at each of them.
+
+        Looks HERMES_DST_WEEKS weeks ahead and runs again every week, each job compiles the shifts of that timezone into UTC again.
+
+        Args:\n
+            zones (set, optional): IANA names of the timezones. Defaults to None, every timezone in use.
+        """
+        if zones is None:
+            zones = {record.shift.timezone for _, record in self.store.items() if record.shift}
+        now = time.time()
+        for name in zones:
+            for change in transitions(name, now, now + self.dst_weeks * 7 * 24 * 3600):
+                self.sched.add_job(self.shift_timezone, "date",
+                                   args=[name],
+                                   id=f"dst:{name}:{int(change)}",
+                                   run_date=datetime.datetime.fromtimestamp(change, datetime.timezone.utc),
+                                   misfire_grace_time=None,
+                                   replace_existing=True)
+        self.dst_zones |= set(zones)
+
+    def shift_timezone(self, name):
+        """Compile the shifts of a timezone into UTC again, after the timezone changed its offset.
+
+        Args:\n
+            name (str): IANA name of the timezone.
+        """
+        users = [user for user, record in self.store.items() if record.shift and record.shift.timezone == name]
+        for user in users:
+            self.store.reindex(user)
+            if self.ring is not None:
+                continue  # The workers read the new slots from the shared store
+            if self.schedule_mode == "slot":
+                self.schedule_user_slots(user)
             else:
-                s_start = datetime.time(0)
-        return hour_list
+                self.schedule_user(user)
+        print(f"Moved the reminders of {len(users)} users to the new UTC offset of {name}")
+
+    def heartbeat(self, restart=False):
+        """Record that the bot is alive and catch up on the reminders missed during an outage.
+
+        After a restart every reminder since the last one sent was missed, while the scheduler was stalled
+        the reminders still within the misfire grace time are sent by their own jobs, see CatchUp.beat.
+
+        Args:\n
+            restart (bool, optional): True on the first beat after starting. Defaults to False.
+        """
+        outage = self.catchup.beat(restart=restart)
+        if outage:
+            self.catch_up(*outage)
+
+    def catch_up(self, since, until):
+        """Send every user a single message for the reminders missed between two moments.
+
+        The messages are spread over the HERMES_CATCHUP_JITTER window through the outbox, so they do not all hit the API at once.
+        Setting HERMES_CATCHUP to "off" drops the missed reminders.
 
+        Args:\n
+            since (float): Timestamp of the last slot that was handled, excluded.
+            until (float): Timestamp of the last slot that was missed, included.
+        """
+        masks = {user: record.shift.mask() for user, record in self.store.items() if record.shift}
+        plan = self.catchup.plan(masks, since, until)
+        print(f"Missed {sum(count for _, count, _ in plan)} reminders of {len(plan)} users in {(until - since) / 60:.0f} minutes")
+        if self.catchup_policy == "off":
+            return
+        for user, count, delay in plan:
+            record = self.store.get(user)
+            if record:
+                self.queue_reminder(user, f"Hi {record.name}, Hermes was offline and you missed {count} reminder{'s' if count > 1 else ''}, remember to send the hourly email!",
+                                    kind="catchup", delay=delay)
+
+    @timed
     def schedule_subscriptions(self):
         """Create a schedule job to ping the users.
 
-        Gathers the subscription information for each user and schedules a job in order to ping the specified user at the correct time.
-        """
-        self.check_user_file()
-        stored_users = self.load_users()
-        if stored_users:
-            for user in stored_users["users"]:
-                name = stored_users["users"][user]["nickName"].split(" ")[0] if "nickName" in stored_users["users"][user] else stored_users["users"][user]["firstName"]
-                if "subscription" in stored_users["users"][user]:
-                    subscription = stored_users["users"][user]["subscription"]
-                    shift_start = subscription["shiftstart"]
-                    shift_end = subscription["shiftend"]
-                    hour_range = self.get_hour_range(shift_start, shift_end)
-                    for day in subscription:
-                        if subscription[day]:
-                            day_num = day.split("day")[-1]
-                            invalid = ["shiftstart", "shiftend"]
-                            if day_num not in invalid:
-                                for time in hour_range:
-                                    f_hour, f_min = time
-                                    self.sched.add_job(self.ping_user, "cron",
-                                                       args=[user],
-                                                       kwargs={"message": f"Hello {name}, remember to send the hourly email!"},
-                                                       day_of_week=day_num,
-                                                       hour=f_hour,
-                                                       minute=f_min,
-                                                       misfire_grace_time=9000,
-                                                       replace_existing=True)
-                else:
-                    self.sched.add_job(self.ping_user,
-                                       "cron",
-                                       args=[user],
-                                       kwargs={"message": f"Hi {name}, looks like you have not updated your subscription, plese reply with /subscribe to update it."},
-                                       hour=22,
-                                       misfire_grace_time=9000)  # allows a time discrepancy of 2.5 minutes from the specified hour to handle large ammounts of users having to be pinged at the exact same time.
-
-    def update_schedules(self):
-        """Updates the schedules for all users.
-
-        Place holder solution to update the scheduled ping times when a user updates his subscription.
-
-        TODO:\n
-            Create Jobstores for each user or record each user's job id to be able to rechedule a single user without having to reschedule everything.
-        """
-        self.sched.remove_all_jobs()
-        self.schedule_subscriptions()
+        By default one job per time slot is created, see schedule_slots.
+        When HERMES_SCHEDULE_MODE is set to "user" a job is created for every ping of every user instead, see schedule_user,
+        which takes far longer to build and holds far more jobs for large rosters.
+        In cluster mode a single job checks the store every minute, see schedule_ticker.
+        """
+        if self.ring is not None:
+            return self.schedule_ticker()
+        if self.schedule_mode == "slot":
+            return self.schedule_slots()
+        for user, record in self.store.items():
+            self.schedule_user(user, record)
+
+    def schedule_user(self, personId, record=None):
+        """Create the schedule jobs to ping a single user.
+
+        Every job gets a stable id built from the personId and the time slot,
+        so the user's jobs can be replaced without touching the jobs of anybody else.
+        Jobs of time slots the user is no longer subscribed to are removed.
+        Users always get direct messages in this mode, the team space delivery needs the slot jobs of HERMES_SCHEDULE_MODE=slot.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+            record (Subscriber, optional): The user record. Defaults to None, reading it from the users store.
+        """
+        record = record or self.store.get(personId)
+        jobs = set()
+        if record:
+            name = record.name
+            if record.shift:
+                for day_num, f_hour, f_min in self.store.user_slots(personId):  # Read from the slot index, the shift is not compiled again on every start
+                    job_id = f"{personId}:{day_num}:{f_hour}:{f_min}"
+                    self.sched.add_job(self.queue_reminder, "cron",
+                                       args=[personId],
+                                       kwargs={"message": f"Hello {name}, remember to send the hourly email!",
+                                               "card": "notification",
+                                               "name": name,
+                                               "time": due_time(f_hour, f_min, utcoffset=utc_offset(record.shift.tz))},
+                                       id=job_id,
+                                       day_of_week=day_num,
+                                       hour=f_hour,
+                                       minute=f_min,
+                                       replace_existing=True)
+                    jobs.add(job_id)
+            else:
+                job_id = f"{personId}:unsubscribed"
+                self.sched.add_job(self.queue_reminder,
+                                   "cron",
+                                   args=[personId],
+                                   kwargs={"message": f"Hi {name}, looks like you have not updated your subscription, plese reply with /subscribe to update it."},
+                                   id=job_id,
+                                   hour=22,
+                                   timezone=self.default_tz,
+                                   replace_existing=True)
+                jobs.add(job_id)
+        for job_id in self.user_jobs.pop(personId, set()) - jobs:
+            self.remove_job(job_id)
+        if jobs:
+            self.user_jobs[personId] = jobs
+
+    def remove_job(self, job_id):
+        """Remove a schedule job, ignoring jobs that no longer exist.
+
+        Args:\n
+            job_id (str): Unique identifier of the job.
+        """
+        try:
+            self.sched.remove_job(job_id)
+        except JobLookupError:
+            pass
+
+    def schedule_slots(self):
+        """Create a schedule job for every time slot.
+
+        Registers at most one job per distinct (day_of_week, hour, minute) slot, at fire time the job looks up the users due in that slot and pings them,
+        so the number of jobs depends on the number of distinct slots rather than on the number of subscribers.
+        Users without a subscription are reminded to subscribe by a single daily job.
+        """
+        for slot in self.store.slots():
+            self.add_slot_job(slot)
+        self.schedule_unsubscribed()
+
+    def schedule_unsubscribed(self):
+        """Create the daily job reminding the users without a subscription to subscribe."""
+        self.sched.add_job(self.ping_unsubscribed, "cron",
+                           id="unsubscribed",
+                           hour=22,
+                           timezone=self.default_tz,
+                           replace_existing=True)
+
+    def schedule_ticker(self):
+        """Create the job pinging the users due every minute, used in cluster mode.
+
+        The users due are read from the shared store at every run, so a subscription changed on any worker
+        is picked up by every worker without touching their jobs.
+        """
+        self.sched.add_job(self.tick, "cron",
+                           id="tick",
+                           second=0,
+                           replace_existing=True)
+        if self.leading:
+            self.schedule_unsubscribed()
+
+    def tick(self):
+        """Ping the users due in the current minute.
+
+        A tick running late pings the minutes since the last tick as well, going back at most HERMES_MISFIRE_GRACE seconds
+        since older minutes are left to the catch-up.
+        """
+        current = int(time.time() // 60)
+        first = current if self.last_tick is None else max(self.last_tick + 1, current - self.misfire_grace // 60)
+        for minute in range(first, current + 1):
+            moment = datetime.datetime.fromtimestamp(minute * 60, datetime.timezone.utc)
+            self.ping_slot((moment.weekday(), moment.hour, moment.minute), scheduled_at=minute * 60)
+        self.last_tick = current
+
+    def schedule_user_slots(self, personId):
+        """Update the slot jobs after a user changed.
+
+        Adds the jobs of the user's new slots that are not scheduled yet and removes the jobs of the user's previous slots nobody is due in anymore.
+        Slot jobs of users scheduled at startup are not tracked, ping_slot removes its own job when it finds that slot empty.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+        """
+        slots = set(self.store.user_slots(personId))
+        for slot in slots:
+            if not self.sched.get_job(self.slot_job_id(slot)):
+                self.add_slot_job(slot)
+        for slot in self.user_jobs.pop(personId, set()) - slots:
+            if not self.store.due(*slot):
+                self.remove_job(self.slot_job_id(slot))
+        if slots:
+            self.user_jobs[personId] = slots
+
+    def slot_job_id(self, slot):
+        """Get the id of the schedule job of a time slot.
+
+        Args:\n
+            slot (tuple): A (day_of_week, hour, minute) tuple.
+
+        Returns:\n
+            str: The job id.
+        """
+        return "slot:{}:{}:{}".format(*slot)
+
+    def add_slot_job(self, slot):
+        """Create the schedule job for a time slot.
+
+        Args:\n
+            slot (tuple): A (day_of_week, hour, minute) tuple.
+        """
+        day_num, f_hour, f_min = slot
+        self.sched.add_job(self.ping_slot, "cron",
+                           args=[slot],
+                           id=self.slot_job_id(slot),
+                           day_of_week=day_num,
+                           hour=f_hour,
+                           minute=f_min,
+                           replace_existing=True)
+
+    def ping_slot(self, slot, scheduled_at=None):
+        """Ping every user due in a time slot.
+
+        Users who chose "room" delivery are mentioned together in the HERMES_TEAM_ROOM space, see ping_room,
+        every other user gets a direct message. Without a team space every user gets a direct message.
+        Removes the slot job if nobody is due in the slot anymore.
+        In cluster mode each worker only sends the direct messages of its own users and the leader sends the team space message.
+
+        Args:\n
+            slot (tuple): A (day_of_week, hour, minute) tuple.
+            scheduled_at (float, optional): Time the slot started at. Defaults to None, its latest start, also when the job runs late.
+        """
+        if scheduled_at is None:
+            scheduled_at = slot_start(slot)
+        users = self.store.due(*slot)
+        if not users:
+            self.remove_job(self.slot_job_id(slot))
+        room = []
+        for user in users:
+            owned = self.owns(user)
+            if not owned and not self.leading:
+                continue
+            record = self.store.get(user)
+            if not record:
+                continue
+            if record.delivery == "room" and self.team_room:
+                if self.leading:
+                    room.append(record)
+            elif owned:
+                self.queue_reminder(user, f"Hello {record.name}, remember to send the hourly email!",
+                                    card="notification", scheduled_at=scheduled_at, name=record.name, time=due_time(*slot[1:], utcoffset=utc_offset(record.shift.tz)))
+        if room:
+            self.ping_room(slot, room, scheduled_at)
+
+    def ping_room(self, slot, records, scheduled_at=None):
+        """Remind several users with a single message in the team space.
+
+        The users are mentioned in as few messages as fit the message size limit, so a whole team sharing a shift costs one API call.
+        Users of different timezones share the UTC slot, so they are mentioned under one header per timezone with the due time in that timezone.
+
+        Args:\n
+            slot (tuple): A (day_of_week, hour, minute) tuple.
+            records (list): List of the Subscriber records to mention.
+            scheduled_at (float, optional): Time the slot started at. Defaults to None, its latest start.
+        """
+        if scheduled_at is None:
+            scheduled_at = slot_start(slot)
+        zones = {}
+        for record in records:
+            zones.setdefault(record.shift.timezone, []).append(mention(record.id, record.name))
+        for timezone, mentions in sorted(zones.items()):
+            header = f"Remember to send the hourly email before {due_time(*slot[1:], utcoffset=utc_offset(timezone))} ({timezone}): "
+            for num, markdown in enumerate(chunk_mentions(header, mentions)):
+                if self.outbox.put(f"room:{self.slot_job_id(slot)}:{int(scheduled_at // 60)}:{timezone}:{num}",
+                                   {"roomId": self.team_room, "markdown": markdown},
+                                   scheduled_at=scheduled_at):
+                    self.dispatcher.wake()
+
+    def ping_unsubscribed(self):
+        """Remind the users without a subscription to subscribe."""
+        for user, record in self.store.items():
+            if not record.shift:
+                self.queue_reminder(user, f"Hi {record.name}, looks like you have not updated your subscription, plese reply with /subscribe to update it.")
+
+    def update_schedules(self, personId=None):
+        """Updates the scheduled ping times.
+
+        When a personId is given only the jobs of that user are updated, the jobs of every other user are left untouched,
+        and the user's pending snoozes are cancelled.
+        Otherwise every job is removed and the whole schedule is rebuilt from the users store.
+
+        Args:\n
+            personId (str, optional): Unique identifier of the user whose subscription changed. Defaults to None.
+        """
+        self.schedule_ready.result()  # Wait for the schedule to be loaded at startup
+        if personId is None:
+            self.sched.remove_all_jobs()
+            self.user_jobs = {}
+            self.schedule_subscriptions()
+            if self.leading:
+                self.schedule_maintenance()
+        else:
+            self.snoozes.cancel_owner(personId)
+            record = self.store.get(personId)
+            if self.leading and record and record.shift and record.shift.timezone not in self.dst_zones:
+                self.schedule_transitions({record.shift.timezone})
+            if self.ring is not None:
+                return  # The ticker reads the subscription from the shared store
+            if self.schedule_mode == "slot":
+                self.schedule_user_slots(personId)
+            else:
+                self.schedule_user(personId)
 
     # --------- Bot --------- #
     def add_commands(self):
@@ -528,13 +1346,88 @@ class Hermess():
         Adds new hidden commands to the bot using the "*" as a second argument.
         Adds user commands to the bot, the second argument is the description of the command;
         visible by sending an unrecognise str to the bot or using the "/help" command.
+        Every command runs on the work queue, the webhooks are received by receive_webhook instead of the bot's own handler.
         """
         self.bot.add_command("attachmentActions", "*", self.handle_cards)
         self.bot.add_command("/unsubscribe", "I will stop pinging you", self.unsubscribe)
         self.bot.add_command("/subscribe", "I will ping you at a specified time", self.subscribe)
         self.bot.add_command("/pingall", "*", self.ping_all_users)
         self.bot.add_command("/listsubs", "This will give you a list of all the people who will be pinged", self.list_subscribers)
-        self.bot.add_command("/clean", "Removes all the meessages in the conversation", self.remove_messages)
+        self.bot.add_command("/clean", "Removes all the meessages in the conversation, use /clean [max] [before=date] to remove only some of them", self.remove_messages)
+        self.bot.view_functions["index"] = self.receive_webhook
+
+    def receive_webhook(self):
+        """Acknowledge a webhook and queue it on the work queue.
+
+        Replaces the bot's own handler, which fetches the message and looks up the bot account twice before answering,
+        so the webhook is acknowledged in milliseconds and every API call runs on a worker, see process_webhook.
+        Webhooks are keyed by the id of the message or attachment action, duplicate deliveries are dropped.
+
+        Returns:\n
+            str: Empty reply.
+        """
+        post_data = request.get_json(force=True)
+        self.work.submit(post_data["data"]["id"], self.process_webhook, post_data)
+        return ""
+
+    def process_webhook(self, post_data):
+        """Run the command of a webhook and send its reply.
+
+        Matches the commands the same way the bot does: card actions by their resource,
+        messages by the first command found in their text, falling back to the bot's default action.
+        Messages of the bot itself and of users outside the bot's approved users are ignored.
+
+        Args:\n
+            post_data (dict): The webhook body.
+        """
+        room = post_data["data"]["roomId"]
+        if post_data["resource"] != "messages":
+            command = self.bot.commands.get(post_data["resource"].lower())
+            if command:
+                self.run_command(room, command["callback"], self.api, post_data)
+            return
+        message = self.api.messages.get(post_data["data"]["id"])
+        if message.personId == self.get_bot_id():
+            return
+        if self.bot.approved_users and message.personEmail not in self.bot.approved_users:
+            return
+        command = self.find_command(message.text or "")
+        if command in self.bot.commands:
+            self.run_command(room, self.bot.commands[command]["callback"], message)
+
+    def find_command(self, text):
+        """Find the command in the text of a message.
+
+        The bot's name is removed first, as mentions in a space include it, then the first command found in the text wins, in alphabetical order.
+
+        Args:\n
+            text (str): Text of the message.
+
+        Returns:\n
+            str: The command, the bot's default action when the text holds none.
+        """
+        text = self.bot.extract_message(self.get_bot().displayName, text).lower()
+        return next((command for command in sorted(self.bot.commands) if command in text), self.bot.default_action)
+
+    def run_command(self, room, command, *args):
+        """Run a command and send its reply.
+
+        The time taken by the command is recorded in the hermes_command_seconds metric.
+
+        Args:\n
+            room (str): Unique identifier of the space the reply is sent to.
+            command (callable): Command callback.
+            *args: Arguments for the command callback.
+        """
+        with COMMAND_SECONDS.time(command=command.__name__):
+            try:
+                reply = command(*args)
+            except Exception as e:
+                print(f"Command {command.__name__} failed: {e!r}")
+                COMMAND_ERRORS.inc(command=command.__name__)
+                reply = "Sorry, something went wrong while processing your request, please try again."
+        if reply:
+            self.api.messages.create(roomId=room, markdown=reply)
 
 
 if __name__ == "__main__":
@@ -542,4 +1435,6 @@ if __name__ == "__main__":
 
     Allows the bot to run if the file was called directly.
     """
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    log.setLevel(logging.INFO)  # The scheduler and the SDK log every job and request at the info level
     Hermess()
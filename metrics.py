@@ -0,0 +1,318 @@
+"""Metrics for Hermes
+
+    Counters, gauges and histograms kept in memory and exposed in the Prometheus text format.
+"""
+import time
+import bisect
+import functools
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values, extra=None):
+    """Format the labels of a series.
+
+    Args:\n
+        names (tuple): Label names.
+        values (tuple): Label values, in the same order.
+        extra (dict, optional): More labels to add. Defaults to None.
+
+    Returns:\n
+        str: The labels between braces, an empty string when there are none.
+    """
+    pairs = list(zip(names, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def format_value(value):
+    """Format a sample value.
+
+    Args:\n
+        value (float): The value.
+
+    Returns:\n
+        str: The value, infinities spelled the Prometheus way.
+    """
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric():
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        """Base of the metric types
+
+        Every combination of label values is a separate series.
+
+        Args:\n
+            name (str): Name of the metric.
+            help (str): Description of the metric.
+            labels (tuple, optional): Label names. Defaults to ().
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._series = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def key(self, labels):
+        """Get the label values of a series.
+
+        Args:\n
+            labels (dict): Label name -> value.
+
+        Returns:\n
+            tuple: The label values in the order of the label names.
+        """
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self):
+        """List the samples of the metric.
+
+        Returns:\n
+            list: List of (suffix, label values, extra labels, value) tuples.
+        """
+        with self._lock:
+            return [("", key, None, value) for key, value in self._series.items()]
+
+    def render(self, extra=None):
+        """Format the metric in the Prometheus text format.
+
+        Args:\n
+            extra (dict, optional): Labels added to every series. Defaults to None.
+
+        Returns:\n
+            str: The lines of the metric.
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.labels, key, dict(labels or {}, **(extra or {})))} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Increase the counter.
+
+        Args:\n
+            amount (float, optional): Amount to add. Defaults to 1.
+            **labels: Label values of the series.
+        """
+        key = self.key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), fn=None):
+        """Value that goes up and down
+
+        Args:\n
+            name (str): Name of the metric.
+            help (str): Description of the metric.
+            labels (tuple, optional): Label names. Defaults to ().
+            fn (callable, optional): Called on every collection to read the value of a gauge without labels,
+                the gauge is left out when it raises. Defaults to None.
+        """
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        """Set the gauge.
+
+        Args:\n
+            value (float): The value.
+            **labels: Label values of the series.
+        """
+        key = self.key(labels)
+        with self._lock:
+            self._series[key] = value
+
+    def samples(self):
+        if self.fn is None:
+            return super().samples()
+        try:
+            return [("", (), None, self.fn())]
+        except Exception:
+            return []
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        """Distribution of observed values
+
+        Args:\n
+            name (str): Name of the metric.
+            help (str): Description of the metric.
+            labels (tuple, optional): Label names. Defaults to ().
+            buckets (tuple, optional): Sorted upper bounds of the buckets, +Inf is added. Defaults to DEFAULT_BUCKETS.
+        """
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """Record a value.
+
+        Args:\n
+            value (float): The value.
+            **labels: Label values of the series.
+        """
+        key = self.key(labels)
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][slot] += 1
+            series[1] += value
+
+    def time(self, **labels):
+        """Time a block of code.
+
+        Usage:
+            with histogram.time(command="subscribe"):
+                ...
+
+        Args:\n
+            **labels: Label values of the series.
+
+        Returns:\n
+            Timer: Context manager observing the time spent in the block.
+        """
+        return Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        samples = []
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", key, {"le": format_value(float(bound))}, cumulative))
+            samples.append(("_sum", key, None, total))
+            samples.append(("_count", key, None, cumulative))
+        return samples
+
+
+class Timer():
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry():
+    def __init__(self):
+        """Set of metrics exposed together"""
+        self.metrics = {}  # name -> Metric
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric, or get the metric already registered under its name.
+
+        Args:\n
+            metric (Metric): The metric.
+
+        Returns:\n
+            Metric: The registered metric.
+        """
+        with self._lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), fn=None):
+        return self.register(Gauge(name, help, labels, fn=fn))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self, extra=None):
+        """Format every metric in the Prometheus text format.
+
+        Args:\n
+            extra (dict, optional): Labels added to every series. Defaults to None.
+
+        Returns:\n
+            str: The exposition text.
+        """
+        with self._lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(metric.render(extra) for metric in metrics) + "\n"
+
+
+def merge(texts):
+    """Combine several expositions into one, as the workers of a cluster each render their own.
+
+    The samples of each metric are grouped under a single HELP and TYPE header, the series must already be told apart by their labels.
+
+    Args:\n
+        texts (list): Texts in the Prometheus text format.
+
+    Returns:\n
+        str: The combined exposition text.
+    """
+    families = {}  # metric name -> [header lines, sample lines]
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                family = families.setdefault(line.split(" ", 3)[2], [[], []])
+                if len(family[0]) < 2 and line not in family[0]:
+                    family[0].append(line)
+            elif line and family is not None:
+                family[1].append(line)
+    return "".join("\n".join(header + samples) + "\n" for header, samples in families.values())
+
+
+REGISTRY = Registry()
+FUNCTION_SECONDS = REGISTRY.histogram("hermes_function_seconds", "Time spent in the instrumented functions", labels=("function",))
+
+
+def timed(fn=None, histogram=FUNCTION_SECONDS):
+    """Decorator recording the time spent in a function, labelled with the function name.
+
+    Usage:
+        @timed
+        def load_users(self):
+            ...
+
+    Args:\n
+        fn (callable, optional): The function, when used without arguments. Defaults to None.
+        histogram (Histogram, optional): Histogram with a "function" label. Defaults to FUNCTION_SECONDS.
+
+    Returns:\n
+        callable: The wrapped function.
+    """
+    if fn is None:
+        return functools.partial(timed, histogram=histogram)
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start, function=name)
+    return wrapper
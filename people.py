@@ -0,0 +1,108 @@
+"""People directory for Hermes
+
+    Caches the Webex people lookups so repeated commands do not hit the API.
+"""
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PeopleCache():
+    def __init__(self, api, ttl=3600, maxsize=5000, chunk_size=85, workers=4):
+        """TTL and LRU cache of Webex people
+
+        People are kept for ttl seconds, once maxsize people are cached the least recently used are evicted.
+        Cache misses for many people at once are fetched in bulk, the /people endpoint accepts up to
+        chunk_size comma separated ids per request, and the chunks are requested concurrently.
+
+        Args:\n
+            api (WebexTeamsAPI): API instance used for the lookups.
+            ttl (float, optional): Seconds a person is kept in the cache. Defaults to 3600.
+            maxsize (int, optional): Maximum number of people kept in the cache. Defaults to 5000.
+            chunk_size (int, optional): Maximum ids per bulk request. Defaults to 85.
+            workers (int, optional): Number of bulk requests made at once. Defaults to 4.
+        """
+        self.api = api
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self._people = OrderedDict()  # personId -> (expires, person)
+        self._lock = threading.Lock()
+
+    def _cached(self, personId):
+        with self._lock:
+            entry = self._people.get(personId)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._people[personId]
+                return None
+            self._people.move_to_end(personId)
+            return entry[1]
+
+    def put(self, person):
+        """Add a person to the cache.
+
+        Args:\n
+            person (Person): The person returned by the API.
+        """
+        with self._lock:
+            self._people[person.id] = (time.monotonic() + self.ttl, person)
+            self._people.move_to_end(person.id)
+            while len(self._people) > self.maxsize:
+                self._people.popitem(last=False)
+
+    def invalidate(self, personId):
+        """Drop a person from the cache.
+
+        Args:\n
+            personId (str): Unique identifier of the person.
+        """
+        with self._lock:
+            self._people.pop(personId, None)
+
+    def get(self, personId):
+        """Get a person, calling the API only on a cache miss.
+
+        Args:\n
+            personId (str): Unique identifier of the person.
+
+        Returns:\n
+            Person: The person details.
+        """
+        person = self._cached(personId)
+        if person is None:
+            person = self.api.people.get(personId)
+            self.put(person)
+        return person
+
+    def get_many(self, personIds):
+        """Get several people, fetching the cache misses in bulk.
+
+        Args:\n
+            personIds (list): List of personIds.
+
+        Returns:\n
+            dict: personId -> Person, people the API did not return are left out.
+        """
+        found = {}
+        missing = []
+        for personId in personIds:
+            person = self._cached(personId)
+            if person is None:
+                missing.append(personId)
+            else:
+                found[personId] = person
+        chunks = [missing[i:i + self.chunk_size] for i in range(0, len(missing), self.chunk_size)]
+        if chunks:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(chunks))) as pool:
+                for people in pool.map(self._fetch, chunks):
+                    for person in people:
+                        self.put(person)
+                        found[person.id] = person
+        return found
+
+    def _fetch(self, chunk):
+        return list(self.api.people.list(id=",".join(chunk)))
@@ -0,0 +1,126 @@
+"""REST client for Hermes
+
+    Shared HTTP session for the Webex API calls not covered by the SDK.
+"""
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class RestClient():
+    def __init__(self, baseurl, token, timeout=(3.05, 15), retry=None, pool_size=20):
+        """Pooled HTTP client for the Webex REST API
+
+        Keeps the connections alive in a pool shared by every call, sets connect and read timeouts on every request
+        and retries idempotent requests on rate limits and server errors, honouring the Retry-After header.
+        The latency of every endpoint is recorded and handed to the hooks added with add_hook.
+
+        Args:\n
+            baseurl (str): Base url of the API, without a trailing slash.
+            token (str): Bearer token used to authenticate.
+            timeout (tuple, optional): (connect, read) timeouts in seconds. Defaults to (3.05, 15).
+            retry (Retry, optional): urllib3 retry policy replacing the default one. Defaults to None.
+            pool_size (int, optional): Maximum connections kept alive. Defaults to 20.
+        """
+        self.baseurl = baseurl
+        self.timeout = timeout
+        self.retry = retry or Retry(total=3,
+                                    backoff_factor=0.5,
+                                    status_forcelist=(429, 500, 502, 503, 504),
+                                    allowed_methods=frozenset(["GET", "PUT", "DELETE", "HEAD", "OPTIONS"]),
+                                    respect_retry_after_header=True,
+                                    raise_on_status=False)
+        self.session = requests.Session()
+        self.session.headers.update({"content-type": "application/json; charset=utf-8",
+                                     "authorization": f"Bearer {token}"})
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=self.retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.hooks = []
+        self.stats = {}  # endpoint -> [calls, errors, total seconds, max seconds]
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """Call a function after every request.
+
+        Args:\n
+            hook (callable): Called as hook(method, endpoint, status, seconds), status is None when the request failed to complete.
+        """
+        self.hooks.append(hook)
+
+    @staticmethod
+    def endpoint(path):
+        """Name the endpoint of a path, leaving out the ids.
+
+        Args:\n
+            path (str): Path of the request, for instance /attachment/actions/<id>.
+
+        Returns:\n
+            str: The endpoint, for instance /attachment/actions.
+        """
+        parts = [part for part in path.split("?")[0].split("/") if part and len(part) < 40]
+        return "/" + "/".join(parts)
+
+    def request(self, method, path, **kwargs):
+        """Send a request to the API.
+
+        Args:\n
+            method (str): HTTP method.
+            path (str): Path of the request relative to the base url.
+            **kwargs: Extra arguments for requests.Session.request.
+
+        Returns:\n
+            Response: The API response.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = self.endpoint(path)
+        status = None
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, f"{self.baseurl}{path}", **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            self.record(method, endpoint, status, time.perf_counter() - start)
+
+    def record(self, method, endpoint, status, seconds):
+        """Record the latency of a request.
+
+        Args:\n
+            method (str): HTTP method.
+            endpoint (str): Endpoint of the request.
+            status (int): HTTP status, None when the request failed to complete.
+            seconds (float): Time taken by the request.
+        """
+        with self._lock:
+            stats = self.stats.setdefault(f"{method} {endpoint}", [0, 0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += status is None or status >= 400
+            stats[2] += seconds
+            stats[3] = max(stats[3], seconds)
+        for hook in self.hooks:
+            hook(method, endpoint, status, seconds)
+
+    def latency(self):
+        """Summarize the latency of every endpoint.
+
+        Returns:\n
+            dict: "METHOD /endpoint" -> dict with the calls, errors, average and max seconds.
+        """
+        with self._lock:
+            return {name: {"calls": calls, "errors": errors, "avg": total / calls, "max": slowest}
+                    for name, (calls, errors, total, slowest) in self.stats.items()}
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
@@ -0,0 +1,527 @@
+"""Shift helpers for Hermes
+
+    Turns the subscription card inputs into the times a user has to be pinged.
+
+    A shift is compiled once into a weekly bitmap, a Python int where bit n is set
+    when the user has to be pinged n minutes after monday 00:00.
+    Shifts are entered in the user's timezone and compiled into UTC, so users of every zone share the same slots.
+"""
+import time
+import pickle
+import datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+# (day_of_week, hour, minute) of every minute of the week, shared by every index instead of building new tuples
+SLOTS = [(day, hour, minute) for day in range(7) for hour in range(24) for minute in range(60)]
+DEFAULT_TIMEZONE = "America/Costa_Rica"  # Timezone of the shifts saved without one
+
+
+def enabled(value):
+    """Check if a card toggle is on.
+
+    Adaptive card toggles are submitted as the strings "true" and "false".
+
+    Args:\n
+        value (str or bool): Value submitted by the toggle.
+
+    Returns:\n
+        bool: True if the toggle is on.
+    """
+    return value is True or str(value).lower() == "true"
+
+
+def hour_range(shift_start, shift_end, offset=5):
+    """Find the time to ping each user.
+
+    Creates a list of all the times the user needs to be ping during his working hours
+
+    Args:\n
+        shift_start (str): string containing the hour at wich the notifications should start.
+        shift_end (str): string containing the hour at wich the notifications should end.
+        offset (int): minutes before the hour to send the message. Defaults to 5.
+
+    Returns:\n
+        list: List containing (hour, minute) tuples specifing the diferent hours to ping the user
+    """
+    hour_list = []
+    s_start = datetime.datetime.strptime(shift_start, "%H:%M").time()
+    s_end = datetime.datetime.strptime(shift_end, "%H:%M",).time()
+    add_start = True
+    while s_start.hour != s_end.hour:
+        # Add shift start
+        minute_delta = 60 - offset
+        if add_start:
+            if s_start.hour == 0:
+                hour_list.append((23, minute_delta))
+            else:
+                hour_list.append(((s_start.hour - 1), minute_delta))
+            add_start = False
+        hour_list.append((s_start.hour, minute_delta))
+        if s_start.hour < 23:
+            s_start = datetime.time((s_start.hour + 1))
+        else:
+            s_start = datetime.time(0)
+    return hour_list
+
+
+def shift_days(subscription):
+    """List the days of the week enabled in a subscription.
+
+    Args:\n
+        subscription (dict): Subscription card inputs, the days are named day0 (monday) to day6 (sunday).
+
+    Returns:\n
+        list: Sorted list of day numbers, 0 being monday.
+    """
+    days = []
+    for key, value in subscription.items():
+        day_num = key.split("day")[-1]
+        if key.startswith("day") and day_num.isdigit() and enabled(value):
+            days.append(int(day_num))
+    return sorted(days)
+
+
+def parse_time(value):
+    """Convert a "HH:MM" time into minutes since midnight.
+
+    Args:\n
+        value (str): Time submitted by the card.
+
+    Returns:\n
+        int: Minutes since midnight.
+    """
+    hour, minute = value.split(":")[:2]
+    return int(hour) * 60 + int(minute)
+
+
+def due_time(hour, minute, offset=5, utcoffset=0):
+    """Format the time an email is due at, for a ping sent offset minutes before it.
+
+    Args:\n
+        hour (int): Hour the ping is sent at.
+        minute (int): Minute the ping is sent at.
+        offset (int, optional): minutes before the due time the ping is sent. Defaults to 5.
+        utcoffset (int, optional): Minutes to add to convert the ping time into the user's time, see utc_offset. Defaults to 0.
+
+    Returns:\n
+        str: The due time, for instance "01:00 PM".
+    """
+    due = (hour * 60 + minute + offset + utcoffset) % MINUTES_PER_DAY
+    return datetime.time(due // 60, due % 60).strftime("%I:%M %p")
+
+
+def zone(name=None):
+    """Get a timezone by name.
+
+    Args:\n
+        name (str, optional): IANA name of the timezone. Defaults to None, the DEFAULT_TIMEZONE.
+
+    Returns:\n
+        ZoneInfo: The timezone.
+    """
+    return ZoneInfo(name or DEFAULT_TIMEZONE)
+
+
+def valid_timezone(name):
+    """Check if a timezone name is known.
+
+    Args:\n
+        name (str): IANA name of the timezone.
+
+    Returns:\n
+        bool: True if the timezone exists.
+    """
+    try:
+        zone(name)
+        return bool(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+
+
+def utc_offset(name=None, at=None):
+    """Get the offset of a timezone from UTC.
+
+    Args:\n
+        name (str, optional): IANA name of the timezone. Defaults to None, the DEFAULT_TIMEZONE.
+        at (float, optional): Timestamp to get the offset at. Defaults to None, now.
+
+    Returns:\n
+        int: Minutes to add to UTC to get the local time.
+    """
+    moment = datetime.datetime.fromtimestamp(time.time() if at is None else at, zone(name))
+    return int(moment.utcoffset().total_seconds() // 60)
+
+
+def transitions(name, start, end, step=86400):
+    """Find the moments a timezone changes its offset from UTC, like daylight saving time changes.
+
+    The offset is checked every step seconds and each change is then narrowed down to the second.
+
+    Args:\n
+        name (str): IANA name of the timezone.
+        start (float): Timestamp to start looking from.
+        end (float): Timestamp to stop looking at.
+        step (float, optional): Seconds between checks, shorter than the time between two changes. Defaults to a day.
+
+    Returns:\n
+        list: Timestamps of the first second of each change.
+    """
+    changes = []
+    before, offset = start, utc_offset(name, start)
+    while before < end:
+        after = min(before + step, end)
+        if utc_offset(name, after) != offset:
+            low, high = before, after
+            while high - low > 1:
+                middle = (low + high) / 2
+                if utc_offset(name, middle) == offset:
+                    low = middle
+                else:
+                    high = middle
+            changes.append(int(low) + 1)
+            offset = utc_offset(name, after)
+        before = after
+    return changes
+
+
+def compile_mask(days, shift_start, shift_end, offset=5):
+    """Compile a shift into its weekly bitmap.
+
+    The user is pinged offset minutes before the shift starts and then every hour until offset minutes before the shift ends,
+    keeping the minutes of the shift start. Days are the days the shift starts on, so a shift past midnight carries over into the next day,
+    and sunday's night shift into monday.
+
+    Args:\n
+        days (list): Days the shift starts on, 0 being monday.
+        shift_start (str): "HH:MM" time the shift starts at.
+        shift_end (str): "HH:MM" time the shift ends at.
+        offset (int, optional): minutes before the hour to send the message. Defaults to 5.
+
+    Returns:\n
+        int: The weekly bitmap.
+    """
+    start = parse_time(shift_start)
+    duration = (parse_time(shift_end) - start) % MINUTES_PER_DAY
+    if not duration:
+        return 0
+    day_mask = 0
+    for hour in range(duration // 60 + 1):
+        day_mask |= 1 << (start - offset + hour * 60) % MINUTES_PER_WEEK
+    mask = 0
+    for day in days:
+        mask |= rotate(day_mask, day * MINUTES_PER_DAY)
+    return mask
+
+
+def rotate(mask, minutes):
+    """Move every bit of a weekly bitmap, wrapping around the end of the week.
+
+    Args:\n
+        mask (int): The weekly bitmap.
+        minutes (int): Minutes to move the bits forward, negative to move them back.
+
+    Returns:\n
+        int: The moved bitmap.
+    """
+    minutes %= MINUTES_PER_WEEK
+    full = (1 << MINUTES_PER_WEEK) - 1
+    return ((mask << minutes) | (mask >> (MINUTES_PER_WEEK - minutes))) & full
+
+
+def minute_of_week(slot):
+    """Convert a (day_of_week, hour, minute) slot into its bit in the weekly bitmap.
+
+    Args:\n
+        slot (tuple): A (day_of_week, hour, minute) tuple.
+
+    Returns:\n
+        int: Minutes since monday 00:00.
+    """
+    day, hour, minute = slot
+    return day * MINUTES_PER_DAY + hour * 60 + minute
+
+
+def slot_start(slot, now=None):
+    """Get the time a UTC slot last started at.
+
+    Args:\n
+        slot (tuple): A (day_of_week, hour, minute) tuple.
+        now (float, optional): Timestamp to look back from. Defaults to None, now.
+
+    Returns:\n
+        float: Timestamp of the start of the slot's latest minute, at or before now.
+    """
+    now = time.time() if now is None else now
+    moment = datetime.datetime.fromtimestamp(now, datetime.timezone.utc)
+    back = (minute_of_week((moment.weekday(), moment.hour, moment.minute)) - minute_of_week(slot)) % MINUTES_PER_WEEK
+    return (now // 60 - back) * 60
+
+
+def mask_slots(mask):
+    """List the slots set in a weekly bitmap.
+
+    Args:\n
+        mask (int): The weekly bitmap.
+
+    Returns:\n
+        list: List of (day_of_week, hour, minute) tuples.
+    """
+    # Scanning the binary string is much cheaper than clearing the bits one by one on a 10080 bit int
+    bits = bin(mask)[:1:-1]
+    slots = []
+    minutes = bits.find("1")
+    while minutes != -1:
+        slots.append(SLOTS[minutes])
+        minutes = bits.find("1", minutes + 1)
+    return slots
+
+
+def window(start, end):
+    """Build the bitmap of the minutes between two points of the week.
+
+    Args:\n
+        start (int): First minute of the window, in minutes since monday 00:00.
+        end (int): Minute the window ends at, excluded. Smaller than start for windows wrapping past sunday.
+
+    Returns:\n
+        int: The window bitmap.
+    """
+    length = (end - start) % MINUTES_PER_WEEK
+    return rotate((1 << length) - 1, start)
+
+
+class Shift():
+    __slots__ = ("days", "start", "end", "tz")
+
+    def __init__(self, days, start, end, tz=None):
+        """Normalized work shift of a subscriber
+
+        Args:\n
+            days (list): Days the shift starts on, 0 being monday.
+            start (str): "HH:MM" time the shift starts at.
+            end (str): "HH:MM" time the shift ends at.
+            tz (str, optional): IANA name of the timezone of the shift. Defaults to None, the DEFAULT_TIMEZONE.
+        """
+        self.days = tuple(sorted(days))
+        self.start = start
+        self.end = end
+        self.tz = tz
+
+    @property
+    def timezone(self):
+        """str: IANA name of the timezone of the shift."""
+        return self.tz or DEFAULT_TIMEZONE
+
+    @classmethod
+    def from_inputs(cls, inputs):
+        """Build a shift from the subscription card inputs.
+
+        Args:\n
+            inputs (dict): Subscription card inputs.
+
+        Returns:\n
+            Shift: The normalized shift, in the default timezone if the card has no known timezone.
+        """
+        tz = inputs.get("timezone")
+        return cls(shift_days(inputs), inputs["shiftstart"], inputs["shiftend"], tz if valid_timezone(tz) else None)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a shift from its record in the users file.
+
+        Args:\n
+            data (dict): The record, see to_dict.
+
+        Returns:\n
+            Shift: The shift, in the default timezone if the record has none.
+        """
+        return cls(data["days"], data["start"], data["end"], data.get("tz"))
+
+    def to_dict(self):
+        """Convert the shift into its record in the users file.
+
+        Returns:\n
+            dict: The days, start and end of the shift, and its timezone when it has one.
+        """
+        data = {"days": list(self.days), "start": self.start, "end": self.end}
+        if self.tz:
+            data["tz"] = self.tz
+        return data
+
+    def to_inputs(self):
+        """Convert the shift back into subscription card inputs, to prefill the card.
+
+        Returns:\n
+            dict: Subscription card inputs.
+        """
+        inputs = {f"day{day}": str(day in self.days).lower() for day in range(7)}
+        inputs.update(shiftstart=self.start, shiftend=self.end, timezone=self.timezone)
+        return inputs
+
+    def mask(self, offset=5, at=None):
+        """Compile the shift into its weekly bitmap in UTC.
+
+        The bitmap uses the offset of the shift's timezone at the given moment,
+        it has to be compiled again when the timezone changes its offset, see transitions.
+
+        Args:\n
+            offset (int, optional): minutes before the hour to send the message. Defaults to 5.
+            at (float, optional): Timestamp the offset of the timezone is taken at. Defaults to None, now.
+
+        Returns:\n
+            int: The weekly bitmap.
+        """
+        return rotate(compile_mask(self.days, self.start, self.end, offset), -utc_offset(self.tz, at))
+
+    def slots(self, offset=5, at=None):
+        """List every weekly UTC slot in which the user has to be pinged.
+
+        Args:\n
+            offset (int, optional): minutes before the hour to send the message. Defaults to 5.
+            at (float, optional): Timestamp the offset of the timezone is taken at. Defaults to None, now.
+
+        Returns:\n
+            list: List of (day_of_week, hour, minute) tuples.
+        """
+        return mask_slots(self.mask(offset, at))
+
+
+class PlainUnpickler(pickle.Unpickler):
+    """Unpickler restricted to the builtin containers, strings and numbers."""
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed")
+
+
+class SlotIndex():
+    def __init__(self):
+        """Index of the users due in each time slot
+
+        Keeps the weekly bitmap of every user next to a slot -> users mapping,
+        so the users due in a slot are a single lookup and a user can be reindexed in O(their slots).
+        The users due anywhere in a span of the week are found with a bitwise and of their bitmaps, see due_within.
+        """
+        self._slots = {}  # (day_of_week, hour, minute) -> set of personIds
+        self._masks = {}  # personId -> weekly bitmap
+
+    def __len__(self):
+        return len(self._slots)
+
+    def dump(self, file):
+        """Write the index to a binary file.
+
+        Args:\n
+            file (file): File opened for binary writing.
+        """
+        pickle.dump((self._slots, self._masks), file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, file):
+        """Read an index written by dump.
+
+        Only plain containers, strings and ints are accepted, any other object in the file is rejected.
+
+        Args:\n
+            file (file): File opened for binary reading.
+
+        Returns:\n
+            SlotIndex: The index.
+
+        Raises:\n
+            UnpicklingError: When the file holds anything else than an index.
+        """
+        index = cls()
+        index._slots, index._masks = PlainUnpickler(file).load()
+        return index
+
+    def add(self, personId, mask):
+        """Index the weekly bitmap of a user, replacing any previous one.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+            mask (int): The user's weekly bitmap.
+        """
+        self.discard(personId)
+        if mask:
+            self._masks[personId] = mask
+            for slot in mask_slots(mask):
+                self._slots.setdefault(slot, set()).add(personId)
+
+    def discard(self, personId):
+        """Remove a user from the index.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+
+        Returns:\n
+            list: The slots the user was indexed in.
+        """
+        slots = mask_slots(self._masks.pop(personId, 0))
+        for slot in slots:
+            bucket = self._slots[slot]
+            bucket.discard(personId)
+            if not bucket:
+                del self._slots[slot]
+        return slots
+
+    def mask(self, personId):
+        """Get the weekly bitmap of a user.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+
+        Returns:\n
+            int: The weekly bitmap, 0 if the user is not indexed.
+        """
+        return self._masks.get(personId, 0)
+
+    def masks(self):
+        """Get the weekly bitmap of every user.
+
+        Returns:\n
+            dict: personId -> weekly bitmap.
+        """
+        return dict(self._masks)
+
+    def user_slots(self, personId):
+        """Get the slots a user is indexed in.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+
+        Returns:\n
+            list: List of (day_of_week, hour, minute) tuples.
+        """
+        return mask_slots(self._masks.get(personId, 0))
+
+    def due(self, slot):
+        """Find the users that have to be pinged in a time slot.
+
+        Args:\n
+            slot (tuple): A (day_of_week, hour, minute) tuple.
+
+        Returns:\n
+            list: List of personIds.
+        """
+        return list(self._slots.get(slot, ()))
+
+    def due_within(self, span):
+        """Find the users that have to be pinged anywhere in a span of the week.
+
+        Args:\n
+            span (int): Bitmap of the span, see window.
+
+        Returns:\n
+            list: List of personIds.
+        """
+        return [personId for personId, mask in self._masks.items() if mask & span]
+
+    def slots(self):
+        """List every slot with at least one user.
+
+        Returns:\n
+            list: List of (day_of_week, hour, minute) tuples.
+        """
+        return list(self._slots)
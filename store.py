@@ -0,0 +1,730 @@
+"""Subscriber storage for Hermes
+
+    Keeps the users file in memory and persists changes in the background,
+    so commands never have to parse or rewrite the whole file.
+"""
+import os
+import json
+import atexit
+import pickle
+import hashlib
+import sqlite3
+import tempfile
+import threading
+
+from shifts import Shift, SlotIndex, PlainUnpickler, utc_offset
+
+SCHEMA_VERSION = 3  # Version of the users file format, see parse_users
+
+
+class Subscriber():
+    __slots__ = ("id", "displayName", "firstName", "nickName", "email", "shift", "delivery")
+
+    def __init__(self, id, displayName=None, firstName=None, nickName=None, email=None, shift=None, delivery=None):
+        """Compact record of a subscriber
+
+        Holds only the details the bot uses instead of the whole Webex person.
+
+        Args:\n
+            id (str): Unique identifier of the user.
+            displayName (str, optional): Full name of the user. Defaults to None.
+            firstName (str, optional): First name of the user. Defaults to None.
+            nickName (str, optional): Nickname of the user. Defaults to None.
+            email (str, optional): Main email of the user. Defaults to None.
+            shift (Shift, optional): Work shift of the user, None until the subscription card is submitted. Defaults to None.
+            delivery (str, optional): "room" to be reminded in the team space, None for direct messages. Defaults to None.
+        """
+        self.id = id
+        self.displayName = displayName
+        self.firstName = firstName
+        self.nickName = nickName
+        self.email = email
+        self.shift = shift
+        self.delivery = delivery
+
+    @property
+    def name(self):
+        """str: The name used to greet the user, the first word of the nickname or else the first name."""
+        if self.nickName:
+            return self.nickName.split(" ")[0]
+        return self.firstName or self.displayName or ""
+
+    @classmethod
+    def from_person(cls, person, shift=None, delivery=None):
+        """Build a subscriber from a Webex person.
+
+        Args:\n
+            person (Person): The person returned by the API.
+            shift (Shift, optional): Work shift of the user. Defaults to None.
+            delivery (str, optional): "room" to be reminded in the team space, None for direct messages. Defaults to None.
+
+        Returns:\n
+            Subscriber: The compact record.
+        """
+        emails = getattr(person, "emails", None) or [None]
+        return cls(person.id,
+                   displayName=getattr(person, "displayName", None),
+                   firstName=getattr(person, "firstName", None),
+                   nickName=getattr(person, "nickName", None),
+                   email=emails[0],
+                   shift=shift,
+                   delivery=delivery)
+
+    @classmethod
+    def from_dict(cls, personId, data):
+        """Build a subscriber from its record in the users file.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+            data (dict): The record, see to_dict.
+
+        Returns:\n
+            Subscriber: The compact record.
+        """
+        shift = Shift.from_dict(data["shift"]) if data.get("shift") else None
+        return cls(personId, data.get("displayName"), data.get("firstName"), data.get("nickName"), data.get("email"), shift, data.get("delivery"))
+
+    @classmethod
+    def from_v1(cls, personId, data):
+        """Build a subscriber from a version 1 record, which held the whole Webex person and the raw card inputs.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+            data (dict): The version 1 record.
+
+        Returns:\n
+            Subscriber: The compact record.
+        """
+        subscription = data.get("subscription")
+        try:
+            shift = Shift.from_inputs(subscription) if subscription else None
+        except (KeyError, AttributeError, ValueError):
+            shift = None
+        emails = data.get("emails") or [None]
+        return cls(personId, data.get("displayName"), data.get("firstName"), data.get("nickName"), emails[0], shift)
+
+    def to_dict(self):
+        """Convert the subscriber into its record in the users file, leaving out the empty fields.
+
+        Returns:\n
+            dict: The record, without the personId, which is the key of the record.
+        """
+        data = {key: getattr(self, key) for key in ("displayName", "firstName", "nickName", "email", "delivery") if getattr(self, key)}
+        if self.shift:
+            data["shift"] = self.shift.to_dict()
+        return data
+
+
+def parse_users(data):
+    """Read the users block of a users file, migrating older versions.
+
+    Version 1 files have no version key and store whole Webex people with the raw card inputs under "subscription",
+    version 2 files store compact subscriber records with a normalized "shift",
+    version 3 files may hold the timezone of the shift, shifts without one are in the default timezone.
+
+    Args:\n
+        data (dict): The users file contents.
+
+    Returns:\n
+        tuple: (dict of personId -> Subscriber, bool True if the data was migrated from an older version).
+    """
+    version = data.get("version", 1)
+    users = data.get("users", {})
+    if version < 2:
+        return {personId: Subscriber.from_v1(personId, record) for personId, record in users.items()}, bool(users)
+    return {personId: Subscriber.from_dict(personId, record) for personId, record in users.items()}, version < SCHEMA_VERSION and bool(users)
+
+
+class UserStore():
+    def __init__(self, filepath, flush_interval=2.0, cache_path=None):
+        """In-memory users store with write-behind persistence
+
+        The users file is loaded once into Subscriber records, every change is applied to the in-memory copy and marked as dirty,
+        a background thread then writes the pending changes every flush_interval seconds.
+        Writes go to a temporary file that replaces the users file, so a crash mid-write never corrupts it.
+        Every subscription is compiled into its weekly bitmap and indexed as the users are loaded and changed.
+        Files in an older format are migrated when loaded and written back in the current format.
+        When a cache_path is given the index is saved there on close, tagged with the checksum of the users file,
+        and loaded from there on the next start instead of being rebuilt if the users file did not change.
+
+        Args:\n
+            filepath (str): String containing the relative or full path to the users file.
+            flush_interval (float, optional): Seconds to wait between writes to disk. Defaults to 2.0.
+            cache_path (str, optional): Path of the index cache. Defaults to None, rebuilding the index on every start.
+        """
+        self.filepath = filepath
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()  # Keeps concurrent flushes from writing out of order
+        self._dirty = False
+        self._stop = threading.Event()
+        self.cache_path = cache_path
+        self.checksum = None  # sha256 of the users file as last read or written
+        self._cached = None  # checksum the index cache was saved or loaded with
+        self.index = SlotIndex()
+        self.users = self.read()
+        if not self.load_index():
+            self.reindex()
+        self._flusher = threading.Thread(target=self._flush_loop, name="hermes-store-flush", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def read(self):
+        """Load the users file from disk.
+
+        Returns:\n
+            dict: personId -> Subscriber, empty if the file is missing or empty.
+        """
+        try:
+            with open(self.filepath, "rb") as file:
+                raw = file.read()
+            print("Users file found!")
+            self.checksum = hashlib.sha256(raw).hexdigest()
+            data = json.loads(raw)
+        except FileNotFoundError:
+            print("No users file found, creating a new one..")
+            data = {}
+            self._dirty = True
+        except json.JSONDecodeError:
+            data = {}
+        users, migrated = parse_users(data)
+        if migrated:
+            print(f"Migrated {len(users)} users to version {SCHEMA_VERSION} of the users file")
+            self._dirty = True
+        return users
+
+    def reindex(self, personId=None):
+        """Rebuild the slot index.
+
+        Args:\n
+            personId (str, optional): Only reindex this user. Defaults to None, reindexing every user.
+        """
+        with self._lock:
+            personIds = [personId] if personId else list(self.users)
+            for user in personIds:
+                record = self.users.get(user)
+                if record and record.shift:
+                    self.index.add(user, record.shift.mask())
+                else:
+                    self.index.discard(user)
+
+    def cache_header(self):
+        """Describe the index the cache has to hold to be used.
+
+        The index depends on the users file and on the current UTC offsets of the users' timezones,
+        so a cache saved before a daylight saving time change is not used after it.
+
+        Returns:\n
+            dict: Version, checksum of the users file and UTC offset of every timezone in use.
+        """
+        with self._lock:
+            zones = {record.shift.timezone for record in self.users.values() if record.shift}
+        return {"version": SCHEMA_VERSION,
+                "checksum": self.checksum,
+                "offsets": {name: utc_offset(name) for name in sorted(zones)}}
+
+    def load_index(self):
+        """Load the slot index from the cache, if it was saved for the current users file.
+
+        Returns:\n
+            bool: True if the index was loaded.
+        """
+        if not self.cache_path or self._dirty or self.checksum is None:
+            return False
+        try:
+            with open(self.cache_path, "rb") as file:
+                header = PlainUnpickler(file).load()
+                if header != self.cache_header():
+                    return False
+                index = SlotIndex.load(file)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError) as e:
+            print(f"Ignoring the index cache: {e!r}")
+            return False
+        with self._lock:
+            self.index = index
+            self._cached = self.checksum
+        print("Slot index loaded from the cache")
+        return True
+
+    def save_index(self):
+        """Save the slot index to the cache, tagged with the checksum of the users file.
+
+        Nothing is saved while there are changes not written to the users file, or when the cache is already up to date.
+        """
+        if not self.cache_path:
+            return
+        folder = os.path.dirname(os.path.abspath(self.cache_path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".index-", suffix=".tmp", dir=folder)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                with self._lock:
+                    if self._dirty or self.checksum is None or self.checksum == self._cached:
+                        return
+                    pickle.dump(self.cache_header(), file)
+                    self.index.dump(file)
+                    self._cached = self.checksum
+            os.replace(tmp_path, self.cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # --------- Access --------- #
+    @property
+    def data(self):
+        """dict: The users data in the users file format."""
+        with self._lock:
+            return {"version": SCHEMA_VERSION,
+                    "users": {personId: record.to_dict() for personId, record in self.users.items()}}
+
+    def __contains__(self, personId):
+        return personId in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+    def ids(self):
+        """List the personId of every stored user.
+
+        Returns:\n
+            list: List of personIds.
+        """
+        with self._lock:
+            return list(self.users)
+
+    def items(self):
+        """List every stored user with its data.
+
+        Returns:\n
+            list: List of (personId, data) tuples.
+        """
+        with self._lock:
+            return list(self.users.items())
+
+    def get(self, personId, default=None):
+        """Get the stored data for a user.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+            default (optional): Value returned if the user is not stored. Defaults to None.
+
+        Returns:\n
+            Subscriber: The user record.
+        """
+        return self.users.get(personId, default)
+
+    def due(self, day_of_week, hour, minute):
+        """Find the users that have to be pinged in a time slot.
+
+        Args:\n
+            day_of_week (int): Day of the week, 0 being monday.
+            hour (int): Hour of the slot.
+            minute (int): Minute of the slot.
+
+        Returns:\n
+            list: List of personIds.
+        """
+        with self._lock:
+            return self.index.due((day_of_week, hour, minute))
+
+    def slots(self):
+        """List every time slot with at least one user due.
+
+        Returns:\n
+            list: List of (day_of_week, hour, minute) tuples.
+        """
+        with self._lock:
+            return self.index.slots()
+
+    def user_slots(self, personId):
+        """List the time slots in which a user is due.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+
+        Returns:\n
+            list: List of (day_of_week, hour, minute) tuples.
+        """
+        with self._lock:
+            return self.index.user_slots(personId)
+
+    # --------- Changes --------- #
+    def set(self, personId, record):
+        """Add or replace a user.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+            record (Subscriber): Record to store for the user.
+        """
+        with self._lock:
+            self.users[personId] = record
+            self.reindex(personId)
+            self._dirty = True
+
+    def update(self, personId, **fields):
+        """Set fields of a stored user.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+            **fields: Subscriber attributes to set, for instance shift.
+
+        Raises:\n
+            KeyError: When the user is not stored.
+        """
+        with self._lock:
+            record = self.users[personId]
+            for key, value in fields.items():
+                setattr(record, key, value)
+            self.reindex(personId)
+            self._dirty = True
+
+    def remove(self, personId):
+        """Remove a user.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+
+        Returns:\n
+            Subscriber: The removed user record, None if the user was not stored.
+        """
+        with self._lock:
+            record = self.users.pop(personId, None)
+            if record is not None:
+                self.index.discard(personId)
+                self._dirty = True
+            return record
+
+    def replace(self, data):
+        """Replace the whole data set.
+
+        Args:\n
+            data (dict): Users data in the users file format.
+        """
+        with self._lock:
+            self.users = parse_users(data)[0]
+            self.index = SlotIndex()
+            self.reindex()
+            self._dirty = True
+
+    # --------- Persistence --------- #
+    def flush(self):
+        """Write the pending changes to disk.
+
+        The data is serialized under the lock, then written to a temporary file in the same folder
+        which atomically replaces the users file.
+        """
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                payload = json.dumps(self.data, sort_keys=True, indent=4, separators=(",", ": ")).encode()
+                self._dirty = False
+            folder = os.path.dirname(os.path.abspath(self.filepath))
+            fd, tmp_path = tempfile.mkstemp(prefix=".users-", suffix=".tmp", dir=folder)
+            try:
+                with os.fdopen(fd, "wb") as file:
+                    file.write(payload)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp_path, self.filepath)
+                self.checksum = hashlib.sha256(payload).hexdigest()
+            except Exception:
+                self._dirty = True
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"Could not write the users file: {e}")
+
+    def close(self):
+        """Stop the background writer, write any pending changes and save the index cache."""
+        self._stop.set()
+        self.flush()
+        self.save_index()
+
+
+class SQLiteUserStore():
+    schema = """
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            person_id TEXT NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            day_of_week INTEGER NOT NULL,
+            hour INTEGER NOT NULL,
+            minute INTEGER NOT NULL,
+            PRIMARY KEY (person_id, day_of_week, hour, minute)
+        );
+        CREATE INDEX IF NOT EXISTS subscriptions_slot ON subscriptions (day_of_week, hour, minute);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, dbpath, json_path=None):
+        """SQLite users store
+
+        Exposes the same operations as UserStore, every user is kept as a row in the users table
+        and each time slot of its subscription as a row in the subscriptions table,
+        indexed by (day_of_week, hour, minute) so the users due in a slot are an indexed lookup.
+        Changes are committed right away, so there is nothing to flush.
+        Rows written in an older format are migrated when the database is opened.
+
+        Args:\n
+            dbpath (str): String containing the relative or full path to the database file.
+            json_path (str, optional): Users file to import the first time the database is created. Defaults to None.
+        """
+        self.dbpath = dbpath
+        self._lock = threading.RLock()
+        self.db = sqlite3.connect(dbpath, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        self.db.executescript(self.schema)
+        self.upgrade()
+        if json_path:
+            self.migrate_json(json_path)
+        atexit.register(self.close)
+
+    def migrate_json(self, json_path):
+        """Import a users file into the database.
+
+        Runs only once, the import is recorded in the meta table and skipped on the next start.
+
+        Args:\n
+            json_path (str): String containing the relative or full path to the users file.
+
+        Returns:\n
+            int: Number of users imported.
+        """
+        with self._lock:
+            if self.db.execute("SELECT value FROM meta WHERE key = 'migrated_from'").fetchone():
+                return 0
+            try:
+                with open(json_path) as file:
+                    users = parse_users(json.load(file))[0]
+            except (FileNotFoundError, json.JSONDecodeError):
+                users = {}
+            with self.transaction():
+                for personId, record in users.items():
+                    self._write(personId, record)
+                self.db.execute("INSERT INTO meta (key, value) VALUES ('migrated_from', ?)", (json_path,))
+            print(f"Imported {len(users)} users from {json_path}")
+            return len(users)
+
+    def upgrade(self):
+        """Migrate the rows written by an older version of the store."""
+        with self._lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+            version = int(row[0]) if row else 1
+            if version >= SCHEMA_VERSION:
+                return
+            with self.transaction():
+                if version < 2:
+                    rows = self.db.execute("SELECT id, data FROM users").fetchall()
+                    for personId, data in rows:
+                        self._write(personId, Subscriber.from_v1(personId, json.loads(data)))
+                elif version < 3:
+                    # Version 2 slots were in the default timezone instead of UTC
+                    for personId, record in list(self.items()):
+                        self._write(personId, record)
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('schema_version', ?)", (str(SCHEMA_VERSION),))
+
+    def transaction(self):
+        """Context manager wrapping the statements in a single transaction."""
+        return _Transaction(self.db)
+
+    # --------- Access --------- #
+    @property
+    def data(self):
+        """dict: The users data in the users file format."""
+        return {"version": SCHEMA_VERSION,
+                "users": {personId: record.to_dict() for personId, record in self.items()}}
+
+    @property
+    def users(self):
+        """dict: A copy of the users, personId -> Subscriber."""
+        return dict(self.items())
+
+    def __contains__(self, personId):
+        with self._lock:
+            return self.db.execute("SELECT 1 FROM users WHERE id = ?", (personId,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def ids(self):
+        """List the personId of every stored user.
+
+        Returns:\n
+            list: List of personIds.
+        """
+        with self._lock:
+            return [row[0] for row in self.db.execute("SELECT id FROM users")]
+
+    def items(self):
+        """List every stored user with its data.
+
+        Returns:\n
+            list: List of (personId, data) tuples.
+        """
+        with self._lock:
+            return [(row[0], Subscriber.from_dict(row[0], json.loads(row[1]))) for row in self.db.execute("SELECT id, data FROM users")]
+
+    def get(self, personId, default=None):
+        """Get the stored data for a user.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+            default (optional): Value returned if the user is not stored. Defaults to None.
+
+        Returns:\n
+            Subscriber: The user record.
+        """
+        with self._lock:
+            row = self.db.execute("SELECT data FROM users WHERE id = ?", (personId,)).fetchone()
+        return Subscriber.from_dict(personId, json.loads(row[0])) if row else default
+
+    def due(self, day_of_week, hour, minute):
+        """Find the users that have to be pinged in a time slot.
+
+        Args:\n
+            day_of_week (int): Day of the week, 0 being monday.
+            hour (int): Hour of the slot.
+            minute (int): Minute of the slot.
+
+        Returns:\n
+            list: List of personIds.
+        """
+        with self._lock:
+            rows = self.db.execute("SELECT person_id FROM subscriptions WHERE day_of_week = ? AND hour = ? AND minute = ?",
+                                   (day_of_week, hour, minute))
+            return [row[0] for row in rows]
+
+    def slots(self):
+        """List every time slot with at least one user due.
+
+        Returns:\n
+            list: List of (day_of_week, hour, minute) tuples.
+        """
+        with self._lock:
+            return [tuple(row) for row in self.db.execute("SELECT DISTINCT day_of_week, hour, minute FROM subscriptions")]
+
+    def user_slots(self, personId):
+        """List the time slots in which a user is due.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+
+        Returns:\n
+            list: List of (day_of_week, hour, minute) tuples.
+        """
+        with self._lock:
+            rows = self.db.execute("SELECT day_of_week, hour, minute FROM subscriptions WHERE person_id = ?", (personId,))
+            return [tuple(row) for row in rows]
+
+    # --------- Changes --------- #
+    def _write(self, personId, record):
+        self.db.execute("INSERT OR REPLACE INTO users (id, data) VALUES (?, ?)", (personId, json.dumps(record.to_dict())))
+        self.db.execute("DELETE FROM subscriptions WHERE person_id = ?", (personId,))
+        if record.shift:
+            slots = record.shift.slots()
+            self.db.executemany("INSERT OR IGNORE INTO subscriptions (person_id, day_of_week, hour, minute) VALUES (?, ?, ?, ?)",
+                                [(personId, *slot) for slot in slots])
+
+    def set(self, personId, record):
+        """Add or replace a user.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+            record (Subscriber): Record to store for the user.
+        """
+        with self._lock, self.transaction():
+            self._write(personId, record)
+
+    def reindex(self, personId=None):
+        """Write the subscription slots again, after the UTC offset of a timezone changed.
+
+        Args:\n
+            personId (str, optional): Only reindex this user. Defaults to None, reindexing every user.
+        """
+        with self._lock:
+            records = [(personId, self.get(personId))] if personId else list(self.items())
+            with self.transaction():
+                for user, record in records:
+                    if record:
+                        self._write(user, record)
+
+    def update(self, personId, **fields):
+        """Set fields of a stored user.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+            **fields: Subscriber attributes to set, for instance shift.
+
+        Raises:\n
+            KeyError: When the user is not stored.
+        """
+        with self._lock:
+            record = self.get(personId)
+            if record is None:
+                raise KeyError(personId)
+            for key, value in fields.items():
+                setattr(record, key, value)
+            self.set(personId, record)
+
+    def remove(self, personId):
+        """Remove a user.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+
+        Returns:\n
+            Subscriber: The removed user record, None if the user was not stored.
+        """
+        with self._lock:
+            record = self.get(personId)
+            if record is not None:
+                with self.transaction():
+                    self.db.execute("DELETE FROM users WHERE id = ?", (personId,))
+            return record
+
+    def replace(self, data):
+        """Replace the whole data set.
+
+        Args:\n
+            data (dict): Users data in the users file format.
+        """
+        with self._lock, self.transaction():
+            self.db.execute("DELETE FROM users")
+            for personId, record in parse_users(data)[0].items():
+                self._write(personId, record)
+
+    # --------- Persistence --------- #
+    def flush(self):
+        """Nothing to do, every change is committed as soon as it is made."""
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self.db.close()
+
+
+class _Transaction():
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN")
+        return self.db
+
+    def __exit__(self, exc_type, *_):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
@@ -0,0 +1,179 @@
+"""Adaptive card templates for Hermes
+
+    Loads the card files once, reloads them when they change on disk and keeps the rendered cards
+    serialized, ready to be sent.
+"""
+import os
+import re
+import json
+import time
+import threading
+from collections import OrderedDict
+
+CARD_CONTENT_TYPE = "application/vnd.microsoft.card.adaptive"
+PLACEHOLDER = re.compile(r"\$\{(\w+)\}")
+
+
+class CardTemplate():
+    def __init__(self, name, path):
+        """Adaptive card loaded from a json file
+
+        The card may contain ${variable} placeholders in its strings, which are filled in by render.
+
+        Args:\n
+            name (str): Name the card is registered with.
+            path (str): String containing the relative or full path to the card file.
+
+        Raises:\n
+            ValueError: When the file is not a valid adaptive card.
+        """
+        self.name = name
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        with open(path) as file:
+            self.content = json.load(file)
+        self.validate()
+        # The serialized card split around its placeholders: text, variable, text, variable, ..., text
+        self.parts = PLACEHOLDER.split(json.dumps(self.content, separators=(",", ":")))
+        self.variables = set(self.parts[1::2])
+
+    def validate(self):
+        """Check the card is an adaptive card.
+
+        Raises:\n
+            ValueError: When the card is missing its type, version or body.
+        """
+        if self.content.get("type") != "AdaptiveCard":
+            raise ValueError(f"{self.path} is not an AdaptiveCard")
+        if not self.content.get("version"):
+            raise ValueError(f"{self.path} has no card version")
+        if not isinstance(self.content.get("body"), list):
+            raise ValueError(f"{self.path} has no card body")
+
+    def render(self, values):
+        """Serialize the attachment of the card with its placeholders filled in.
+
+        Args:\n
+            values (dict): Variable name -> value, missing variables are left empty.
+
+        Returns:\n
+            str: The serialized attachment.
+        """
+        parts = list(self.parts)
+        for num in range(1, len(parts), 2):
+            parts[num] = json.dumps(str(values.get(parts[num], "")))[1:-1]
+        return f'{{"contentType":"{CARD_CONTENT_TYPE}","content":{"".join(parts)}}}'
+
+
+class CardRegistry():
+    def __init__(self, cards, check_interval=1.0, cache_size=4096):
+        """Registry of the adaptive cards used by the bot
+
+        Every card is loaded and validated once, then reloaded when its file changes, checking the modification time at most every check_interval seconds.
+        A card that fails to reload keeps its previous version.
+        Rendered attachments are kept serialized in an LRU cache keyed by the card and its variables,
+        so sending the same card to the same user again costs no parsing or serializing.
+
+        Args:\n
+            cards (dict): Card name -> path of the card file.
+            check_interval (float, optional): Seconds between checks for changed files. Defaults to 1.0.
+            cache_size (int, optional): Maximum rendered attachments kept. Defaults to 4096.
+
+        Raises:\n
+            ValueError: When a card file is not a valid adaptive card.
+        """
+        self.check_interval = check_interval
+        self.cache_size = cache_size
+        self.templates = {name: CardTemplate(name, path) for name, path in cards.items()}
+        self._checked = {name: time.monotonic() for name in cards}
+        self._broken = {}  # card -> modification time of the file that failed to load
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def template(self, card):
+        """Get a card template, reloading it if its file changed.
+
+        Args:\n
+            card (str): Name of the card.
+
+        Returns:\n
+            CardTemplate: The current template.
+        """
+        template = self.templates[card]
+        now = time.monotonic()
+        if now - self._checked[card] < self.check_interval:
+            return template
+        self._checked[card] = now
+        mtime = None
+        try:
+            mtime = os.stat(template.path).st_mtime
+            if mtime != template.mtime and mtime != self._broken.get(card):
+                template = self.templates[card] = CardTemplate(card, template.path)
+                print(f"Reloaded the {card} card")
+        except (OSError, ValueError) as e:
+            self._broken[card] = mtime
+            print(f"Could not reload the {card} card, keeping the previous one: {e}")
+        return template
+
+    def card(self, card):
+        """Get the content of a card.
+
+        Args:\n
+            card (str): Name of the card.
+
+        Returns:\n
+            dict: The card content, without its placeholders filled in.
+        """
+        return self.template(card).content
+
+    def render(self, card, **values):
+        """Get the serialized attachment of a card.
+
+        Args:\n
+            card (str): Name of the card.
+            **values: Values for the card variables.
+
+        Returns:\n
+            str: The serialized attachment.
+        """
+        template = self.template(card)
+        key = (card, template.mtime, tuple(sorted((var, values.get(var)) for var in template.variables)))
+        with self._lock:
+            attachment = self._cache.get(key)
+            if attachment is not None:
+                self._cache.move_to_end(key)
+                return attachment
+        attachment = template.render(values)
+        with self._lock:
+            self._cache[key] = attachment
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return attachment
+
+    def attachment(self, card, **values):
+        """Get the attachment of a card, to be sent through the SDK.
+
+        Args:\n
+            card (str): Name of the card.
+            **values: Values for the card variables.
+
+        Returns:\n
+            dict: The attachment.
+        """
+        return json.loads(self.render(card, **values))
+
+    def message(self, card, text, toPersonId=None, roomId=None, **values):
+        """Serialize a whole message carrying a card, ready to be posted to /messages.
+
+        Args:\n
+            card (str): Name of the card.
+            text (str): Fallback text for clients that can not show cards.
+            toPersonId (str, optional): Unique identifier of the recipient. Defaults to None.
+            roomId (str, optional): Unique identifier of the space, used when there is no toPersonId. Defaults to None.
+            **values: Values for the card variables.
+
+        Returns:\n
+            str: The serialized message.
+        """
+        target = f'"toPersonId":{json.dumps(toPersonId)}' if toPersonId else f'"roomId":{json.dumps(roomId)}'
+        return f'{{{target},"text":{json.dumps(text)},"attachments":[{self.render(card, **values)}]}}'
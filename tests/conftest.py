@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import shutil
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+from hermes import Hermess  # noqa: E402
+from fake_webex import FakeWebex  # noqa: E402
+from roster import write_roster  # noqa: E402
+
+
+@pytest.fixture
+def fake():
+    """Fake Webex API served from a background thread."""
+    fake = FakeWebex()
+    server = fake.serve(port=0)
+    fake.url = f"http://localhost:{server.server_port}/v1"
+    yield fake
+    server.shutdown()
+
+
+@pytest.fixture
+def bot(fake, tmp_path, monkeypatch):
+    """Bot set up against the fake Webex API with a synthetic roster, without running the webhook server."""
+    for card in ("subscription.json", "notification.json"):
+        shutil.copy(os.path.join(ROOT, card), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    write_roster("peopletonotify.json", 200, seed=1)
+    monkeypatch.setenv("HERMES_API_URL", fake.url)
+    monkeypatch.setenv("TEAMS_BOT_TOKEN", "fake")
+    monkeypatch.setenv("HERMES_CATCHUP", "off")
+    monkeypatch.setenv("HERMES_STORE", "json")
+    bot = object.__new__(Hermess)
+    bot.started = time.perf_counter()
+    bot.configure()
+    bot.api = bot.webex_api()
+    bot.start_services()
+    bot.users_loaded.result()
+    bot.schedule_ready.result()
+    yield bot
+    bot.dispatcher.stop()
+    bot.snoozes.stop()
+    bot.sched.shutdown(wait=False)
+    bot.store.close()
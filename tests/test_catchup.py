@@ -0,0 +1,233 @@
+import random
+import datetime
+from types import SimpleNamespace
+import pytest
+from catchup import CatchUp, SECONDS_PER_WEEK
+from shifts import minute_of_week
+from hermes import Hermess
+
+UTC = datetime.timezone.utc
+MONDAY = datetime.datetime(2024, 1, 1, tzinfo=UTC).timestamp()  # Monday 00:00 UTC
+
+
+class Clock():
+    def __init__(self, now):
+        """Fake clock the tests move by hand.
+
+        Args:\n
+            now (float): Starting timestamp.
+        """
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def at(day, hour, minute, second=0):
+    """Get the timestamp of a moment in the test week.
+
+    Returns:\n
+        float: Timestamp of that moment, days past 6 falling in the following weeks.
+    """
+    return MONDAY + ((day * 24 + hour) * 60 + minute) * 60 + second
+
+
+def mask(*slots):
+    """Build a weekly bitmap out of (day_of_week, hour, minute) slots.
+
+    Returns:\n
+        int: The weekly bitmap.
+    """
+    return sum(1 << minute_of_week(slot) for slot in slots)
+
+
+@pytest.fixture
+def clock():
+    return Clock(at(0, 8, 0))
+
+
+@pytest.fixture
+def catchup(tmp_path, clock):
+    return CatchUp(str(tmp_path / "heartbeat"), UTC, clock=clock, rng=random.Random(7))
+
+
+def restart(catchup):
+    """Start a new CatchUp on the same heartbeat file, as after a restart of the bot."""
+    return CatchUp(catchup.path, catchup.timezone, interval=catchup.interval, jitter=catchup.jitter, grace=catchup.grace,
+                   clock=catchup.clock, rng=catchup.rng)
+
+
+def test_no_gap(catchup, clock):
+    assert catchup.beat() is None  # First run ever, nothing was missed
+    for _ in range(10):
+        clock.advance(catchup.interval)
+        assert catchup.beat() is None
+    assert restart(catchup).last_seen() == clock.now
+
+
+def test_quick_restart_across_a_slot(catchup, clock):
+    clock.now = at(0, 9, 54, 30)
+    catchup.beat()
+    clock.now = at(0, 9, 56)
+    catchup = restart(catchup)
+
+    since, until = catchup.beat(restart=True)
+
+    assert catchup.missed(mask((0, 9, 55)), since, until) == 1
+
+
+def test_restart_within_the_minute_of_the_last_beat(catchup, clock):
+    clock.now = at(0, 9, 54, 30)
+    catchup.beat()
+    clock.now = at(0, 9, 54, 50)
+
+    assert restart(catchup).beat(restart=True) is None
+
+
+def test_restart_after_a_slot_was_sent(catchup, clock):
+    clock.now = at(0, 9, 54, 30)
+    catchup.beat()
+    catchup.handled(at(0, 9, 55))  # The 09:55 reminders went out, then the bot went down
+    catchup.handled(at(0, 9, 50))  # Older slots do not move it back
+    clock.now = at(0, 10, 30)
+    catchup = restart(catchup)
+
+    since, until = catchup.beat(restart=True)
+
+    assert since == at(0, 9, 55)
+    assert catchup.missed(mask((0, 9, 55), (0, 10, 15)), since, until) == 1
+
+
+def test_restart_gap(catchup, clock):
+    catchup.beat()
+    clock.advance(2 * 60 * 60)
+    catchup = restart(catchup)
+
+    since, until = catchup.beat(restart=True)
+
+    assert (since, until) == (at(0, 8, 0), at(0, 10, 0))
+    masks = {"a": mask((0, 8, 55), (0, 9, 55), (0, 10, 55)), "b": mask((0, 10, 55)), "c": mask((0, 8, 0))}
+    assert {personId: count for personId, count, _ in catchup.plan(masks, since, until)} == {"a": 2}
+
+
+def test_restart_catches_up_to_the_restart(catchup, clock):
+    bot = object.__new__(Hermess)
+    bot.catchup = catchup
+    bot.misfire_grace = 60
+    calls = []
+    bot.catch_up = lambda since, until: calls.append((since, until))
+    bot.heartbeat(restart=True)
+    clock.advance(30 * 60)
+    bot.catchup = restart(catchup)
+
+    bot.heartbeat(restart=True)
+
+    assert calls == [(at(0, 8, 0), at(0, 8, 30))]
+
+
+def test_stall_leaves_the_misfire_grace_to_the_jobs(catchup, clock):
+    bot = object.__new__(Hermess)
+    bot.catchup = catchup
+    bot.misfire_grace = 60
+    calls = []
+    bot.catch_up = lambda since, until: calls.append((since, until))
+    bot.heartbeat()
+    clock.now = at(0, 9, 55, 30)  # The scheduler was stalled, the 09:55 job still runs within its misfire grace
+
+    bot.heartbeat()
+
+    assert calls == [(at(0, 8, 0), at(0, 9, 54, 30))]
+    since, until = calls[0]
+    assert catchup.missed(mask((0, 8, 55), (0, 9, 55)), since, until) == 1
+
+
+def test_stall_shorter_than_two_beats(catchup, clock):
+    clock.now = at(0, 9, 54, 30)
+    catchup.beat()
+    clock.now = at(0, 9, 56, 10)  # The 09:55 job was 70s late, past the grace, the scheduler dropped it
+
+    since, until = catchup.beat()
+
+    assert (since, until) == (at(0, 9, 54, 30), at(0, 9, 55, 10))
+    assert catchup.missed(mask((0, 9, 55), (0, 9, 56)), since, until) == 1
+
+
+def test_stall_within_the_grace(catchup, clock):
+    clock.now = at(0, 9, 54, 30)
+    catchup.beat()
+    catchup.handled(at(0, 9, 55))  # The 09:55 job ran late, but within the grace
+    clock.now = at(0, 9, 56, 40)
+
+    assert catchup.beat() is None
+
+
+def test_beats_start_half_a_minute_after_the_grace(catchup):
+    assert catchup.next_beat(at(0, 9, 54, 10)) == at(0, 9, 54, 30)
+    assert catchup.next_beat(at(0, 9, 54, 30)) == at(0, 9, 54, 30)
+    assert catchup.next_beat(at(0, 9, 54, 45)) == at(0, 9, 55, 30)
+    catchup.grace = 45
+    assert catchup.next_beat(at(0, 9, 54, 10)) == at(0, 9, 54, 15)
+
+
+def test_outage_longer_than_a_week(catchup, clock):
+    catchup.beat()
+    clock.advance(SECONDS_PER_WEEK + 2 * 60 * 60)
+    catchup = restart(catchup)
+
+    since, until = catchup.beat(restart=True)
+
+    weekly = mask((0, 8, 55), (2, 14, 0), (6, 23, 59))
+    assert catchup.missed(weekly, since, until) == 3 + 1  # Every slot of the full week, plus monday 08:55 again
+    assert catchup.missed(weekly, since, since + 2 * SECONDS_PER_WEEK) == 6
+    assert catchup.missed(weekly, until, since) == 0
+
+
+def test_outage_wrapping_past_sunday(catchup, clock):
+    clock.now = at(6, 23, 0)
+    catchup.beat()
+    clock.advance(2 * 60 * 60)
+    catchup = restart(catchup)
+
+    since, until = catchup.beat(restart=True)
+
+    assert catchup.missed(mask((6, 23, 30), (0, 0, 30), (0, 1, 30), (6, 22, 0)), since, until) == 2
+
+
+def test_jitter_bounds(catchup, clock):
+    masks = {f"user{num}": mask((0, 8, 55)) for num in range(500)}
+
+    plan = catchup.plan(masks, at(0, 8, 0), at(0, 9, 0))
+
+    delays = [delay for _, _, delay in plan]
+    assert len(plan) == 500
+    assert all(0 <= delay <= catchup.jitter for delay in delays)
+    assert delays == sorted(delays)
+    assert max(delays) - min(delays) > catchup.jitter / 2  # Spread over the window, not bunched up at the start
+    again = CatchUp(catchup.path, UTC, clock=clock, rng=random.Random(7)).plan(masks, at(0, 8, 0), at(0, 9, 0))
+    assert again == plan
+
+
+def test_no_jitter(tmp_path, clock):
+    catchup = CatchUp(str(tmp_path / "heartbeat"), UTC, jitter=0, clock=clock)
+
+    plan = catchup.plan({"a": mask((0, 8, 55)), "b": mask((0, 8, 56))}, at(0, 8, 0), at(0, 9, 0))
+
+    assert [delay for _, _, delay in plan] == [0, 0]
+
+
+def test_reminder_jobs_record_the_slot_they_ran_for(bot):
+    slot_job = next(job for job in bot.sched.get_jobs() if job.id.startswith("slot:"))
+    due = datetime.datetime(2024, 1, 1, 9, 55, tzinfo=UTC)
+    handled = bot.catchup.last_handled
+
+    bot.record_handled(SimpleNamespace(job_id="purge", scheduled_run_times=[due]))
+    assert bot.catchup.last_handled == handled
+    bot.record_handled(SimpleNamespace(job_id=slot_job.id, scheduled_run_times=[due]))
+
+    assert bot.catchup.last_handled == due.timestamp()
+    assert bot.catchup.read()[1] == due.timestamp()
+    heartbeat = bot.sched.get_job("heartbeat")
+    assert heartbeat.next_run_time.second == 30
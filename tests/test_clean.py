@@ -0,0 +1,19 @@
+from fake_webex import BOT_ID
+
+
+def test_clean_room_reports_its_progress_in_the_space(bot, fake, monkeypatch):
+    monkeypatch.setattr(bot.broadcaster.bucket, "acquire", lambda *args, **kwargs: True)  # Not testing the rate limit
+    for num in range(250):
+        bot.api.messages.create(roomId="room-x", markdown=f"Reminder {num}")
+    fake.messages["user-message"] = {"id": "user-message", "roomId": "room-x", "personId": "someone", "text": "hi"}
+    edits = []
+    edit = bot.api.messages.edit
+    monkeypatch.setattr(bot.api.messages, "edit", lambda messageId, **kwargs: edits.append(kwargs["markdown"]) or edit(messageId, **kwargs))
+
+    reply = bot.clean_room("room-x", progress_every=100)
+
+    assert reply == "Removed 250 messages."
+    assert edits == ["Removing my messages in this space, 100 handled so far...", "Removing my messages in this space, 200 handled so far..."]
+    # The status message is removed too, only the messages of other people are left
+    assert [message["id"] for message in fake.messages.values() if message["roomId"] == "room-x"] == ["user-message"]
+    assert not any(message["personId"] == BOT_ID and message["roomId"] == "room-x" for message in fake.messages.values())
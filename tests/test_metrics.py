@@ -0,0 +1,52 @@
+from metrics import Registry, merge
+from hermes import Hermess, COMMAND_ERRORS
+
+
+def worker_registry(requests):
+    """Build the registry of a worker that served some requests.
+
+    Returns:\n
+        Registry: The registry.
+    """
+    registry = Registry()
+    registry.counter("hermes_webex_requests_total", "Requests made to the Webex API", labels=("status",)).inc(requests, status="200")
+    registry.histogram("hermes_command_seconds", "Time taken by the bot commands", buckets=(0.1, 1)).observe(0.5)
+    return registry
+
+
+def test_merge_groups_the_series_of_every_worker():
+    texts = [worker_registry(3).render({"worker": "worker-0"}), worker_registry(5).render({"worker": "worker-1"})]
+
+    text = merge(texts)
+
+    lines = text.splitlines()
+    assert lines.count("# TYPE hermes_webex_requests_total counter") == 1
+    assert lines.count("# HELP hermes_command_seconds Time taken by the bot commands") == 1
+    assert 'hermes_webex_requests_total{status="200",worker="worker-0"} 3' in lines
+    assert 'hermes_webex_requests_total{status="200",worker="worker-1"} 5' in lines
+    # Samples stay right below the header of their metric
+    start = lines.index("# TYPE hermes_webex_requests_total counter")
+    assert all(line.startswith("hermes_webex_requests_total{") for line in lines[start + 1:start + 3])
+    assert sum(line.startswith("hermes_command_seconds_count") for line in lines) == 2
+    assert text.endswith("\n")
+
+
+def test_every_worker_serves_the_metrics_of_the_whole_cluster(tmp_path):
+    COMMAND_ERRORS.inc(0, command="help")
+    workers = []
+    for number in range(3):
+        bot = object.__new__(Hermess)
+        bot.node = f"worker-{number}"
+        bot.workers = 3
+        bot.metrics_dir = str(tmp_path)
+        workers.append(bot)
+    workers[0].write_metrics()  # The last worker only writes its file when it answers a scrape
+
+    before = workers[1].serve_metrics()[0]
+    scrapes = [bot.serve_metrics()[0] for bot in (workers[2], workers[0], workers[1])]
+
+    assert 'worker="worker-2"' not in before
+    assert 'worker="worker-0"' in before and 'worker="worker-1"' in before
+    for text in scrapes:
+        assert all(f'worker="worker-{number}"' in text for number in range(3))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["worker-0.prom", "worker-1.prom", "worker-2.prom"]
@@ -0,0 +1,108 @@
+import time
+import pytest
+from hermes import Hermess
+from shifts import due_time, utc_offset, slot_start
+
+
+def snapshot(bot):
+    """Get every job of the scheduler.
+
+    Returns:\n
+        dict: Job id -> (function name, args, kwargs, trigger).
+    """
+    return {job.id: (job.func.__name__, job.args, job.kwargs, str(job.trigger)) for job in bot.sched.get_jobs()}
+
+
+def new_shift(bot, personId):
+    """Change the shift of a user through the subscription card inputs, keeping the timezone.
+
+    Returns:\n
+        Shift: The shift before the change.
+    """
+    before = bot.store.get(personId).shift
+    inputs = {f"day{day}": str(day in (1, 3)).lower() for day in range(7)}
+    inputs.update(shiftstart="11:30", shiftend="15:30", timezone=before.timezone)
+    bot.update_file(user=personId, data=inputs)
+    return before
+
+
+@pytest.mark.parametrize("mode", ["user", "slot"])
+def test_update_schedules_leaves_other_users_jobs_untouched(bot, mode):
+    bot.schedule_mode = mode
+    bot.update_schedules()
+    personId = next(user for user, record in bot.store.items() if record.shift)
+    before = snapshot(bot)
+    old_shift = new_shift(bot, personId)
+
+    bot.update_schedules(personId)
+
+    after = snapshot(bot)
+    changed = {job_id for job_id in before.keys() | after.keys() if before.get(job_id) != after.get(job_id)}
+    new_slots = set(bot.store.get(personId).shift.slots())
+    if mode == "user":
+        assert changed
+        assert all(job_id.startswith(f"{personId}:") for job_id in changed)
+        assert {job_id for job_id in after if job_id.startswith(f"{personId}:")} == {"{}:{}:{}:{}".format(personId, *slot) for slot in new_slots}
+        return
+    # Slot jobs are shared, only the ones of the user's old and new slots may change, and only when nobody else is due in them
+    slots = set(old_shift.slots()) | new_slots
+    for job_id in changed:
+        assert job_id in {bot.slot_job_id(slot) for slot in slots}
+        slot = tuple(int(part) for part in job_id.split(":")[1:])
+        assert set(bot.store.due(*slot)) <= {personId}
+    assert all(bot.slot_job_id(slot) in after for slot in new_slots)
+
+
+def test_ping_room_gives_the_due_time_of_each_timezone(bot, monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot.outbox, "put", lambda key, body, **kwargs: sent.append((key, body["markdown"])))
+    bot.team_room = "room"
+    records = [record for _, record in bot.store.items() if record.shift][:3]
+    for record, timezone in zip(records, ["America/New_York", "America/Costa_Rica", "America/New_York"]):
+        record.shift.tz = timezone
+
+    bot.ping_room((0, 13, 55), records)
+
+    assert len(sent) == 2
+    assert len({key for key, _ in sent}) == 2
+    costa_rica, new_york = (markdown for _, markdown in sent)
+    assert costa_rica.startswith("Remember to send the hourly email before 08:00 AM (America/Costa_Rica): ")
+    assert new_york.startswith(f"Remember to send the hourly email before {due_time(13, 55, utcoffset=utc_offset('America/New_York'))} (America/New_York): ")
+    assert records[0].id in new_york and records[2].id in new_york and records[1].id not in new_york
+
+
+def test_late_tick_pings_the_minutes_it_missed(monkeypatch):
+    bot = object.__new__(Hermess)
+    bot.last_tick = None
+    bot.misfire_grace = 120
+    pinged = []
+    bot.ping_slot = lambda slot, scheduled_at: pinged.append((slot, scheduled_at))
+    monday = 1704067200  # Monday 2024-01-01 00:00 UTC
+    clock = iter([monday + 10 * 60, monday + 12 * 60 + 5, monday + 12 * 60 + 30, monday + 20 * 60])
+    monkeypatch.setattr(time, "time", lambda: next(clock))
+
+    for _ in range(4):
+        bot.tick()
+
+    # The 00:11 tick ran late into 00:12 and pinged both minutes, the 00:12 tick then has nothing left, and nothing older than the misfire grace is pinged
+    assert pinged == [((0, 0, minute), monday + minute * 60) for minute in (10, 11, 12, 18, 19, 20)]
+
+
+def test_late_reminders_are_due_in_their_slot(bot, monkeypatch):
+    queued = []
+    monkeypatch.setattr(bot.outbox, "put", lambda key, body, scheduled_at=None, delay=0: queued.append((key, scheduled_at)))
+    personId, record = next((user, record) for user, record in bot.store.items() if record.shift)
+    slot = bot.store.user_slots(personId)[0]
+    due = slot_start(slot)
+    monkeypatch.setattr(time, "time", lambda: due + 65)  # The job runs late, within the grace, in the next minute
+
+    bot.ping_slot(slot)
+
+    assert (f"{personId}:{int(due // 60)}", due) in queued
+
+
+def test_slot_start():
+    monday = 1704067200  # Monday 2024-01-01 00:00 UTC
+    assert slot_start((0, 9, 55), monday + (9 * 60 + 55) * 60 + 30) == monday + (9 * 60 + 55) * 60
+    assert slot_start((0, 9, 55), monday + (9 * 60 + 57) * 60) == monday + (9 * 60 + 55) * 60
+    assert slot_start((6, 23, 59), monday + 30) == monday - 60  # Last week's slot
@@ -0,0 +1,141 @@
+"""Timing wheel for Hermes
+
+    Holds short lived timers, like snoozed reminders, without creating a scheduler job for each of them.
+"""
+import math
+import time
+import itertools
+import threading
+
+
+class TimingWheel():
+    def __init__(self, tick=60.0, slots=64):
+        """Hashed timing wheel drained by a single ticker thread
+
+        A timer due in n ticks is hashed into the slot n steps ahead of the current one, remembering how many full turns of the wheel it has to wait,
+        so adding and cancelling a timer take constant time whatever the number of timers.
+        Timers are grouped by owner, so every timer of an owner can be cancelled at once.
+
+        Args:\n
+            tick (float, optional): Seconds between ticks, the resolution of the timers. Defaults to 60.0.
+            slots (int, optional): Number of slots in the wheel. Defaults to 64.
+        """
+        self.tick = tick
+        self.wheel = [{} for _ in range(slots)]  # timer id -> [rounds, owner, fn, args, kwargs]
+        self.current = 0
+        self._timers = {}  # timer id -> slot
+        self._owners = {}  # owner -> set of timer ids
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="hermes-timing-wheel", daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._timers)
+
+    def schedule(self, delay, fn, *args, owner=None, **kwargs):
+        """Run a function after a delay.
+
+        The delay is rounded up to whole ticks.
+
+        Args:\n
+            delay (float): Seconds to wait.
+            fn (callable): Function to run, it runs on the ticker thread so it should return quickly.
+            *args: Positional arguments for fn.
+            owner (str, optional): Owner of the timer, for instance a personId. Defaults to None.
+            **kwargs: Keyword arguments for fn.
+
+        Returns:\n
+            int: Unique identifier of the timer.
+        """
+        ticks = max(1, math.ceil(delay / self.tick))
+        with self._lock:
+            timer_id = next(self._ids)
+            slot = (self.current + ticks) % len(self.wheel)
+            self.wheel[slot][timer_id] = [(ticks - 1) // len(self.wheel), owner, fn, args, kwargs]
+            self._timers[timer_id] = slot
+            if owner is not None:
+                self._owners.setdefault(owner, set()).add(timer_id)
+        return timer_id
+
+    def cancel(self, timer_id):
+        """Cancel a timer.
+
+        Args:\n
+            timer_id (int): Unique identifier of the timer.
+
+        Returns:\n
+            bool: True if the timer was pending.
+        """
+        with self._lock:
+            return self._pop(timer_id) is not None
+
+    def cancel_owner(self, owner):
+        """Cancel every timer of an owner.
+
+        Args:\n
+            owner (str): Owner of the timers.
+
+        Returns:\n
+            int: Number of timers cancelled.
+        """
+        with self._lock:
+            timer_ids = list(self._owners.get(owner, ()))
+            for timer_id in timer_ids:
+                self._pop(timer_id)
+            return len(timer_ids)
+
+    def pending(self, owner):
+        """Count the timers of an owner.
+
+        Args:\n
+            owner (str): Owner of the timers.
+
+        Returns:\n
+            int: Number of pending timers.
+        """
+        with self._lock:
+            return len(self._owners.get(owner, ()))
+
+    def _pop(self, timer_id):
+        slot = self._timers.pop(timer_id, None)
+        if slot is None:
+            return None
+        timer = self.wheel[slot].pop(timer_id)
+        owner = timer[1]
+        if owner is not None:
+            timers = self._owners[owner]
+            timers.discard(timer_id)
+            if not timers:
+                del self._owners[owner]
+        return timer
+
+    def advance(self):
+        """Move the wheel one tick and run the timers that are due."""
+        with self._lock:
+            self.current = (self.current + 1) % len(self.wheel)
+            due = []
+            for timer_id, timer in list(self.wheel[self.current].items()):
+                if timer[0]:
+                    timer[0] -= 1
+                else:
+                    due.append(self._pop(timer_id))
+        for _, _, fn, args, kwargs in due:
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                print(f"Timer {getattr(fn, '__name__', fn)} failed: {e!r}")
+
+    def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while not self._stop.wait(max(0, next_tick - time.monotonic())):
+            # Catch up on the ticks missed while the process was busy
+            while next_tick <= time.monotonic():
+                self.advance()
+                next_tick += self.tick
+
+    def stop(self):
+        """Stop the ticker, pending timers are dropped."""
+        self._stop.set()
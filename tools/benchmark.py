@@ -0,0 +1,359 @@
+"""Benchmarks for Hermes
+
+    Sets up the bot against the fake Webex API with synthetic rosters of several sizes and reports how the hot paths scale:
+    loading the users file, building the schedule and the memory its jobs take, updating a single user's jobs,
+    reading and writing the users data, broadcasting, and the latency of every command.
+    Results can be saved and compared with a previous run, the comparison fails when a result got worse than the tolerance.
+
+    Usage:
+        python tools/benchmark.py [--sizes 100,1000,10000,50000] [--latency 20] [--throttle 0.01]
+                                  [--save results.json] [--compare baseline.json --tolerance 0.25]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import logging
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import requests
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TOOLS)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, TOOLS)
+from hermes import Hermess  # noqa: E402
+from fake_webex import FakeWebex  # noqa: E402
+from roster import write_roster  # noqa: E402
+
+CARDS = ("subscription.json", "notification.json")
+# Result name -> (description, unit, True when higher is better)
+RESULTS = {
+    "load_cold": ("Load the users file, building the slot index", "s", False),
+    "load_warm": ("Load the users file with the cached slot index", "s", False),
+    "schedule_user": ("Build the schedule, one job per user ping", "s", False),
+    "jobs_user": ("Jobs, one job per user ping", "", False),
+    "memory_user": ("Memory of the jobs, one job per user ping", "MiB", False),
+    "schedule_slot": ("Build the schedule, one job per time slot", "s", False),
+    "jobs_slot": ("Jobs, one job per time slot", "", False),
+    "memory_slot": ("Memory of the jobs, one job per time slot", "MiB", False),
+    "update_schedules": ("Update the jobs of one user", "ms", False),
+    "load_users": ("load_users(file=True)", "ms", False),
+    "write_to_file": ("write_to_file and flush", "s", False),
+    "broadcast": ("Broadcast throughput", "msg/s", True),
+}
+COMMANDS = ("subscribe", "handle_cards", "list_subscribers", "remove_messages", "unsubscribe")
+
+
+def percentile(values, share):
+    """Get a percentile of a list of values.
+
+    Args:\n
+        values (list): The values.
+        share (float): The percentile, between 0 and 1.
+
+    Returns:\n
+        float: The value below which share of the values fall, None when there are no values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+
+def timed(fn, *args, **kwargs):
+    """Run a function and time it.
+
+    Returns:\n
+        tuple: (result, seconds).
+    """
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+class Benchmark():
+    def __init__(self, api_url, broadcast_limit=2000, user_mode_limit=10000, samples=20, seed=0):
+        """Benchmark of a single roster size
+
+        Args:\n
+            api_url (str): Base url of the fake Webex API.
+            broadcast_limit (int, optional): Maximum users the broadcast is sent to. Defaults to 2000.
+            user_mode_limit (int, optional): Largest roster the one job per user ping schedule is built for,
+                it takes minutes and gigabytes beyond that. Defaults to 10000.
+            samples (int, optional): Runs of every command and of update_schedules. Defaults to 20.
+            seed (int, optional): Seed of the roster and of the samples. Defaults to 0.
+        """
+        self.api_url = api_url
+        self.fake_url = api_url.rsplit("/v1", 1)[0]
+        self.broadcast_limit = broadcast_limit
+        self.user_mode_limit = user_mode_limit
+        self.samples = samples
+        self.seed = seed
+
+    def setup(self, size):
+        """Write the roster and the cards to a new folder and move into it.
+
+        Args:\n
+            size (int): Number of users.
+        """
+        self.folder = tempfile.mkdtemp(prefix=f"hermes-bench-{size}-")
+        for card in CARDS:
+            shutil.copy(os.path.join(ROOT, card), self.folder)
+        os.chdir(self.folder)
+        write_roster("peopletonotify.json", size, seed=self.seed)
+        os.environ.update({"HERMES_API_URL": self.api_url, "TEAMS_BOT_TOKEN": "fake", "HERMES_CATCHUP": "off",
+                           "HERMES_FLUSH_INTERVAL": "3600", "HERMES_SCHEDULE_MODE": "user", "HERMES_STORE": "json"})
+        os.environ.setdefault("HERMES_RATE_LIMIT", "1000")
+        os.environ.setdefault("HERMES_RATE_BURST", "100")
+
+    def bot(self):
+        """Set up a bot without running it.
+
+        Returns:\n
+            Hermess: The bot, with its users and schedule loaded.
+        """
+        bot = object.__new__(Hermess)
+        bot.started = time.perf_counter()
+        bot.configure()
+        bot.api = bot.webex_api()
+        bot.start_services()
+        bot.users_loaded.result()
+        bot.schedule_ready.result()
+        return bot
+
+    def run(self, size):
+        """Run every benchmark on a roster.
+
+        Args:\n
+            size (int): Number of users.
+
+        Returns:\n
+            dict: Result name -> value.
+        """
+        self.setup(size)
+        results = {}
+        probe = object.__new__(Hermess)
+        probe.configure()
+        _, results["load_cold"] = timed(probe.init_users_file)
+        probe.store.close()  # Saves the slot index cache
+        _, results["load_warm"] = timed(probe.init_users_file)
+        probe.store.close()
+
+        bot = self.bot()
+        try:
+            for mode in (("user", "slot") if size <= self.user_mode_limit else ("slot",)):
+                results.update(self.schedule(bot, mode))
+            results["update_schedules"] = self.update_schedules(bot) * 1000
+            data, seconds = timed(bot.load_users, file=True)
+            results["load_users"] = seconds * 1000
+            results["write_to_file"] = timed(lambda: (bot.write_to_file(data), bot.store.flush()))[1]
+            results["broadcast"] = self.broadcast(bot)
+            results.update(self.commands(bot))
+        finally:
+            bot.dispatcher.stop()
+            bot.snoozes.stop()
+            bot.sched.shutdown(wait=False)
+            bot.store.close()
+            os.chdir(ROOT)
+            shutil.rmtree(self.folder, ignore_errors=True)
+        return results
+
+    def schedule(self, bot, mode):
+        """Build the whole schedule, timing it, then build it again tracing its memory.
+
+        Args:\n
+            bot (Hermess): The bot.
+            mode (str): Either "user" or "slot".
+
+        Returns:\n
+            dict: Result name -> value.
+        """
+        bot.schedule_mode = mode
+        bot.sched.remove_all_jobs()
+        bot.user_jobs = {}
+        _, seconds = timed(bot.schedule_subscriptions)
+        jobs = len(bot.sched.get_jobs())
+        bot.sched.remove_all_jobs()
+        bot.user_jobs = {}
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        bot.schedule_subscriptions()
+        memory = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        return {f"schedule_{mode}": seconds, f"jobs_{mode}": jobs, f"memory_{mode}": memory / 2 ** 20}
+
+    def update_schedules(self, bot):
+        """Time the update of a single user's jobs.
+
+        Args:\n
+            bot (Hermess): The bot, in the schedule mode of the last schedule built.
+
+        Returns:\n
+            float: Median seconds.
+        """
+        users = random.Random(self.seed).sample(bot.store.ids(), min(self.samples * 10, len(bot.store)))
+        return percentile([timed(bot.update_schedules, user)[1] for user in users], 0.5)
+
+    def broadcast(self, bot):
+        """Broadcast a message and measure the throughput.
+
+        Args:\n
+            bot (Hermess): The bot.
+
+        Returns:\n
+            float: Messages handled per second.
+        """
+        done = threading.Event()
+        recipients = bot.store.ids()[:self.broadcast_limit]
+        start = time.perf_counter()
+        job = bot.broadcaster.submit(recipients, "Benchmark broadcast", on_done=lambda job: done.set())
+        done.wait()
+        return job.total / (time.perf_counter() - start)
+
+    def message(self, personId, text):
+        """Have a user send a message to the bot.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+            text (str): Text of the message.
+
+        Returns:\n
+            dict: The message, as the fake API stored it.
+        """
+        return requests.post(f"{self.fake_url}/_fake/messages", json={"personId": personId, "text": text}).json()
+
+    def commands(self, bot):
+        """Time every command, the way the work queue runs them.
+
+        Each sample subscribes a new user, submits the subscription card, lists the subscribers, cleans the space and unsubscribes.
+
+        Args:\n
+            bot (Hermess): The bot.
+
+        Returns:\n
+            dict: "<command>_p50" and "<command>_p99" -> milliseconds.
+        """
+        rng = random.Random(self.seed)
+        inputs = {**{f"day{day}": "true" for day in range(5)}, "shiftstart": "08:00", "shiftend": "17:00", "timezone": "America/New_York"}
+        timings = {command: [] for command in COMMANDS}
+
+        def run(command, *args):
+            timings[command].append(timed(bot.run_command, room, getattr(bot, command), *args)[1] * 1000)
+
+        for num in range(self.samples):
+            personId = f"bench-user-{rng.getrandbits(64):016x}-{num}"
+            room = f"room-{personId}"
+            run("subscribe", bot.api.messages.get(self.message(personId, "/subscribe")["id"]))
+            action = requests.post(f"{self.fake_url}/_fake/actions", json={"personId": personId, "inputs": inputs}).json()
+            run("handle_cards", None, {"data": {"id": action["id"], "roomId": room}})
+            if num < 3:  # Lists every subscriber, a few runs are enough
+                run("list_subscribers", bot.api.messages.get(self.message(personId, "/listsubs")["id"]))
+            run("remove_messages", bot.api.messages.get(self.message(personId, "/clean 10")["id"]))
+            run("unsubscribe", bot.api.messages.get(self.message(personId, "/unsubscribe")["id"]))
+        results = {}
+        for command, values in timings.items():
+            results[f"{command}_p50"] = percentile(values, 0.5)
+            results[f"{command}_p99"] = percentile(values, 0.99)
+        return results
+
+
+def describe(name):
+    """Describe a result.
+
+    Args:\n
+        name (str): Result name.
+
+    Returns:\n
+        tuple: (description, unit, True when higher is better).
+    """
+    if name in RESULTS:
+        return RESULTS[name]
+    command, stat = name.rsplit("_", 1)
+    return (f"/{command} latency {stat}", "ms", False)
+
+
+def report(results):
+    """Print the results as a table.
+
+    Args:\n
+        results (dict): Size -> result name -> value.
+    """
+    sizes = list(results)
+    names = list(dict.fromkeys(name for size in sizes for name in results[size]))
+    print(f"\n{'':58}" + "".join(f"{size:>12}" for size in sizes))
+    for name in names:
+        description, unit, _ = describe(name)
+        values = "".join(f"{results[size][name]:>12.3f}" if results[size].get(name) is not None else f"{'-':>12}" for size in sizes)
+        print(f"{description + (f' ({unit})' if unit else ''):58}{values}")
+
+
+def compare(results, baseline, tolerance):
+    """Compare the results with a previous run.
+
+    Args:\n
+        results (dict): Size -> result name -> value.
+        baseline (dict): Size -> result name -> value of the previous run.
+        tolerance (float): Share a result may get worse by before it counts as a regression.
+
+    Returns:\n
+        list: Descriptions of the regressions.
+    """
+    regressions = []
+    for size, values in results.items():
+        for name, value in values.items():
+            old = baseline.get(str(size), {}).get(name)
+            if not old or value is None:
+                continue
+            description, unit, higher_is_better = describe(name)
+            change = (old - value) / old if higher_is_better else (value - old) / old
+            if change > tolerance:
+                regressions.append(f"{size} users, {description}: {old:.3f} -> {value:.3f} {unit} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot against the fake Webex API")
+    parser.add_argument("--sizes", default="100,1000,10000,50000", help="comma separated roster sizes")
+    parser.add_argument("--latency", type=float, default=20, help="milliseconds every API request takes")
+    parser.add_argument("--jitter", type=float, default=10, help="maximum random milliseconds added to the latency")
+    parser.add_argument("--throttle", type=float, default=0.01, help="share of the API requests answered with a 429")
+    parser.add_argument("--broadcast-limit", type=int, default=2000, help="maximum users the broadcast is sent to")
+    parser.add_argument("--user-mode-limit", type=int, default=10000, help="largest roster the one job per user ping schedule is built for")
+    parser.add_argument("--samples", type=int, default=20, help="runs of every command")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write the results to this json file")
+    parser.add_argument("--compare", help="json file of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="share a result may get worse by")
+    args = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    fake = FakeWebex(latency=args.latency / 1000, jitter=args.jitter / 1000, throttle=args.throttle, seed=args.seed)
+    server = fake.serve(port=0)
+    benchmark = Benchmark(f"http://localhost:{server.server_port}/v1", broadcast_limit=args.broadcast_limit,
+                          user_mode_limit=args.user_mode_limit, samples=args.samples, seed=args.seed)
+    results = {}
+    for size in (int(size) for size in args.sizes.split(",")):
+        print(f"Benchmarking {size} users")
+        results[size] = benchmark.run(size)
+    server.shutdown()
+    print(f"The fake API answered {fake.throttled} requests with a 429")
+    report(results)
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=4)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
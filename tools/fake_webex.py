@@ -0,0 +1,301 @@
+"""Fake Webex API for Hermes
+
+    Serves the handful of Webex endpoints the bot uses, keeping everything in memory,
+    so the bot, or a cluster of bot workers, can be run locally without a Webex account.
+
+    Usage:
+        python tools/fake_webex.py --port 8090 [--latency 50] [--jitter 20] [--throttle 0.01] [--retry-after 1]
+
+    Then start the bot against it:
+        HERMES_API_URL=http://localhost:8090/v1 HERMES_BOT_URL=http://localhost:8080 TEAMS_BOT_TOKEN=fake \\
+        TEAMS_BOT_EMAIL=hermes@webex.bot TEAMS_BOT_APP_NAME=hermes HERMES_STORE=sqlite HERMES_WORKERS=4 python hermes.py
+
+    Messages are sent to the bot with POST /_fake/messages {"personId": ..., "text": "/subscribe"}
+    and card actions with POST /_fake/actions {"personId": ..., "inputs": {...}}, both are delivered to the registered webhooks.
+    GET /_fake/stats counts the messages the bot sent to each user, to check every reminder was sent exactly once,
+    and the requests answered with a 429.
+    In-process users can also seed messages and card actions with add_message and add_action,
+    and follow the messages the bot sends by adding callbacks to listeners.
+"""
+import time
+import uuid
+import base64
+import random
+import argparse
+import threading
+import requests
+from collections import Counter
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+BOT_ID = "fake-bot"
+# Fields of a message or attachment action sent in the data of its webhook event
+EVENT_FIELDS = {"messages": ("id", "roomId", "roomType", "personId", "personEmail", "created"),
+                "attachmentActions": ("id", "type", "messageId", "personId", "roomId", "created")}
+
+
+def make_id(kind):
+    """Make up an id shaped like the Webex ones, so the bot's metrics leave it out of the endpoint names.
+
+    Args:\n
+        kind (str): Kind of object, for instance "MESSAGE".
+
+    Returns:\n
+        str: The id.
+    """
+    return base64.urlsafe_b64encode(f"ciscospark://us/{kind}/{uuid.uuid4()}".encode()).decode().rstrip("=")
+
+
+class FakeWebex():
+    def __init__(self, bot_email="hermes@webex.bot", latency=0.0, jitter=0.0, throttle=0.0, retry_after=1, seed=None):
+        """In memory Webex API
+
+        Every API request waits latency seconds plus up to jitter more, and a throttle share of them
+        is refused with a 429 and a Retry-After header, like the real API does under load.
+
+        Args:\n
+            bot_email (str, optional): Email of the bot account. Defaults to "hermes@webex.bot".
+            latency (float, optional): Seconds every API request takes. Defaults to 0.0.
+            jitter (float, optional): Maximum random seconds added to the latency. Defaults to 0.0.
+            throttle (float, optional): Share of the API requests answered with a 429, between 0 and 1. Defaults to 0.0.
+            retry_after (int, optional): Seconds sent in the Retry-After header of the 429s. Defaults to 1.
+            seed (int, optional): Seed of the jitter and throttle draws. Defaults to None.
+        """
+        self.bot_email = bot_email
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.throttled = 0
+        self.messages = {}  # messageId -> message
+        self.actions = {}  # attachment action id -> action
+        self.webhooks = {}  # webhookId -> webhook
+        self.sent = Counter()  # personId or roomId -> messages sent by the bot
+        self.listeners = []  # Called as listener(message, body) with every message the bot sends
+        self._lock = threading.Lock()
+        self.app = Flask("fake_webex")
+        self.routes()
+
+    def person(self, personId):
+        """Make up the details of a person.
+
+        Args:\n
+            personId (str): Unique identifier of the person.
+
+        Returns:\n
+            dict: The person.
+        """
+        if personId == BOT_ID:
+            return {"id": BOT_ID, "emails": [self.bot_email], "displayName": "Hermes", "nickName": "Hermes",
+                    "firstName": "Hermes", "type": "bot", "created": "2020-01-01T00:00:00.000Z"}
+        short = personId[-6:]
+        return {"id": personId, "emails": [f"{short}@example.com"], "displayName": f"User {short}", "nickName": f"User {short}",
+                "firstName": "User", "type": "person", "created": "2020-01-01T00:00:00.000Z"}
+
+    def now(self):
+        """str: The current time in the API's format."""
+        return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+
+    def add_message(self, personId, text, id=None):
+        """Store a message sent to the bot by a user, without delivering it to the webhooks.
+
+        Args:\n
+            personId (str): Unique identifier of the sender.
+            text (str): Text of the message.
+            id (str, optional): Id of the message, to replay a recorded one. Defaults to a new id.
+
+        Returns:\n
+            dict: The message.
+        """
+        person = self.person(personId)
+        message = {"id": id or make_id("MESSAGE"), "roomId": f"room-{personId}", "roomType": "direct", "personId": personId,
+                   "personEmail": person["emails"][0], "text": text, "created": self.now()}
+        with self._lock:
+            self.messages[message["id"]] = message
+        return message
+
+    def add_action(self, personId, inputs, messageId=None, id=None):
+        """Store a card submitted by a user, without delivering it to the webhooks.
+
+        Args:\n
+            personId (str): Unique identifier of the user.
+            inputs (dict): Inputs of the card.
+            messageId (str, optional): Id of the message holding the card. Defaults to a new id.
+            id (str, optional): Id of the attachment action, to replay a recorded one. Defaults to a new id.
+
+        Returns:\n
+            dict: The attachment action.
+        """
+        action = {"id": id or make_id("ATTACHMENT_ACTION"), "type": "submit", "messageId": messageId or make_id("MESSAGE"),
+                  "inputs": inputs, "personId": personId, "roomId": f"room-{personId}", "created": self.now()}
+        with self._lock:
+            self.actions[action["id"]] = action
+        return action
+
+    def notify(self, resource, data):
+        """Deliver a webhook event to the webhooks registered for it.
+
+        Args:\n
+            resource (str): Either "messages" or "attachmentActions".
+            data (dict): The event data.
+        """
+        with self._lock:
+            hooks = [hook for hook in self.webhooks.values() if hook["resource"] == resource and hook["event"] == "created"]
+        for hook in hooks:
+            body = {"id": hook["id"], "name": hook["name"], "resource": resource, "event": "created", "data": data}
+            threading.Thread(target=requests.post, args=(hook["targetUrl"],), kwargs={"json": body, "timeout": 30}, daemon=True).start()
+
+    def routes(self):
+        """Register the endpoints."""
+        app = self.app
+
+        @app.before_request
+        def slow_down():
+            if not request.path.startswith("/v1/"):
+                return None
+            with self._lock:
+                delay = self.latency + self.rng.uniform(0, self.jitter)
+                throttled = self.rng.random() < self.throttle
+                self.throttled += throttled
+            if delay:
+                time.sleep(delay)
+            if throttled:
+                return jsonify({"message": "Too Many Requests"}), 429, {"Retry-After": str(self.retry_after)}
+            return None
+
+        @app.get("/v1/people/me")
+        def me():
+            return jsonify(self.person(BOT_ID))
+
+        @app.get("/v1/people/<personId>")
+        def person(personId):
+            return jsonify(self.person(personId))
+
+        @app.get("/v1/people")
+        def people():
+            ids = [personId for personId in request.args.get("id", "").split(",") if personId]
+            return jsonify({"items": [self.person(personId) for personId in ids]})
+
+        @app.post("/v1/messages")
+        def create_message():
+            body = request.get_json(force=True)
+            target = body.get("toPersonId") or body.get("roomId")
+            message = {"id": make_id("MESSAGE"), "roomId": body.get("roomId") or f"room-{target}", "personId": BOT_ID,
+                       "personEmail": self.bot_email, "text": body.get("text") or body.get("markdown", ""), "created": self.now()}
+            with self._lock:
+                self.messages[message["id"]] = message
+                self.sent[target] += 1
+            for listener in self.listeners:
+                listener(message, body)
+            return jsonify(message)
+
+        @app.get("/v1/messages/<messageId>")
+        def get_message(messageId):
+            message = self.messages.get(messageId)
+            return (jsonify(message), 200) if message else (jsonify({"message": "Not found"}), 404)
+
+        @app.put("/v1/messages/<messageId>")
+        def edit_message(messageId):
+            body = request.get_json(force=True)
+            with self._lock:
+                message = self.messages.get(messageId)
+                if message:
+                    message.update(text=body.get("text") or body.get("markdown", ""), updated=self.now())
+            return (jsonify(message), 200) if message else (jsonify({"message": "Not found"}), 404)
+
+        @app.delete("/v1/messages/<messageId>")
+        def delete_message(messageId):
+            with self._lock:
+                self.messages.pop(messageId, None)
+            return "", 204
+
+        @app.get("/v1/messages")
+        def list_messages():
+            roomId = request.args.get("roomId")
+            with self._lock:
+                items = [message for message in self.messages.values() if message["roomId"] == roomId]
+            return jsonify({"items": items[::-1]})
+
+        @app.get("/v1/attachment/actions/<actionId>")
+        def get_action(actionId):
+            action = self.actions.get(actionId)
+            return (jsonify(action), 200) if action else (jsonify({"message": "Not found"}), 404)
+
+        @app.get("/v1/webhooks")
+        def list_webhooks():
+            with self._lock:
+                return jsonify({"items": list(self.webhooks.values())})
+
+        @app.post("/v1/webhooks")
+        def create_webhook():
+            body = request.get_json(force=True)
+            hook = dict(body, id=make_id("WEBHOOK"), status="active", created=self.now())
+            with self._lock:
+                self.webhooks[hook["id"]] = hook
+            return jsonify(hook)
+
+        @app.delete("/v1/webhooks/<webhookId>")
+        def delete_webhook(webhookId):
+            with self._lock:
+                self.webhooks.pop(webhookId, None)
+            return "", 204
+
+        @app.post("/_fake/messages")
+        def send_message():
+            body = request.get_json(force=True)
+            message = self.add_message(body["personId"], body["text"])
+            self.notify("messages", {key: message[key] for key in EVENT_FIELDS["messages"]})
+            return jsonify(message)
+
+        @app.post("/_fake/actions")
+        def send_action():
+            body = request.get_json(force=True)
+            action = self.add_action(body["personId"], body["inputs"], body.get("messageId"))
+            self.notify("attachmentActions", {key: action[key] for key in EVENT_FIELDS["attachmentActions"]})
+            return jsonify(action)
+
+        @app.get("/_fake/stats")
+        def stats():
+            with self._lock:
+                return jsonify({"sent": sum(self.sent.values()), "recipients": dict(self.sent), "throttled": self.throttled})
+
+        @app.delete("/_fake/stats")
+        def reset_stats():
+            with self._lock:
+                self.sent.clear()
+                self.throttled = 0
+            return "", 204
+
+    def serve(self, host="localhost", port=8090):
+        """Serve the API from a background thread.
+
+        Args:\n
+            host (str, optional): Address to listen on. Defaults to "localhost".
+            port (int, optional): Port to listen on, 0 picks a free one. Defaults to 8090.
+
+        Returns:\n
+            BaseWSGIServer: The server, its port is server.server_port, stop it with server.shutdown().
+        """
+        server = make_server(host, port, self.app, threaded=True)
+        threading.Thread(target=server.serve_forever, name="fake-webex", daemon=True).start()
+        return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Webex API for running Hermes locally")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--bot-email", default="hermes@webex.bot")
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds every API request takes")
+    parser.add_argument("--jitter", type=float, default=0, help="maximum random milliseconds added to the latency")
+    parser.add_argument("--throttle", type=float, default=0, help="share of the API requests answered with a 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="seconds sent in the Retry-After header of the 429s")
+    args = parser.parse_args()
+    fake = FakeWebex(bot_email=args.bot_email, latency=args.latency / 1000, jitter=args.jitter / 1000,
+                     throttle=args.throttle, retry_after=args.retry_after)
+    fake.app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
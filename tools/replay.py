@@ -0,0 +1,505 @@
+"""Webhook replay for Hermes
+
+    Starts the fake Webex API and a bot process against it, then replays messages:created and attachmentActions:created webhooks
+    to the bot's endpoint for many users at a time, the way a whole shift submitting the subscription card at once would.
+    The events are either made up from a synthetic roster or read from a file of recorded ones.
+
+    Every event is timed from the webhook until the bot's reply to that space reaches the fake API, so the latency includes the work queue,
+    and it counts as an error when the webhook is refused, the reply is the error message or no reply comes.
+    The events of a user are replayed in order, one at a time, so once they are all done the users file must hold exactly
+    what the commands that succeeded left in it, which is checked at the end. The users file is also read while the events are replayed,
+    to catch it half written.
+
+    Usage:
+        python tools/replay.py [--roster 1000] [--joining 200] [--updating 100] [--leaving 50] [--concurrency 20]
+                               [--store json|sqlite] [--workers 1] [--latency 20] [--throttle 0.01]
+                               [--events recorded.jsonl] [--record events.jsonl]
+
+    Events are stored one webhook body per line, its data also holding the "text" of the message or the "inputs" of the card,
+    which the fake API serves back when the bot fetches them. Duplicate ids are dropped by the bot, so they never get a reply.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import signal
+import logging
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TOOLS)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, TOOLS)
+from shifts import Shift, DEFAULT_TIMEZONE  # noqa: E402
+from store import SQLiteUserStore, parse_users  # noqa: E402
+from fake_webex import FakeWebex, EVENT_FIELDS, make_id  # noqa: E402
+from roster import subscriber, write_roster  # noqa: E402
+from benchmark import CARDS, percentile  # noqa: E402
+
+ERROR_REPLY = "Sorry, something went wrong"  # Start of the reply run_command sends when a command fails
+
+
+def free_port():
+    """int: A TCP port nobody is listening on."""
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def message_event(personId, text):
+    """Make up the messages:created webhook of a message sent to the bot.
+
+    Args:\n
+        personId (str): Unique identifier of the sender.
+        text (str): Text of the message.
+
+    Returns:\n
+        dict: The webhook body, its data holding the text.
+    """
+    data = {"id": make_id("MESSAGE"), "roomId": f"room-{personId}", "roomType": "direct", "personId": personId, "text": text}
+    return {"resource": "messages", "event": "created", "data": data}
+
+
+def action_event(personId, inputs):
+    """Make up the attachmentActions:created webhook of a card submitted by a user.
+
+    Args:\n
+        personId (str): Unique identifier of the user.
+        inputs (dict): Inputs of the card.
+
+    Returns:\n
+        dict: The webhook body, its data holding the inputs.
+    """
+    data = {"id": make_id("ATTACHMENT_ACTION"), "type": "submit", "personId": personId, "roomId": f"room-{personId}", "inputs": inputs}
+    return {"resource": "attachmentActions", "event": "created", "data": data}
+
+
+def card_inputs(record):
+    """Get the subscription card inputs a user would submit.
+
+    Args:\n
+        record (Subscriber): The user, with a shift.
+
+    Returns:\n
+        dict: The card inputs.
+    """
+    inputs = record.shift.to_inputs()
+    inputs["timezone"] = inputs["timezone"] or DEFAULT_TIMEZONE
+    inputs["delivery"] = record.delivery or "direct"
+    return inputs
+
+
+def synthetic_events(users, joining=200, updating=100, leaving=50, seed=0):
+    """Make up the events of a busy moment.
+
+    New users subscribe and submit the card, subscribed users submit the card again with a new shift and some others unsubscribe.
+
+    Args:\n
+        users (list): personIds of the users already subscribed.
+        joining (int, optional): Users that subscribe. Defaults to 200.
+        updating (int, optional): Subscribed users that change their shift. Defaults to 100.
+        leaving (int, optional): Subscribed users that unsubscribe. Defaults to 50.
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+
+    Returns:\n
+        list: The webhook bodies, the events of each user in order.
+    """
+    rng = random.Random(seed)
+    events = []
+    for _ in range(joining):
+        record = subscriber(rng, unsubscribed=0)
+        events += [message_event(record.id, "/subscribe"), action_event(record.id, card_inputs(record))]
+    chosen = rng.sample(users, min(len(users), updating + leaving))
+    for personId in chosen[:updating]:
+        events.append(action_event(personId, card_inputs(subscriber(rng, unsubscribed=0))))
+    for personId in chosen[updating:]:
+        events.append(message_event(personId, "/unsubscribe"))
+    return events
+
+
+def command_name(event):
+    """Get the command an event runs.
+
+    Args:\n
+        event (dict): The webhook body.
+
+    Returns:\n
+        str: The first word of the message, or the resource for card actions.
+    """
+    if event["resource"] == "messages":
+        return (event["data"].get("text") or "").split(" ")[0] or "(empty)"
+    return event["resource"]
+
+
+def read_events(path):
+    """Read recorded events.
+
+    Args:\n
+        path (str): String containing the relative or full path to the json lines file.
+
+    Returns:\n
+        list: The webhook bodies.
+    """
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def write_events(path, events):
+    """Record events to replay them later.
+
+    Args:\n
+        path (str): String containing the relative or full path to the json lines file.
+        events (list): The webhook bodies.
+    """
+    with open(path, "w") as file:
+        file.writelines(json.dumps(event) + "\n" for event in events)
+
+
+def expected_users(users, results):
+    """Work out the users the bot should have stored after the events.
+
+    Only the events that succeeded are applied, in the order each user sent them.
+
+    Args:\n
+        users (dict): personId -> Subscriber before the events.
+        results (list): (event, result) tuples, see Replay.send.
+
+    Returns:\n
+        dict: personId -> (shift dict, delivery).
+    """
+    state = {personId: (record.shift and record.shift.to_dict(), record.delivery) for personId, record in users.items()}
+    for event, result in results:
+        if result["error"]:
+            continue
+        data, command = event["data"], command_name(event)
+        personId = data["personId"]
+        if command == "/subscribe":
+            state.setdefault(personId, (None, None))
+        elif command == "/unsubscribe":
+            state.pop(personId, None)
+        elif command == "attachmentActions" and "shiftstart" in data["inputs"]:
+            inputs = data["inputs"]
+            state[personId] = (Shift.from_inputs(inputs).to_dict(), "room" if inputs.get("delivery") == "room" else None)
+    return state
+
+
+def compare_users(expected, users):
+    """Compare the users the bot stored with the expected ones.
+
+    Args:\n
+        expected (dict): personId -> (shift dict, delivery), see expected_users.
+        users (dict): personId -> Subscriber stored by the bot.
+
+    Returns:\n
+        dict: Lists of the "missing", "unexpected" and "different" personIds.
+    """
+    stored = {personId: (record.shift and record.shift.to_dict(), record.delivery) for personId, record in users.items()}
+    return {"missing": sorted(set(expected) - set(stored)),
+            "unexpected": sorted(set(stored) - set(expected)),
+            "different": sorted(personId for personId in set(expected) & set(stored) if expected[personId] != stored[personId])}
+
+
+class Bot():
+    def __init__(self, folder, api_url, port, store="json", workers=1):
+        """Bot process running against the fake API
+
+        Args:\n
+            folder (str): Folder the bot runs in, holding the users file and the cards.
+            api_url (str): Base url of the fake Webex API.
+            port (int): Port of the webhook endpoint.
+            store (str, optional): Either "json" or "sqlite". Defaults to "json".
+            workers (int, optional): Worker processes. Defaults to 1.
+        """
+        self.folder = folder
+        self.url = f"http://localhost:{port}"
+        self.store = store
+        self.env = dict(os.environ, HERMES_API_URL=api_url, HERMES_BOT_URL=self.url, TEAMS_BOT_TOKEN="fake",
+                        TEAMS_BOT_EMAIL="hermes@webex.bot", TEAMS_BOT_APP_NAME="hermes", HERMES_PORT=str(port),
+                        HERMES_STORE=store, HERMES_WORKERS=str(workers), HERMES_CATCHUP="off", TERM=os.getenv("TERM", "dumb"))
+        self.log = os.path.join(folder, "hermes.log")
+        self.process = None
+
+    def start(self, timeout=120):
+        """Start the bot and wait until it accepts webhooks.
+
+        Args:\n
+            timeout (float, optional): Seconds to wait. Defaults to 120.
+
+        Raises:\n
+            SystemExit: When the bot exits or does not come up in time.
+        """
+        with open(self.log, "w") as log:
+            self.process = subprocess.Popen([sys.executable, os.path.join(ROOT, "hermes.py")], cwd=self.folder, env=self.env,
+                                            stdout=log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise SystemExit(f"The bot exited with status {self.process.returncode}, see {self.log}")
+            try:
+                if requests.get(f"{self.url}/metrics", timeout=1).ok:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        raise SystemExit(f"The bot did not accept webhooks within {timeout}s, see {self.log}")
+
+    def stop(self, timeout=30):
+        """Stop the bot the way Ctrl+C does, so the stores are flushed and closed.
+
+        Args:\n
+            timeout (float, optional): Seconds to wait before killing it. Defaults to 30.
+        """
+        if not self.process or self.process.poll() is not None:
+            return
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def users(self):
+        """Read the users the bot stored.
+
+        Returns:\n
+            dict: personId -> Subscriber.
+        """
+        if self.store == "sqlite":
+            store = SQLiteUserStore(os.path.join(self.folder, "hermes.db"))
+            try:
+                return dict(store.items())
+            finally:
+                store.close()
+        with open(os.path.join(self.folder, "peopletonotify.json")) as file:
+            return parse_users(json.load(file))[0]
+
+
+class Replay():
+    def __init__(self, fake, url, concurrency=20, timeout=30):
+        """Replays events to a bot and times them
+
+        Args:\n
+            fake (FakeWebex): The fake API the bot runs against.
+            url (str): Url of the bot's webhook endpoint.
+            concurrency (int, optional): Users replayed at a time. Defaults to 20.
+            timeout (float, optional): Seconds to wait for the reply to an event. Defaults to 30.
+        """
+        self.fake = fake
+        self.url = url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.pending = {}  # roomId -> [threading.Event, reply]
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+        fake.listeners.append(self.on_message)
+
+    def on_message(self, message, body):
+        """Listener of the fake API, picks up the replies of the commands.
+
+        Replies are sent to the roomId of the webhook, unlike the cards and reminders, which are sent to the personId.
+
+        Args:\n
+            message (dict): The message the bot sent.
+            body (dict): The body of the request.
+        """
+        if "roomId" not in body or "markdown" not in body:
+            return
+        with self._lock:
+            waiter = self.pending.get(body["roomId"])
+        if waiter and not waiter[0].is_set():
+            waiter[1] = body["markdown"]
+            waiter[0].set()
+
+    def send(self, event):
+        """Replay an event and wait for its reply.
+
+        Args:\n
+            event (dict): The webhook body, its data holding the text of the message or the inputs of the card.
+
+        Returns:\n
+            dict: "ack" and "latency" seconds, "error" None or the reason the event failed.
+        """
+        data = event["data"]
+        if event["resource"] == "messages":
+            created = self.fake.add_message(data["personId"], data.get("text", ""), id=data["id"])
+        else:
+            created = self.fake.add_action(data["personId"], data["inputs"], data.get("messageId"), id=data["id"])
+        body = dict(event, id="replay", name="replay", data={key: created[key] for key in EVENT_FIELDS[event["resource"]]})
+        waiter = [threading.Event(), None]
+        with self._lock:
+            self.pending[created["roomId"]] = waiter
+        start = time.perf_counter()
+        result = {"ack": None, "latency": None, "error": None}
+        try:
+            response = self.session.post(self.url, json=body, timeout=self.timeout)
+            result["ack"] = time.perf_counter() - start
+            if not response.ok:
+                result["error"] = f"HTTP {response.status_code}"
+            elif not waiter[0].wait(self.timeout):
+                result["error"] = "no reply"
+            else:
+                result["latency"] = time.perf_counter() - start
+                if waiter[1].startswith(ERROR_REPLY):
+                    result["error"] = "command failed"
+        except requests.RequestException as e:
+            result["error"] = type(e).__name__
+        finally:
+            with self._lock:
+                self.pending.pop(created["roomId"], None)
+        return result
+
+    def replay(self, events):
+        """Replay the events of concurrency users at a time, the events of each user in order.
+
+        Args:\n
+            events (list): The webhook bodies.
+
+        Returns:\n
+            list: (event, result) tuples, in the order of the events of each user.
+        """
+        users = {}
+        for event in events:
+            users.setdefault(event["data"]["personId"], []).append(event)
+
+        def run(user_events):
+            return [(event, self.send(event)) for event in user_events]
+
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            return [pair for pairs in pool.map(run, users.values()) for pair in pairs]
+
+
+class FileWatcher():
+    def __init__(self, path, interval=0.05):
+        """Reads a json file over and over, counting the reads that find it half written
+
+        Args:\n
+            path (str): String containing the relative or full path to the file.
+            interval (float, optional): Seconds between reads. Defaults to 0.05.
+        """
+        self.path = path
+        self.interval = interval
+        self.reads = 0
+        self.torn = 0
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="file-watcher", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                with open(self.path) as file:
+                    json.load(file)
+            except FileNotFoundError:
+                continue
+            except ValueError:
+                self.torn += 1
+            self.reads += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.thread.join()
+
+
+def report(results, elapsed):
+    """Print the latency and errors of every command.
+
+    Args:\n
+        results (list): (event, result) tuples.
+        elapsed (float): Seconds the replay took.
+    """
+    commands = {}
+    for event, result in results:
+        commands.setdefault(command_name(event), []).append(result)
+    print(f"\nReplayed {len(results)} events in {elapsed:.1f}s, {len(results) / elapsed:.1f} events/s\n")
+    print(f"{'command':20}{'events':>8}{'errors':>8}{'rate':>8}{'ack p50':>10}{'ack p99':>10}{'p50':>10}{'p99':>10}   (ms)")
+    for command, values in sorted(commands.items()):
+        errors = [value["error"] for value in values if value["error"]]
+        acks = [value["ack"] * 1000 for value in values if value["ack"] is not None]
+        latencies = [value["latency"] * 1000 for value in values if value["latency"] is not None]
+        stats = (percentile(acks, 0.5), percentile(acks, 0.99), percentile(latencies, 0.5), percentile(latencies, 0.99))
+        print(f"{command:20}{len(values):>8}{len(errors):>8}{len(errors) / len(values):>8.1%}"
+              + "".join(f"{stat:>10.1f}" if stat is not None else f"{'-':>10}" for stat in stats))
+        for reason in sorted(set(errors)):
+            print(f"{'':20}{errors.count(reason):>8} {reason}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay webhooks to the bot running against the fake Webex API")
+    parser.add_argument("--roster", type=int, default=1000, help="users already subscribed")
+    parser.add_argument("--joining", type=int, default=200, help="users that subscribe and submit the card")
+    parser.add_argument("--updating", type=int, default=100, help="subscribed users that submit the card again")
+    parser.add_argument("--leaving", type=int, default=50, help="subscribed users that unsubscribe")
+    parser.add_argument("--events", help="json lines file of recorded events to replay instead of the synthetic ones")
+    parser.add_argument("--record", help="write the events to this json lines file")
+    parser.add_argument("--concurrency", type=int, default=20, help="users replayed at a time")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for the reply to an event")
+    parser.add_argument("--store", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--workers", type=int, default=1, help="bot worker processes, more than 1 needs --store sqlite")
+    parser.add_argument("--latency", type=float, default=20, help="milliseconds every API request takes")
+    parser.add_argument("--jitter", type=float, default=10, help="maximum random milliseconds added to the latency")
+    parser.add_argument("--throttle", type=float, default=0, help="share of the API requests answered with a 429")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="keep the folder the bot ran in")
+    args = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    folder = tempfile.mkdtemp(prefix="hermes-replay-")
+    for card in CARDS:
+        shutil.copy(os.path.join(ROOT, card), folder)
+    users_file = os.path.join(folder, "peopletonotify.json")
+    write_roster(users_file, args.roster, seed=args.seed)
+    with open(users_file) as file:
+        before = parse_users(json.load(file))[0]
+    events = read_events(args.events) if args.events else synthetic_events(
+        list(before), args.joining, args.updating, args.leaving, seed=args.seed)
+    if args.record:
+        write_events(args.record, events)
+
+    fake = FakeWebex(latency=args.latency / 1000, jitter=args.jitter / 1000, throttle=args.throttle, seed=args.seed)
+    server = fake.serve(port=0)
+    bot = Bot(folder, f"http://localhost:{server.server_port}/v1", free_port(), store=args.store, workers=args.workers)
+    bot.start()
+    watcher = FileWatcher(users_file)
+    try:
+        print(f"Replaying {len(events)} events to {bot.url}, {args.concurrency} users at a time")
+        replay = Replay(fake, bot.url, concurrency=args.concurrency, timeout=args.timeout)
+        if args.store == "json":
+            watcher.start()
+        start = time.perf_counter()
+        results = replay.replay(events)
+        elapsed = time.perf_counter() - start
+    finally:
+        if watcher.thread.is_alive():
+            watcher.stop()
+        bot.stop()
+        server.shutdown()
+    report(results, elapsed)
+
+    mismatches = compare_users(expected_users(before, results), bot.users())
+    print(f"\nUsers file: {sum(map(len, mismatches.values()))} users differ from the commands that succeeded")
+    for kind, personIds in mismatches.items():
+        print(f"    {kind}: {len(personIds)}" + (f", for instance {personIds[0]}" if personIds else ""))
+    if args.store == "json":
+        print(f"    read {watcher.reads} times while replaying, {watcher.torn} reads found it half written")
+    if args.keep:
+        print(f"The bot ran in {folder}")
+    else:
+        shutil.rmtree(folder, ignore_errors=True)
+    if any(mismatches.values()) or watcher.torn:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Synthetic rosters for Hermes
+
+    Generates users files with realistic shifts, to exercise the bot with any number of users.
+
+    Usage:
+        python tools/roster.py 10000 --output peopletonotify.json [--seed 1]
+"""
+import os
+import sys
+import json
+import uuid
+import base64
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shifts import Shift, DEFAULT_TIMEZONE  # noqa: E402
+from store import Subscriber, SCHEMA_VERSION  # noqa: E402
+
+# (start, end, weight) of the usual shifts, the night shift goes past midnight
+SHIFTS = (("06:00", "14:00", 25), ("14:00", "22:00", 25), ("22:00", "06:00", 20), ("08:00", "17:00", 20), ("09:30", "18:30", 10))
+# (days, weight) of the usual work weeks, 0 being monday
+WEEKS = (((0, 1, 2, 3, 4), 70), ((6, 0, 1, 2, 3), 10), ((1, 2, 3, 4, 5), 10), (None, 10))
+# (timezone, weight), most of the team works from the default timezone
+TIMEZONES = ((DEFAULT_TIMEZONE, 60), ("America/New_York", 10), ("America/Mexico_City", 10), ("America/Sao_Paulo", 5),
+             ("Europe/Madrid", 5), ("Europe/London", 5), ("Asia/Kolkata", 5))
+FIRST_NAMES = ("Ana", "Luis", "Maria", "Jose", "Sofia", "Carlos", "Valeria", "Diego", "Camila", "Andres", "Priya", "John", "Emma", "Kenji")
+LAST_NAMES = ("Rojas", "Vargas", "Jimenez", "Mora", "Castro", "Solano", "Smith", "Garcia", "Patel", "Silva", "Brown", "Tanaka")
+
+
+def pick(rng, choices):
+    """Draw from a list of (value..., weight) tuples.
+
+    Args:\n
+        rng (Random): Random generator.
+        choices (tuple): Tuples whose last item is the weight.
+
+    Returns:\n
+        tuple: The chosen tuple without its weight.
+    """
+    choice = rng.choices(choices, weights=[choice[-1] for choice in choices])[0]
+    return choice[:-1]
+
+
+def person_id(rng):
+    """Make up a personId shaped like the Webex ones.
+
+    Args:\n
+        rng (Random): Random generator.
+
+    Returns:\n
+        str: The personId.
+    """
+    return base64.urlsafe_b64encode(f"ciscospark://us/PEOPLE/{uuid.UUID(int=rng.getrandbits(128))}".encode()).decode().rstrip("=")
+
+
+def subscriber(rng, unsubscribed=0.05, room=0.1):
+    """Make up a subscriber.
+
+    Args:\n
+        rng (Random): Random generator.
+        unsubscribed (float, optional): Chance the user has not submitted the subscription card. Defaults to 0.05.
+        room (float, optional): Chance the user chose the team space delivery. Defaults to 0.1.
+
+    Returns:\n
+        Subscriber: The user record.
+    """
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    shift = None
+    if rng.random() >= unsubscribed:
+        start, end = pick(rng, SHIFTS)
+        days, = pick(rng, WEEKS)
+        if days is None:
+            days = rng.sample(range(7), rng.randint(3, 6))
+        timezone, = pick(rng, TIMEZONES)
+        shift = Shift(days, start, end, None if timezone == DEFAULT_TIMEZONE else timezone)
+    return Subscriber(person_id(rng), displayName=f"{first} {last}", firstName=first, nickName=first,
+                      email=f"{first.lower()}.{last.lower()}{rng.randint(1, 999)}@example.com",
+                      shift=shift, delivery="room" if shift and rng.random() < room else None)
+
+
+def roster(size, seed=0, **kwargs):
+    """Make up the users data of a team.
+
+    Args:\n
+        size (int): Number of users.
+        seed (int, optional): Seed of the random generator, the same seed gives the same roster. Defaults to 0.
+        **kwargs: Keyword arguments for subscriber.
+
+    Returns:\n
+        dict: The users data in the users file format.
+    """
+    rng = random.Random(seed)
+    users = (subscriber(rng, **kwargs) for _ in range(size))
+    return {"version": SCHEMA_VERSION, "users": {record.id: record.to_dict() for record in users}}
+
+
+def write_roster(path, size, seed=0, **kwargs):
+    """Write a users file with a made up team.
+
+    Args:\n
+        path (str): String containing the relative or full path to the users file.
+        size (int): Number of users.
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+        **kwargs: Keyword arguments for subscriber.
+    """
+    with open(path, "w") as file:
+        json.dump(roster(size, seed, **kwargs), file, sort_keys=True, indent=4, separators=(",", ": "))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a users file with a made up team")
+    parser.add_argument("size", type=int, help="number of users")
+    parser.add_argument("--output", default="peopletonotify.json")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--unsubscribed", type=float, default=0.05, help="share of users without a shift")
+    parser.add_argument("--room", type=float, default=0.1, help="share of users reminded in the team space")
+    args = parser.parse_args()
+    write_roster(args.output, args.size, args.seed, unsubscribed=args.unsubscribed, room=args.room)
+    print(f"Wrote {args.size} users to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Work queue for Hermes
+
+    Runs the webhook work on background threads so the webhook requests are acknowledged right away.
+"""
+import queue
+import threading
+from collections import OrderedDict
+
+
+class WorkQueue():
+    def __init__(self, workers=4, maxsize=1000, seen_size=4096):
+        """Bounded work queue with background workers and duplicate detection
+
+        Work is keyed by the id of the webhook event that caused it, keys already seen are dropped,
+        so a webhook delivered twice by Webex only runs once. Only the last seen_size keys are remembered.
+        When maxsize items are waiting, submitting blocks until a worker frees a spot.
+
+        Args:\n
+            workers (int, optional): Number of worker threads. Defaults to 4.
+            maxsize (int, optional): Maximum items waiting in the queue. Defaults to 1000.
+            seen_size (int, optional): Number of keys remembered to drop duplicates. Defaults to 4096.
+        """
+        self.queue = queue.Queue(maxsize)
+        self.seen_size = seen_size
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._work, name=f"hermes-work-{num}", daemon=True) for num in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def seen(self, key):
+        """Check if a key was already submitted and remember it.
+
+        Args:\n
+            key (str): Unique identifier of the work.
+
+        Returns:\n
+            bool: True if the key was already seen.
+        """
+        with self._lock:
+            if key in self._seen:
+                return True
+            self._seen[key] = None
+            while len(self._seen) > self.seen_size:
+                self._seen.popitem(last=False)
+            return False
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Queue work to be run in the background.
+
+        Args:\n
+            key (str): Unique identifier of the work, None to skip the duplicate check.
+            fn (callable): Function to run.
+            *args: Positional arguments for fn.
+            **kwargs: Keyword arguments for fn.
+
+        Returns:\n
+            bool: True if the work was queued, False if it was a duplicate.
+        """
+        if key is not None and self.seen(key):
+            return False
+        self.queue.put((fn, args, kwargs))
+        return True
+
+    def _work(self):
+        while True:
+            fn, args, kwargs = self.queue.get()
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                print(f"Background work {getattr(fn, '__name__', fn)} failed: {e!r}")
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        """Wait until every queued item has been processed."""
+        self.queue.join()